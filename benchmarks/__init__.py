@@ -0,0 +1,3 @@
+import os
+
+os.environ.setdefault("GESTOR_MODULE_SETTINGS", "config.test")
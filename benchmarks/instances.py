@@ -0,0 +1,66 @@
+"""Measures the instance lookups as the number of instances grows
+
+    poetry run python -m benchmarks.instances
+"""
+import asyncio
+import time
+
+from gestor.models.instance import InstanceModel
+from gestor.schemas.git import GitInfo
+from gestor.schemas.instance import Instance
+from gestor.utils.database import create_tables, get_session
+
+REPOSITORY = "Som-Energia/openerp_som_addons"
+
+
+async def populate(size: int) -> list[Instance]:
+    await create_tables(drop=True)
+    instances = [
+        Instance(
+            git_info=GitInfo(
+                commit="%040x" % i,
+                pull_request=i,
+                branch="branch-%d" % i,
+                repository=REPOSITORY,
+            )
+        )
+        for i in range(size)
+    ]
+    async with get_session() as db:
+        await InstanceModel.write_instances(db, instances, replace=True)
+    return instances
+
+
+async def measure(lookup, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        # Every API request opens its own session
+        async with get_session() as db:
+            await lookup(db)
+    return (time.perf_counter() - start) / number * 1e6
+
+
+async def run(number: int) -> None:
+    for size in (10, 100, 1000, 5000):
+        instance = (await populate(size))[size // 2]
+        by_name = await measure(
+            lambda db: InstanceModel.get_instance(db, instance.name), number
+        )
+        by_branch = await measure(
+            lambda db: InstanceModel.get_instance(
+                db, repository=REPOSITORY, branch=instance.git_info.branch
+            ),
+            number,
+        )
+        print(
+            "%5d instances: by name %.1f us, by branch %.1f us"
+            % (size, by_name, by_branch)
+        )
+
+
+def main(number: int = 2000) -> None:
+    asyncio.run(run(number))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Measures the in-memory rendering of the instance Kubernetes objects
+
+    poetry run python -m benchmarks.manifests
+"""
+import datetime
+import os
+import timeit
+
+from gestor.utils import manifests
+
+KUBERNETES_FILES_PATH = os.path.join(
+    os.path.dirname(manifests.__file__), "..", "kubernetes"
+)
+
+data = {
+    "name": "gbenchmark01",
+    "commit": "0123456789abcdef0123456789abcdef01234567",
+    "branch": "benchmark",
+    "repository": "Som-Energia/openerp_som_addons",
+    "pull_request": 1,
+    "server_port": 30001,
+    "ssh_port": 30002,
+    "created_at": datetime.datetime.now(),
+    "labels": {},
+    "target_module": None,
+}
+
+
+def main(number: int = 1000) -> None:
+    load = timeit.timeit(
+        lambda: manifests.ManifestRenderer(KUBERNETES_FILES_PATH), number=10
+    )
+    print("load files: %.1f us" % (load / 10 * 1e6))
+
+    renderer = manifests.ManifestRenderer(KUBERNETES_FILES_PATH)
+    render = timeit.timeit(lambda: renderer.render(data), number=number)
+    print("render instance: %.1f us" % (render / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Compares the instance store backends on the API and event paths
+
+    poetry run python -m benchmarks.store
+"""
+import asyncio
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from gestor.models.store import get_store
+from gestor.schemas.git import GitInfo
+from gestor.schemas.instance import Instance
+
+REPOSITORY = "Som-Energia/openerp_som_addons"
+
+
+def instances(size: int) -> list[Instance]:
+    return [
+        Instance(
+            git_info=GitInfo(
+                commit="%040x" % i,
+                pull_request=i,
+                branch="branch-%d" % i,
+                repository=REPOSITORY,
+            )
+        )
+        for i in range(size)
+    ]
+
+
+async def measure(func, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        await func()
+    return (time.perf_counter() - start) / number
+
+
+async def run(size: int, batch: int, number: int) -> None:
+    existing = instances(size)
+    modified = [
+        instance.copy(update={"is_ready": True}) for instance in existing[:batch]
+    ]
+    for kind in ("sql", "memory"):
+        store = get_store(kind)
+        await store.write_instances(existing, replace=True)
+
+        async def read_instances():
+            # What /api/instances/ does to build the response
+            jsonable_encoder(
+                [Instance.from_orm(i) for i in await store.get_instances()]
+            )
+
+        fetch = await measure(store.get_instances, number)
+        read = await measure(read_instances, 10)
+        lookup = await measure(
+            lambda: store.get_instance(name=existing[size // 2].name), number
+        )
+        write = await measure(lambda: store.write_instances(modified), number)
+        print(
+            "%6s: fetch %d instances %.1f ms (%.1f ms encoded), lookup %.1f us, "
+            "write %d events %.1f ms"
+            % (
+                kind,
+                size,
+                fetch * 1e3,
+                read * 1e3,
+                lookup * 1e6,
+                batch,
+                write * 1e3,
+            )
+        )
+
+
+def main(size: int = 1000, batch: int = 100, number: int = 100) -> None:
+    asyncio.run(run(size, batch, number))
+
+
+if __name__ == "__main__":
+    main()
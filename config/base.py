@@ -4,15 +4,41 @@ from pydantic import BaseSettings
 class Settings(BaseSettings):
     KUBERNETES_FILES_PATH: str
     KUBERNETES_NAMESPACE: str
-    TEMP_DIRECTORY_PATH: str
     DEPLOY_DOMAIN: str
+    EXPOSE_MODE: str = "nodeport"
     SSH_IP: str
     SSH_USER: str
     SSH_KEY_PATH: str
+    SSH_MODE: str = "nodeport"
+    SSH_GATEWAY_HOST: str = "{name}-erpserver-ssh.{namespace}.svc.cluster.local"
+    SSH_GATEWAY_PORT: int = 22
+    SSH_IDLE_TIMEOUT: float = 300
+    SSH_KEEPALIVE_INTERVAL: int = 30
+    SSH_MAX_CHANNELS: int = 10
     ALLOWED_REPOSITORIES: list[str]
     LIMIT_INSTANCES: bool
+    INSTANCE_STORE: str = "sql"
     WEBHOOKS_SECRET: str
+    WEBHOOKS_DEBOUNCE_SECONDS: float = 10
+    WEBHOOKS_DEBOUNCE_MAX_WAIT: float = 60
     GITHUB_TOKEN: str
+    DEPLOY_MAX_WORKERS: int = 4
+    KUBERNETES_CONNECTION_POOL_SIZE: int = 100
+    EVENT_BUFFER_SIZE: int = 1000
+    EVENT_BATCH_SIZE: int = 100
+    EVENT_HUB_BUFFER_SIZE: int = 100
+    EVENT_HUB_HISTORY_SIZE: int = 1000
+    LOG_BUFFER_LINES: int = 5000
+    LOG_BUFFER_CONTAINERS: list[str] = ["erpserver"]
+    LOG_BUFFER_MAX_INSTANCES: int = 20
+    LOG_FOLLOW_MAX_STREAMS: int = 20
+    GITHUB_CONNECTION_POOL_SIZE: int = 10
+    GITHUB_RATE_LIMIT_RESERVE: int = 100
+    GITHUB_RATE_LIMIT_MAX_WAIT: float = 60
+    GITHUB_MAX_RETRIES: int = 3
+    GITHUB_CACHE_SIZE: int = 1024
+    GITHUB_CACHE_TTL: float = 30
+    GITHUB_STATUS_WORKERS: int = 4
 
     class Config:
         env_file_encoding = "utf-8"
@@ -1,6 +1,17 @@
+<%
+  ingress = expose_mode == "ingress"
+  # SSH has a Service of its own unless it shares the erpserver NodePorts
+  ssh_service = ssh_mode == "gateway" or ingress
+%>
 resources:
   - deployment.yaml
   - service.yaml
+% if ssh_service:
+  - service-ssh.yaml
+% endif
+% if ingress:
+  - ingress.yaml
+% endif
 
 # Set prefix to all resource names
 # Also to the ones in Ingress rules
@@ -41,9 +52,44 @@ patches:
       kind: Service
       name: erpserver
     patch: |-
+% if ingress:
+      - op: replace
+        path: /spec/type
+        value: ClusterIP
+      - op: remove
+        path: /spec/ports/0/nodePort
+% else:
       - op: replace
         path: /spec/ports/0/nodePort
         value: ${server_port}
+% endif
+% if ssh_service:
+      - op: remove
+        path: /spec/ports/1
+% else:
       - op: replace
         path: /spec/ports/1/nodePort
         value: ${ssh_port}
+% endif
+## Only reached through a NodePort in nodeport SSH mode
+% if ssh_service and ssh_mode != "gateway":
+  - target:
+      kind: Service
+      name: erpserver-ssh
+    patch: |-
+      - op: replace
+        path: /spec/type
+        value: NodePort
+      - op: add
+        path: /spec/ports/0/nodePort
+        value: ${ssh_port}
+% endif
+% if ingress:
+  - target:
+      kind: Ingress
+      name: erpserver
+    patch: |-
+      - op: replace
+        path: /spec/rules/0/host
+        value: ${name}.${domain}
+% endif
@@ -37,4 +37,5 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event() -> None:
+    await webhooks.debouncer.stop()
     await manager.manager.stop()
@@ -1,47 +1,89 @@
 import logging
-from asyncio import create_task, Queue, gather
+from asyncio import create_task, gather
 
 from config import settings
-from gestor.models.instance import InstanceModel
+from gestor.models.store import get_store
 from gestor.schemas.git import GitInfo
 from gestor.schemas.instance import Instance
 from gestor.utils import github
 from gestor.utils import kubernetes
-from gestor.utils.database import SessionLocal
-from gestor.utils.github import set_commit_status, GitHubStatusState, commit_exists
+from gestor.utils import manifests
+from gestor.utils import ssh
+from gestor.utils.events import EventBuffer
+from gestor.utils.hub import EventHub
+from gestor.utils.github import (
+    CommitStatus,
+    GitHubStatusState,
+    commit_exists,
+    publisher,
+)
+from gestor.utils.jobs import executor
+from gestor.utils.locks import KeyedLock, Superseded
+from gestor.utils.logs import LogCollector
 
 _logger = logging.getLogger(__name__)
 
 
 class Manager:
     def __init__(self):
-        self._db = SessionLocal()
+        self.store = get_store(settings.INSTANCE_STORE)
         self._tasks = []
+        self._operations = KeyedLock()
+        self.events = EventBuffer(settings.EVENT_BUFFER_SIZE)
+        self.feed = EventHub(
+            settings.EVENT_HUB_BUFFER_SIZE, settings.EVENT_HUB_HISTORY_SIZE
+        )
+        self._ready: set[str] = set()
+        self.logs = LogCollector(
+            settings.LOG_BUFFER_LINES,
+            settings.LOG_BUFFER_CONTAINERS,
+            settings.LOG_BUFFER_MAX_INSTANCES,
+        )
+
+    @staticmethod
+    def _branch_key(git_info: GitInfo) -> tuple[str, str]:
+        return git_info.repository, git_info.branch or git_info.commit
+
+    async def _deploy(self, instance: Instance, module: str = None) -> None:
+        if await instance.deploy(module):
+            # Known before its Kubernetes events arrive, so the next operation
+            # on the branch finds it
+            await self.store.create_instance(instance)
+
+    async def _undeploy(self, instance: Instance) -> None:
+        if await instance.undeploy():
+            await self.store.delete_instance(instance)
 
     async def stop_instance_from_webhook(self, git_info: GitInfo) -> None:
         if git_info.repository not in settings.ALLOWED_REPOSITORIES:
             _logger.debug("Repository %s is not allowed", git_info.repository)
             return
 
-        existing_instance = InstanceModel.get_instance(
-            self._db,
-            repository=git_info.repository,
-            branch=git_info.branch,
-        )
-        if existing_instance:
+        try:
+            async with self._operations.acquire(
+                self._branch_key(git_info), supersede=True
+            ):
+                existing_instance = await self.store.get_instance(
+                    repository=git_info.repository,
+                    branch=git_info.branch,
+                )
+                if existing_instance:
+                    _logger.debug(
+                        "Stopping instance %s PR%d:%s",
+                        existing_instance.repository,
+                        existing_instance.pull_request,
+                        existing_instance.name,
+                    )
+                    await self._undeploy(Instance.from_orm(existing_instance))
+                else:
+                    _logger.debug(
+                        "Instance not found %s PR%d",
+                        git_info.repository,
+                        git_info.pull_request,
+                    )
+        except Superseded:
             _logger.debug(
-                "Stopping instance %s PR%d:%s",
-                existing_instance.repository,
-                existing_instance.pull_request,
-                existing_instance.name,
-            )
-            instance = Instance.from_orm(existing_instance)
-            await instance.undeploy()
-        else:
-            _logger.debug(
-                "Instance not found %s PR%d",
-                git_info.repository,
-                git_info.pull_request,
+                "Stopping %s/%s superseded", git_info.repository, git_info.branch
             )
 
     async def start_instance_from_webhook(self, git_info: GitInfo) -> None:
@@ -49,46 +91,58 @@ class Manager:
             _logger.debug("Repository %s is not allowed", git_info.repository)
             return
 
-        existing_instance = InstanceModel.get_instance(
-            self._db,
-            repository=git_info.repository,
-            branch=git_info.branch,
-        )
+        try:
+            async with self._operations.acquire(
+                self._branch_key(git_info), supersede=True
+            ):
+                existing_instance = await self.store.get_instance(
+                    repository=git_info.repository,
+                    branch=git_info.branch,
+                )
 
-        if existing_instance and existing_instance.commit == git_info.commit:
-            return
+                if existing_instance and existing_instance.commit == git_info.commit:
+                    return
+
+                if existing_instance and settings.LIMIT_INSTANCES:
+                    _logger.debug(
+                        "An instance for %s/%s already exists, it will we replaced:%s",
+                        existing_instance.repository,
+                        existing_instance.branch,
+                        existing_instance.name,
+                    )
+                    await self._undeploy(Instance.from_orm(existing_instance))
 
-        if existing_instance and settings.LIMIT_INSTANCES:
+                await self._deploy(Instance(git_info=git_info))
+        except Superseded:
             _logger.debug(
-                "An instance for %s/%s already exists, it will we replaced:%s",
-                existing_instance.repository,
-                existing_instance.branch,
-                existing_instance.name,
+                "Starting %s/%s (%s) superseded",
+                git_info.repository,
+                git_info.branch,
+                git_info.commit,
             )
-            instance = Instance.from_orm(existing_instance)
-            await instance.undeploy()
-
-        instance = Instance(git_info=git_info)
-        await instance.deploy()
 
     async def start_instance(self, instance: Instance, module: str = None):
-        # Allow just one instance for a repository branch
-        existing_instance = InstanceModel.get_instance(
-            self._db,
-            repository=instance.git_info.repository,
-            branch=instance.git_info.branch,
-        )
-
-        if existing_instance and settings.LIMIT_INSTANCES:
-            _logger.debug(
-                "An instance for %s/%s already exists:%s",
-                existing_instance.repository,
-                existing_instance.branch,
-                existing_instance.name,
+        async with self._operations.acquire(self._branch_key(instance.git_info)):
+            # Allow just one instance for a repository branch
+            existing_instance = await self.store.get_instance(
+                repository=instance.git_info.repository,
+                branch=instance.git_info.branch,
             )
-            raise Exception("An instance for the associated branch already exists")
 
-        await instance.deploy(module)
+            if existing_instance and settings.LIMIT_INSTANCES:
+                _logger.debug(
+                    "An instance for %s/%s already exists:%s",
+                    existing_instance.repository,
+                    existing_instance.branch,
+                    existing_instance.name,
+                )
+                raise Exception("An instance for the associated branch already exists")
+
+            await self._deploy(instance, module)
+
+    async def stop_instance(self, instance: Instance) -> None:
+        async with self._operations.acquire(self._branch_key(instance.git_info)):
+            await self._undeploy(instance)
 
     async def start_instance_from_pull_request(
         self, repository: str, pull_request: int
@@ -133,85 +187,169 @@ class Manager:
         instance = Instance(git_info=git_info)
         await self.start_instance(instance, module)
 
-    async def init_db_from_cluster(self):
-        deployments = await kubernetes.cluster_deployments()
+    async def init_db_from_cluster(self, deployments: list = None):
+        """Replaces the instances with the deployments of the cluster
+
+        The differences with the previous instances are handled as events,
+        as the deployments may have changed while they were not watched.
+        """
+        if deployments is None:
+            deployments = await kubernetes.cluster_deployments()
+        instances = {}
         for deployment in deployments:
             instance = Instance.parse_obj(await Instance.deployment_to_dict(deployment))
-            InstanceModel.create_instance(self._db, instance)
-            InstanceModel.create_instance(self._db, instance)
+            instances[instance.name] = instance
+        previous = {
+            record.name: Instance.from_orm(record)
+            for record in await self.store.get_instances()
+        }
+        await self.store.write_instances(instances.values(), replace=True)
+        self.feed.resync()
+        self.logs.retain(set(instances))
+        changes = [
+            (instance, "DELETED")
+            for name, instance in previous.items()
+            if name not in instances
+        ]
+        for instance in instances.values():
+            old = previous.get(instance.name)
+            if old is None:
+                changes.append((instance, "ADDED"))
+            elif (old.is_ready, old.git_info) != (instance.is_ready, instance.git_info):
+                changes.append((instance, "MODIFIED"))
+        self.apply_changes(changes)
 
-    async def process_kubernetes_events(self, event_queue):
-        while True:
-            event = await event_queue.get()
+    async def apply_kubernetes_events(self, events: list[dict]) -> None:
+        """Writes the changes of a batch of events in one transaction"""
+        upserted: dict[str, Instance] = {}
+        deleted: set[str] = set()
+        changes = []
+        for event in events:
             event_type = event["type"]
+            if event_type == "SYNC":
+                _logger.debug("Event SYNC (%d deployments)", len(event["objects"]))
+                await self.store.write_instances(upserted.values(), deleted)
+                self.apply_changes(changes)
+                upserted.clear()
+                deleted.clear()
+                changes.clear()
+                await self.init_db_from_cluster(event["objects"])
+                continue
             deployment = event["object"]
             _logger.debug("Event %s %s", event_type, deployment.metadata.name)
-            instance = Instance.parse_obj(await Instance.deployment_to_dict(deployment))
             try:
-                if event_type == "ADDED":
-                    InstanceModel.create_instance(self._db, instance)
-                elif event_type == "DELETED":
-                    InstanceModel.delete_instance(self._db, instance)
-                elif event_type == "MODIFIED":
-                    InstanceModel.delete_instance(self._db, instance)
-                    InstanceModel.create_instance(self._db, instance)
-                await self.update_commit_status(instance, event_type)
-            except Exception:
-                pass
+                instance = Instance.parse_obj(
+                    await Instance.deployment_to_dict(deployment)
+                )
+            except Exception as e:
+                _logger.error("Invalid deployment %s:%s", deployment.metadata.name, e)
+                continue
+            if event_type in ("ADDED", "MODIFIED"):
+                upserted[instance.name] = instance
+                deleted.discard(instance.name)
+            elif event_type == "DELETED":
+                deleted.add(instance.name)
+                upserted.pop(instance.name, None)
+            changes.append((instance, event_type))
+
+        await self.store.write_instances(upserted.values(), deleted)
+        self.apply_changes(changes)
+
+    def apply_changes(self, changes: list[tuple[Instance, str]]) -> None:
+        """Notifies the instance changes once they are in the store"""
+        for instance, event_type in changes:
+            self.publish_change(instance, event_type)
+            self.collect_logs(instance, event_type)
+            self.update_commit_status(instance, event_type)
+
+    def publish_change(self, instance: Instance, event: str) -> None:
+        """Sends an instance change to the feed subscribers"""
+        if event == "DELETED":
+            self._ready.discard(instance.name)
+            self.feed.publish("deleted", instance)
+            return
+        self.feed.publish("added" if event == "ADDED" else "modified", instance)
+        if not instance.is_ready:
+            self._ready.discard(instance.name)
+        elif instance.name not in self._ready:
+            self._ready.add(instance.name)
+            self.feed.publish("ready", instance)
+
+    def collect_logs(self, instance: Instance, event: str) -> None:
+        """Buffers the logs of an instance from the time it is ready
+
+        They are kept until the instance is deleted, so the lines of a
+        crashed server can still be searched.
+        """
+        if event == "DELETED":
+            self.logs.unwatch(instance.name)
+        elif instance.is_ready:
+            self.logs.watch(instance.name)
+
+    async def process_kubernetes_events(self, event_queue):
+        while True:
+            events = await event_queue.get_batch(settings.EVENT_BATCH_SIZE)
+            try:
+                await self.apply_kubernetes_events(events)
+            except Exception as e:
+                _logger.error("Failed to process Kubernetes events:%s", str(e))
 
     async def start(self) -> None:
-        event_queue = Queue()
-        self._tasks.append(create_task(self.init_db_from_cluster()))
-        self._tasks.append(create_task(self.watch_kubernetes_events(event_queue)))
-        self._tasks.append(create_task(self.process_kubernetes_events(event_queue)))
+        # Load and compile the Kubernetes files before the first deploy
+        manifests.get_renderer()
+        try:
+            await kubernetes.get_client()
+        except Exception as e:
+            _logger.error("Failed to configure the Kubernetes client:%s", str(e))
+        self._tasks.append(create_task(self.watch_kubernetes_events(self.events)))
+        self._tasks.append(create_task(self.process_kubernetes_events(self.events)))
+        self._tasks.extend(publisher.start())
+        self._tasks.extend(ssh.pool.start())
 
     async def stop(self) -> None:
+        executor.cancel_all()
         for task in self._tasks:
             task.cancel()
         await gather(*self._tasks, return_exceptions=True)
         self._tasks.clear()
+        await self.logs.stop()
+        await ssh.pool.close()
+        await kubernetes.close_client()
+        await github.client.close()
 
     @staticmethod
     async def watch_kubernetes_events(event_queue):
-        while True:
-            try:
-                await kubernetes.watch_deployments(event_queue)
-            except Exception as e:
-                _logger.debug("Error watching K8s Deployments:%s" % str(e))
+        await kubernetes.DeploymentInformer().run(event_queue)
 
     @staticmethod
-    async def update_commit_status(instance: Instance, event: str) -> None:
+    def update_commit_status(instance: Instance, event: str) -> None:
         if not instance.git_info.pull_request:
             return
         if event == "DELETED":
-            await set_commit_status(
-                instance.name,
-                instance.git_info.repository,
-                instance.git_info.commit,
-                "The instance no longer exists",
-                GitHubStatusState.failure,
-            )
-            return
-        if event not in ["ADDED", "MODIFIED"]:  # Invalid events
+            description = "The instance no longer exists"
+            state = GitHubStatusState.failure
+        elif event not in ["ADDED", "MODIFIED"]:  # Invalid events
             return
-        if event == "MODIFIED" and not instance.is_ready:  # Avoid unnecessary API calls
+        elif (
+            event == "MODIFIED" and not instance.is_ready
+        ):  # Avoid unnecessary API calls
             return
-        if instance.is_ready:
-            await set_commit_status(
-                instance.name,
-                instance.git_info.repository,
-                instance.git_info.commit,
-                "The instance is ready",
-                GitHubStatusState.success,
-            )
+        elif instance.is_ready:
+            description = "The instance is ready"
+            state = GitHubStatusState.success
         else:
-            await set_commit_status(
+            description = "The instance is initializing"
+            state = GitHubStatusState.pending
+        publisher.publish(
+            CommitStatus(
                 instance.name,
                 instance.git_info.repository,
                 instance.git_info.commit,
-                "The instance is initializing",
-                GitHubStatusState.pending,
+                description,
+                state,
+                instance.url,
             )
+        )
 
 
 manager = Manager()
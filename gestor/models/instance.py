@@ -1,7 +1,11 @@
+import functools
 from datetime import datetime
+from typing import Iterable
 
-from sqlalchemy import DateTime
-from sqlalchemy.orm import Mapped, Session, mapped_column
+from sqlalchemy import DateTime, Index, Select, bindparam, delete, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped, mapped_column
 
 from gestor.schemas.instance import Instance
 from gestor.utils.database import Base
@@ -9,23 +13,24 @@ from gestor.utils.database import Base
 
 class InstanceModel(Base):
     __tablename__ = "instances"
-
-    id: Mapped[int] = mapped_column(
-        "id", autoincrement=True, nullable=False, unique=True, primary_key=True
+    __table_args__ = (
+        Index("ix_instances_repository_branch", "repository", "branch"),
+        Index("ix_instances_repository_pull_request", "repository", "pull_request"),
     )
-    name: Mapped[str] = mapped_column("name", nullable=False)
-    server_port: Mapped[int] = mapped_column("server_port", nullable=False)
-    ssh_port: Mapped[int] = mapped_column("ssh_port", nullable=False)
+
+    name: Mapped[str] = mapped_column("name", primary_key=True)
+    server_port: Mapped[int] = mapped_column("server_port", nullable=False, index=True)
+    ssh_port: Mapped[int] = mapped_column("ssh_port", nullable=False, index=True)
     is_ready: Mapped[bool] = mapped_column("is_ready", nullable=False)
     created_at: Mapped[datetime] = mapped_column("created_at", DateTime, nullable=False)
-    commit: Mapped[str] = mapped_column("commit", nullable=False)
+    commit: Mapped[str] = mapped_column("commit", nullable=False, index=True)
     repository: Mapped[str] = mapped_column("repository", nullable=False)
     pull_request: Mapped[int] = mapped_column("pull_request", nullable=True)
     branch: Mapped[str] = mapped_column("branch", nullable=True)
 
     @classmethod
-    def create_instance(cls, db: Session, instance: Instance):
-        if cls.get_instance(db, instance.name):
+    async def create_instance(cls, db: AsyncSession, instance: Instance):
+        if await cls.get_instance(db, instance.name):
             return
 
         new_instance = cls(
@@ -41,51 +46,152 @@ class InstanceModel(Base):
         )
 
         db.add(new_instance)
-        db.commit()
-        db.refresh(new_instance)
+        await db.commit()
+        await db.refresh(new_instance)
 
         return new_instance
 
-    @classmethod
-    def delete_instance(cls, db: Session, instance: Instance) -> None:
-        db_instance = cls.get_instance(db, instance.name)
-        if db_instance:
-            db.delete(db_instance)
-            db.commit()
+    @staticmethod
+    def _row(instance: Instance) -> dict:
+        return {
+            "name": instance.name,
+            "server_port": instance.server_port,
+            "ssh_port": instance.ssh_port,
+            "is_ready": instance.is_ready,
+            "created_at": instance.created_at,
+            "commit": instance.git_info.commit,
+            "repository": instance.git_info.repository,
+            "pull_request": instance.git_info.pull_request,
+            "branch": instance.git_info.branch,
+        }
 
     @classmethod
-    def get_instances(
-        cls, db: Session, name: str = None, repository: str = None, branch: str = None
-    ):
-        instance_query = db.query(cls)
+    async def write_instances(
+        cls,
+        db: AsyncSession,
+        instances: Iterable[Instance] = (),
+        deleted: Iterable[str] = (),
+        replace: bool = False,
+    ) -> None:
+        """Upserts and deletes instances in a single transaction
+
+        With replace, every instance not in instances is deleted.
+        """
+        table = cls.__table__
+        if replace:
+            await db.execute(delete(table))
+        deleted = list(deleted)
+        if deleted:
+            await db.execute(delete(table).where(table.c.name.in_(deleted)))
+        rows = [cls._row(instance) for instance in instances]
+        if rows:
+            statement = insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.name],
+                set_={key: statement.excluded[key] for key in rows[0]},
+            )
+            await db.execute(statement, rows)
+        await db.commit()
 
-        if name:
-            instance_query = instance_query.filter(cls.name == name)
-        if repository:
-            instance_query = instance_query.filter(cls.repository == repository)
-        if branch:
-            instance_query = instance_query.filter(cls.branch == branch)
+    @classmethod
+    async def delete_instance(cls, db: AsyncSession, instance: Instance) -> None:
+        db_instance = await cls.get_instance(db, instance.name)
+        if db_instance:
+            await db.delete(db_instance)
+            await db.commit()
 
-        return instance_query.all()
+    @staticmethod
+    def _filters(**filters) -> dict:
+        return {key: value for key, value in filters.items() if value is not None}
 
     @classmethod
-    def get_instance(
-        cls, db: Session, name: str = None, repository: str = None, branch: str = None
+    async def get_instances(
+        cls,
+        db: AsyncSession,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+        pull_request: int = None,
+        is_ready: bool = None,
+        created_after: datetime = None,
+        after: str = None,
+        limit: int = None,
     ):
-        instance_query = db.query(cls)
+        """Returns the matching instances ordered by name
+
+        after and limit page through them, after being the last name seen.
+        """
+        filters = cls._filters(
+            name=name,
+            repository=repository,
+            branch=branch,
+            commit=commit,
+            pull_request=pull_request,
+            is_ready=is_ready,
+            created_after=created_after,
+            after=after,
+            limit=limit,
+        )
+        return (await db.scalars(_select_instances(*filters), filters)).all()
 
-        if not name and not branch:
+    @classmethod
+    async def get_instance(
+        cls,
+        db: AsyncSession,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+    ):
+        if not name and not branch and not commit:
             return None
 
-        if name:
-            instance_query = instance_query.filter(cls.name == name)
-        if repository:
-            instance_query = instance_query.filter(cls.repository == repository)
-        if branch:
-            instance_query = instance_query.filter(cls.branch == branch)
+        filters = cls._filters(
+            name=name or None,
+            repository=repository or None,
+            branch=branch or None,
+            commit=commit or None,
+        )
+        return (await db.scalars(_select_instances(*filters), filters)).first()
 
-        return instance_query.first()
+    @classmethod
+    async def get_instance_by_port(cls, db: AsyncSession, port: int):
+        return (await db.scalars(_select_by_port(), {"port": port})).first()
 
     @classmethod
-    def get_ports(cls, db: Session):
-        return db.query(cls.server_port, cls.ssh_port).all()
+    async def get_ports(cls, db: AsyncSession):
+        return (await db.execute(_select_ports())).all()
+
+
+@functools.cache
+def _select_instances(*filters: str) -> Select:
+    """Builds once the statement filtering instances by the given filters
+
+    Values are bound at execution, so each combination of filters is compiled
+    a single time and reused from the SQLAlchemy statement cache.
+    """
+    statement = select(InstanceModel).order_by(InstanceModel.name)
+    for key in filters:
+        if key == "created_after":
+            statement = statement.where(InstanceModel.created_at > bindparam(key))
+        elif key == "after":
+            statement = statement.where(InstanceModel.name > bindparam(key))
+        elif key == "limit":
+            statement = statement.limit(bindparam(key))
+        else:
+            statement = statement.where(getattr(InstanceModel, key) == bindparam(key))
+    return statement
+
+
+@functools.cache
+def _select_by_port() -> Select:
+    port = bindparam("port")
+    return select(InstanceModel).where(
+        (InstanceModel.server_port == port) | (InstanceModel.ssh_port == port)
+    )
+
+
+@functools.cache
+def _select_ports() -> Select:
+    return select(InstanceModel.server_port, InstanceModel.ssh_port)
@@ -0,0 +1,445 @@
+import abc
+import bisect
+import datetime
+import itertools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterable, Iterator, Optional, Sequence
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from gestor.models.instance import InstanceModel
+from gestor.schemas.instance import Instance
+from gestor.utils.database import create_tables, get_session
+
+
+class UnsupportedInstanceStore(Exception):
+    pass
+
+
+def _naive(value: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    """Converts an aware datetime to the naive local time of created_at"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+class InstanceStore(abc.ABC):
+    """Keeps track of the deployed instances
+
+    Returned instances expose the InstanceModel attributes, so they can be
+    read with Instance.from_orm. version is increased on every write, so
+    data derived from the instances knows when to be rebuilt.
+    """
+
+    version = 0
+
+    @abc.abstractmethod
+    async def create_instance(self, instance: Instance):
+        """Adds an instance, unless another one has the same name"""
+
+    @abc.abstractmethod
+    async def delete_instance(self, instance: Instance) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def write_instances(
+        self,
+        instances: Iterable[Instance] = (),
+        deleted: Iterable[str] = (),
+        replace: bool = False,
+    ) -> None:
+        """Upserts and deletes instances at once
+
+        With replace, every instance not in instances is deleted.
+        """
+
+    @abc.abstractmethod
+    async def get_instances(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+        pull_request: int = None,
+        is_ready: bool = None,
+        created_after: datetime.datetime = None,
+        after: str = None,
+        limit: int = None,
+    ) -> list:
+        """Returns the matching instances ordered by name
+
+        after and limit page through them, after being the last name seen.
+        """
+
+    @abc.abstractmethod
+    async def get_instance(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+    ):
+        pass
+
+    @abc.abstractmethod
+    async def get_instance_by_port(self, port: int):
+        pass
+
+    @abc.abstractmethod
+    async def get_ports(self) -> list[tuple[int, int]]:
+        pass
+
+
+class SQLInstanceStore(InstanceStore):
+    """Instances stored with the SQLAlchemy models, one session per call"""
+
+    def __init__(self):
+        self._tables_created = False
+
+    @asynccontextmanager
+    async def _session(self) -> AsyncIterator[AsyncSession]:
+        if not self._tables_created:
+            await create_tables()
+            self._tables_created = True
+        async with get_session() as db:
+            yield db
+
+    async def create_instance(self, instance: Instance):
+        async with self._session() as db:
+            new_instance = await InstanceModel.create_instance(db, instance)
+        self.version += 1
+        return new_instance
+
+    async def delete_instance(self, instance: Instance) -> None:
+        async with self._session() as db:
+            await InstanceModel.delete_instance(db, instance)
+        self.version += 1
+
+    async def write_instances(
+        self,
+        instances: Iterable[Instance] = (),
+        deleted: Iterable[str] = (),
+        replace: bool = False,
+    ) -> None:
+        async with self._session() as db:
+            await InstanceModel.write_instances(db, instances, deleted, replace)
+        self.version += 1
+
+    async def get_instances(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+        pull_request: int = None,
+        is_ready: bool = None,
+        created_after: datetime.datetime = None,
+        after: str = None,
+        limit: int = None,
+    ) -> list:
+        async with self._session() as db:
+            return await InstanceModel.get_instances(
+                db,
+                name=name,
+                repository=repository,
+                branch=branch,
+                commit=commit,
+                pull_request=pull_request,
+                is_ready=is_ready,
+                created_after=_naive(created_after),
+                after=after,
+                limit=limit,
+            )
+
+    async def get_instance(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+    ):
+        async with self._session() as db:
+            return await InstanceModel.get_instance(
+                db, name, repository, branch, commit
+            )
+
+    async def get_instance_by_port(self, port: int):
+        async with self._session() as db:
+            return await InstanceModel.get_instance_by_port(db, port)
+
+    async def get_ports(self) -> list[tuple[int, int]]:
+        async with self._session() as db:
+            return await InstanceModel.get_ports(db)
+
+
+class InstanceRecord:
+    """Immutable instance entry of the memory store"""
+
+    __slots__ = (
+        "name",
+        "server_port",
+        "ssh_port",
+        "is_ready",
+        "created_at",
+        "commit",
+        "repository",
+        "pull_request",
+        "branch",
+    )
+
+    name: str
+    server_port: int
+    ssh_port: int
+    is_ready: bool
+    created_at: datetime.datetime
+    commit: str
+    repository: str
+    pull_request: Optional[int]
+    branch: Optional[str]
+
+    def __init__(self, instance: Instance):
+        set_attribute = object.__setattr__
+        set_attribute(self, "name", instance.name)
+        set_attribute(self, "server_port", instance.server_port)
+        set_attribute(self, "ssh_port", instance.ssh_port)
+        set_attribute(self, "is_ready", instance.is_ready)
+        set_attribute(self, "created_at", instance.created_at)
+        set_attribute(self, "commit", instance.git_info.commit)
+        set_attribute(self, "repository", instance.git_info.repository)
+        set_attribute(self, "pull_request", instance.git_info.pull_request)
+        set_attribute(self, "branch", instance.git_info.branch)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("InstanceRecord is immutable")
+
+    def __repr__(self) -> str:
+        return "InstanceRecord(%s)" % self.name
+
+
+def _name(record: InstanceRecord) -> str:
+    return record.name
+
+
+# Keys each index of a snapshot files a record under
+_INDEXES = {
+    "branches": lambda record: {(record.repository, record.branch)},
+    "pull_requests": lambda record: {(record.repository, record.pull_request)},
+    "commits": lambda record: {record.commit},
+}
+
+
+class Snapshot:
+    """Instances and their indexes at a point in time, never modified
+
+    Every index maps a key to its records ordered by name.
+    """
+
+    __slots__ = ("names", "ordered", *_INDEXES)
+
+    def __init__(self, names: dict[str, InstanceRecord]):
+        self.names = names
+        self.ordered = tuple(names[name] for name in sorted(names))
+        for attribute, keys in _INDEXES.items():
+            index: dict = {}
+            for record in self.ordered:
+                for key in keys(record):
+                    index.setdefault(key, []).append(record)
+            setattr(self, attribute, {key: tuple(v) for key, v in index.items()})
+
+    def updated(
+        self, records: Iterable[InstanceRecord], deleted: Iterable[str] = ()
+    ) -> "Snapshot":
+        """Returns a copy with records added or replaced and deleted removed
+
+        Only the index entries of the changed instances are rebuilt, so a
+        write costs a copy of the dicts instead of sorting every instance.
+        """
+        changes: dict[str, Optional[InstanceRecord]] = dict.fromkeys(deleted)
+        changes.update((record.name, record) for record in records)
+        snapshot = Snapshot.__new__(Snapshot)
+        names = dict(self.names)
+        ordered = list(self.ordered)
+        indexes = {attribute: dict(getattr(self, attribute)) for attribute in _INDEXES}
+        for name, record in changes.items():
+            old = names.pop(name, None)
+            if old is not None:
+                del ordered[bisect.bisect_left(ordered, name, key=_name)]
+                for attribute, keys in _INDEXES.items():
+                    index = indexes[attribute]
+                    for key in keys(old):
+                        remaining = tuple(r for r in index[key] if r is not old)
+                        if remaining:
+                            index[key] = remaining
+                        else:
+                            del index[key]
+            if record is not None:
+                names[name] = record
+                bisect.insort(ordered, record, key=_name)
+                for attribute, keys in _INDEXES.items():
+                    index = indexes[attribute]
+                    for key in keys(record):
+                        current = index.get(key, ())
+                        position = bisect.bisect(current, name, key=_name)
+                        index[key] = current[:position] + (record,) + current[position:]
+        snapshot.names = names
+        snapshot.ordered = tuple(ordered)
+        for attribute, index in indexes.items():
+            setattr(snapshot, attribute, index)
+        return snapshot
+
+    def _candidates(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+        pull_request: int = None,
+        after: str = None,
+    ) -> Sequence[InstanceRecord]:
+        if name is not None:
+            record = self.names.get(name)
+            return (record,) if record else ()
+        if repository is not None and branch is not None:
+            return self.branches.get((repository, branch), ())
+        if repository is not None and pull_request is not None:
+            return self.pull_requests.get((repository, pull_request), ())
+        if commit is not None:
+            return self.commits.get(commit, ())
+        if after is not None:
+            start = bisect.bisect_right(self.ordered, after, key=lambda r: r.name)
+            return self.ordered[start:]
+        return self.ordered
+
+    def find(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+        pull_request: int = None,
+        is_ready: bool = None,
+        created_after: datetime.datetime = None,
+        after: str = None,
+        limit: int = None,
+    ) -> Iterator[InstanceRecord]:
+        """Yields the matching instances ordered by name"""
+        candidates = self._candidates(
+            name, repository, branch, commit, pull_request, after
+        )
+        records = (
+            record
+            for record in candidates
+            if (repository is None or record.repository == repository)
+            and (branch is None or record.branch == branch)
+            and (commit is None or record.commit == commit)
+            and (pull_request is None or record.pull_request == pull_request)
+            and (is_ready is None or record.is_ready == is_ready)
+            and (created_after is None or record.created_at > created_after)
+            and (after is None or record.name > after)
+        )
+        return itertools.islice(records, limit)
+
+
+class MemoryInstanceStore(InstanceStore):
+    """Instances kept in dicts indexed by name, branch and commit
+
+    Writers build an updated snapshot and swap it in, so readers iterate a
+    consistent state without locks. Instances are rebuilt from Kubernetes on
+    startup, so nothing is persisted (ADR 0004).
+    """
+
+    def __init__(self):
+        self._snapshot = Snapshot({})
+
+    def snapshot(self) -> Snapshot:
+        return self._snapshot
+
+    async def create_instance(self, instance: Instance):
+        if instance.name in self._snapshot.names:
+            return
+        await self.write_instances([instance])
+        return self._snapshot.names[instance.name]
+
+    async def delete_instance(self, instance: Instance) -> None:
+        if instance.name in self._snapshot.names:
+            await self.write_instances(deleted=[instance.name])
+
+    async def write_instances(
+        self,
+        instances: Iterable[Instance] = (),
+        deleted: Iterable[str] = (),
+        replace: bool = False,
+    ) -> None:
+        records = [InstanceRecord(instance) for instance in instances]
+        if replace:
+            self._snapshot = Snapshot({record.name: record for record in records})
+        else:
+            self._snapshot = self._snapshot.updated(records, deleted)
+        self.version += 1
+
+    async def get_instances(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+        pull_request: int = None,
+        is_ready: bool = None,
+        created_after: datetime.datetime = None,
+        after: str = None,
+        limit: int = None,
+    ) -> list[InstanceRecord]:
+        return list(
+            self._snapshot.find(
+                name,
+                repository,
+                branch,
+                commit,
+                pull_request,
+                is_ready,
+                _naive(created_after),
+                after,
+                limit,
+            )
+        )
+
+    async def get_instance(
+        self,
+        name: str = None,
+        repository: str = None,
+        branch: str = None,
+        commit: str = None,
+    ) -> Optional[InstanceRecord]:
+        if not name and not branch and not commit:
+            return None
+        records = self._snapshot.find(
+            name or None, repository or None, branch or None, commit or None
+        )
+        return next(records, None)
+
+    async def get_instance_by_port(self, port: int) -> Optional[InstanceRecord]:
+        # Not indexed, as the ingress and gateway modes give every instance
+        # the same server or SSH port
+        for record in self._snapshot.ordered:
+            if port in (record.server_port, record.ssh_port):
+                return record
+        return None
+
+    async def get_ports(self) -> list[tuple[int, int]]:
+        return [
+            (record.server_port, record.ssh_port)
+            for record in self._snapshot.names.values()
+        ]
+
+
+_STORES = {
+    "sql": SQLInstanceStore,
+    "memory": MemoryInstanceStore,
+}
+
+
+def get_store(kind: str) -> InstanceStore:
+    store_class = _STORES.get(kind)
+    if store_class is None:
+        raise UnsupportedInstanceStore("Unknown instance store %s" % kind)
+    return store_class()
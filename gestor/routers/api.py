@@ -1,29 +1,47 @@
 import asyncio
-import json
-
-import paramiko
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
+import base64
+import binascii
+import datetime
+import logging
+import re
+from typing import AsyncIterator, Optional
+
+from fastapi import (
+    APIRouter,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+)
+from fastapi.responses import StreamingResponse
+from kubernetes_asyncio.client import ApiException
 
 from config import settings
 from gestor.manager import manager
-from gestor.models.instance import InstanceModel
 from gestor.schemas.instance import Instance
-from gestor.utils.database import Base, SessionLocal, engine
-
-Base.metadata.create_all(bind=engine)
+from gestor.utils import github, kubernetes, logs, ssh
+from gestor.utils.hub import RESYNC, Subscription, format_encoded_message
+from gestor.utils.jobs import executor
+from gestor.utils.responses import (
+    BodyCache,
+    accepts_gzip,
+    cached_response,
+    gzip_chunks,
+)
+
+MAX_PAGE_SIZE = 1000
+MAX_LOG_MATCHES = 1000
+# Seconds between the comments keeping idle event streams open
+EVENTS_KEEPALIVE = 15
+
+_logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-key = paramiko.RSAKey.from_private_key_file(settings.SSH_KEY_PATH)
-
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Bodies of the instance reads, rebuilt when the store changes
+bodies = BodyCache()
 
 
 @router.get("/")
@@ -71,79 +89,249 @@ async def instance_from_branch(
 
 
 @router.delete("/instances/{instance_name}")
-async def undeploy_instance(instance_name: str, db: Session = Depends(get_db)) -> None:
-    instance = InstanceModel.get_instance(db=db, name=instance_name)
+async def undeploy_instance(instance_name: str) -> None:
+    instance = await manager.store.get_instance(name=instance_name)
     if instance is None:
         raise HTTPException(status_code=404, detail="Instance not found")
     else:
-        await Instance.from_orm(instance).undeploy()
+        await manager.stop_instance(Instance.from_orm(instance))
 
 
-@router.get("/instances/", response_model=list[Instance])
-def read_instances(db: Session = Depends(get_db)):
-    instances = InstanceModel.get_instances(db=db)
-    return instances
+def _encode_cursor(name: str) -> str:
+    return base64.urlsafe_b64encode(name.encode()).decode()
 
 
-@router.get("/instances/{instance_name}", response_model=Instance)
-def read_instance(instance_name: str, db: Session = Depends(get_db)):
-    instance = InstanceModel.get_instance(db=db, name=instance_name)
-    if instance is None:
-        raise HTTPException(status_code=404, detail="Instance not found")
-    return instance
+def _decode_cursor(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor, altchars=b"-_", validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 
+def _parse_fields(fields: Optional[str]) -> Optional[set[str]]:
+    if fields is None:
+        return None
+    names = {field.strip() for field in fields.split(",")}
+    unknown = sorted(name for name in names if name not in Instance.__fields__)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail="Unknown fields: %s" % ", ".join(unknown)
+        )
+    return names
 
-@router.get("/instances/{instance_name}/logs", response_model=str)
-async def read_instance_logs(instance_name: str, db: Session = Depends(get_db)) -> str:
-    instance = InstanceModel.get_instance(db=db, name=instance_name)
+
+@router.get("/instances/", response_model=list[Instance])
+async def read_instances(
+    request: Request,
+    repository: Optional[str] = None,
+    branch: Optional[str] = None,
+    pull_request: Optional[int] = None,
+    is_ready: Optional[bool] = None,
+    created_after: Optional[datetime.datetime] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+) -> Response:
+    """Lists the instances ordered by name
+
+    With limit, the Link header has the URL of the next page. fields is a
+    comma separated list of the fields to return.
+    """
+    version = manager.store.version
+    key = ("instances", tuple(sorted(request.query_params.multi_items())))
+    cached = bodies.get(version, key)
+    if cached is None:
+        after = _decode_cursor(cursor) if cursor is not None else None
+        include = _parse_fields(fields)
+        instances = await manager.store.get_instances(
+            repository=repository,
+            branch=branch,
+            pull_request=pull_request,
+            is_ready=is_ready,
+            created_after=created_after,
+            after=after,
+            limit=limit + 1 if limit else None,
+        )
+        headers = None
+        if limit and len(instances) > limit:
+            instances = instances[:limit]
+            next_url = request.url.include_query_params(
+                cursor=_encode_cursor(instances[-1].name)
+            )
+            headers = {"Link": '<%s>; rel="next"' % next_url}
+        data = [
+            Instance.from_orm(instance).dict(include=include) for instance in instances
+        ]
+        cached = bodies.store(version, key, data, headers)
+    return cached_response(request, cached)
+
+
+async def _snapshot() -> bytes:
+    """Returns the body of the unfiltered instances list"""
+    version = manager.store.version
+    key = ("instances", ())
+    cached = bodies.get(version, key)
+    if cached is None:
+        instances = await manager.store.get_instances()
+        data = [Instance.from_orm(instance).dict() for instance in instances]
+        cached = bodies.store(version, key, data)
+    return cached.body
+
+
+async def _stream_events(subscription: Subscription) -> AsyncIterator[bytes]:
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    subscription.get(), timeout=EVENTS_KEEPALIVE
+                )
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if message == RESYNC:
+                # Later changes are already queued after this id
+                event_id = manager.feed.last_event_id
+                message = format_encoded_message(
+                    event_id, "snapshot", await _snapshot()
+                )
+            yield message
+    finally:
+        manager.feed.unsubscribe(subscription)
+
+
+@router.get("/instances/events")
+async def instance_events(
+    last_event_id: Optional[str] = Header(None),
+) -> StreamingResponse:
+    """Streams the instance changes as Server-Sent Events
+
+    The stream starts with a snapshot event holding every instance, followed
+    by added, modified, ready and deleted events. Reconnecting with the
+    Last-Event-ID header resumes the stream when possible, and a new snapshot
+    is sent whenever the client falls too far behind.
+    """
+    subscription = manager.feed.subscribe(last_event_id)
+    return StreamingResponse(
+        _stream_events(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/instances/{instance_name}", response_model=Instance)
+async def read_instance(instance_name: str, request: Request) -> Response:
+    version = manager.store.version
+    cached = bodies.get(version, ("instance", instance_name))
+    if cached is None:
+        instance = await manager.store.get_instance(name=instance_name)
+        if instance is None:
+            raise HTTPException(status_code=404, detail="Instance not found")
+        cached = bodies.store(
+            version, ("instance", instance_name), Instance.from_orm(instance)
+        )
+    return cached_response(request, cached)
+
+
+@router.get("/instances/{instance_name}/logs", response_class=StreamingResponse)
+async def read_instance_logs(
+    request: Request,
+    instance_name: str,
+    tail: Optional[int] = Query(default=None, ge=0),
+    since: Optional[int] = Query(default=None, ge=1),
+    limit_bytes: Optional[int] = Query(default=None, ge=1),
+    follow: bool = False,
+) -> StreamingResponse:
+    """Streams the log of the instance as plain text
+
+    tail is a number of lines, since a number of seconds and limit_bytes
+    truncates the log. follow keeps the response open, sending the new lines
+    as they are written, 503 is returned when LOG_FOLLOW_MAX_STREAMS logs are
+    followed already. Other responses are gzipped if the client accepts it.
+    """
+    instance = await manager.store.get_instance(name=instance_name)
     if instance is None:
         raise HTTPException(status_code=404, detail="Instance not found")
-    return await Instance.from_orm(instance).logs()
+    try:
+        chunks = await Instance.from_orm(instance).logs(
+            tail=tail, since=since, limit_bytes=limit_bytes, follow=follow
+        )
+    except kubernetes.PodNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except kubernetes.TooManyStreams as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ApiException as e:
+        _logger.error("Failed to get instance logs:%s", str(e))
+        raise HTTPException(status_code=502, detail="Failed to get logs")
+    headers = {"Cache-Control": "no-cache"}
+    if not follow:
+        headers["Vary"] = "Accept-Encoding"
+        if accepts_gzip(request):
+            chunks = gzip_chunks(chunks)
+            headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type="text/plain", headers=headers)
+
+
+@router.get("/instances/{instance_name}/logs/search")
+async def search_instance_logs(
+    instance_name: str,
+    pattern: Optional[str] = None,
+    ignore_case: bool = False,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    container: Optional[str] = None,
+    limit: int = Query(default=100, ge=1, le=MAX_LOG_MATCHES),
+) -> list[dict]:
+    """Searches the buffered log lines of the instance
+
+    Returns the latest limit lines matching the regular expression, the time
+    range and the container, oldest first.
+    """
+    if not manager.logs.is_watched(instance_name):
+        raise HTTPException(
+            status_code=404, detail="Instance logs are not being collected"
+        )
+    compiled = None
+    if pattern:
+        try:
+            compiled = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        except re.error as e:
+            raise HTTPException(status_code=400, detail="Invalid pattern:%s" % e)
+    # Searched on a copy off the event loop, as patterns can be slow
+    matches = await asyncio.to_thread(
+        logs.search,
+        manager.logs.lines(instance_name),
+        compiled,
+        since,
+        until,
+        container,
+        limit,
+    )
+    return [line._asdict() for line in matches]
 
 
 @router.websocket("/instances/{instance_name}/ssh")
-async def ssh_connection(
-    websocket: WebSocket, instance_name: str, db: Session = Depends(get_db)
-):
-    instance = InstanceModel.get_instance(db=db, name=instance_name)
+async def ssh_connection(websocket: WebSocket, instance_name: str, text: bool = False):
+    instance = await manager.store.get_instance(name=instance_name)
     if instance is None:
         return
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        hostname=settings.SSH_IP,
-        username=settings.SSH_USER,
-        pkey=key,
-        port=instance.ssh_port,
-        timeout=2,
-    )
-    chan = ssh.invoke_shell(term="xterm")
-    await websocket.accept()
-
-    async def read_chan():
-        while not chan.exit_status_ready():
-            if chan.recv_ready():
-                data = chan.recv(1024).decode("utf-8")
-                await websocket.send_text(data)
-            await asyncio.sleep(0.05)
-
-    read_task = asyncio.create_task(read_chan())
-
-    while True:
-        try:
-            message = await asyncio.wait_for(websocket.receive_text(), timeout=0.05)
-            if '"type":"resize"' in message:
-                sizes = json.loads(message)
-                chan.resize_pty(width=int(sizes["cols"]), height=int(sizes["rows"]))
-            else:
-                chan.send(message.encode("utf-8"))
-        except WebSocketDisconnect:
-            ssh.close()
-            read_task.cancel()
-            break
-        except Exception:
-            continue
+    address = ssh.instance_address(instance.name, instance.ssh_port)
+    await ssh.bridge(websocket, address, text)
+
+
+@router.get("/stats/")
+async def read_stats() -> dict[str, dict]:
+    return {
+        "jobs": executor.stats(),
+        "kubernetes": kubernetes.client_stats(),
+        "kubernetes_logs": kubernetes.client_stats(kubernetes.LOGS_POOL),
+        "kubernetes_follow": kubernetes.client_stats(kubernetes.FOLLOW_POOL),
+        "events": manager.events.stats(),
+        "github": github.stats(),
+        "responses": bodies.stats(),
+        "feed": manager.feed.stats(),
+        "logs": manager.logs.stats(),
+        "ssh": ssh.stats(),
+    }
 
 
 @router.get("/allowed-repositories/")
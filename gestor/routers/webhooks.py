@@ -1,8 +1,12 @@
+import asyncio
 import hashlib
 import hmac
+import json
 import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
 
-from fastapi import APIRouter, Request, Header, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Request, Header
 
 from config import settings
 from gestor.manager import manager
@@ -13,6 +17,75 @@ router = APIRouter()
 _logger = logging.getLogger(__name__)
 
 
+class DeliveryLog:
+    """Remembers the most recent webhook delivery identifiers"""
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._deliveries: OrderedDict[str, None] = OrderedDict()
+
+    def seen(self, delivery: str) -> bool:
+        return delivery in self._deliveries
+
+    def record(self, delivery: str) -> None:
+        """Records a handled delivery, forgetting the oldest past maxsize"""
+        self._deliveries[delivery] = None
+        if len(self._deliveries) > self._maxsize:
+            self._deliveries.popitem(last=False)
+
+
+class Debouncer:
+    """Runs only the last call scheduled for a key within a time window
+
+    A call is delayed while others follow within delay seconds, but never
+    more than max_wait seconds after the first one, so a steady stream of
+    calls still runs.
+    """
+
+    def __init__(self, delay: float, max_wait: float):
+        self._delay = delay
+        self._max_wait = max_wait
+        self._timers: dict[Hashable, asyncio.TimerHandle] = {}
+        self._first: dict[Hashable, float] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.debounced = 0
+
+    def schedule(self, key: Hashable, func: Callable[..., Awaitable], *args) -> None:
+        loop = asyncio.get_running_loop()
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+            self.debounced += 1
+        first = self._first.setdefault(key, loop.time())
+        delay = min(self._delay, first + self._max_wait - loop.time())
+        self._timers[key] = loop.call_later(max(0, delay), self._run, key, func, args)
+
+    def _run(self, key: Hashable, func: Callable[..., Awaitable], args: tuple):
+        del self._timers[key]
+        del self._first[key]
+        task = asyncio.create_task(func(*args))
+        # Keep a reference until the task finishes
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self) -> None:
+        """Drops the pending calls and cancels the running ones"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._first.clear()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+deliveries = DeliveryLog(1024)
+debouncer = Debouncer(
+    settings.WEBHOOKS_DEBOUNCE_SECONDS, settings.WEBHOOKS_DEBOUNCE_MAX_WAIT
+)
+
+
 def _verify_signature(payload_body: bytes, secret_token: str, signature_header: str):
     if not signature_header:
         _logger.warning("x-hub-signature-256 header is missing")
@@ -34,36 +107,51 @@ async def root():
 
 @router.post("/github")
 async def github_webhook(
-    background_tasks: BackgroundTasks,
     request: Request,
     x_github_event: str = Header(...),
     x_hub_signature_256: str | None = Header(None),
+    x_github_delivery: str | None = Header(None),
 ):
     if x_github_event != "pull_request":
         return
 
-    # Process payload
-    payload = await request.json()
-    _logger.debug("Received %s pull_request webhook", payload["action"])
-
-    # Check GitHub signature
+    # Check GitHub signature before parsing the payload
     body = await request.body()
     if not _verify_signature(body, settings.WEBHOOKS_SECRET, x_hub_signature_256):
         return
 
-    # Get GitInfo from payload
-    git_info = GitInfo(
-        repository=payload["pull_request"]["head"]["repo"]["full_name"],
-        pull_request=payload["pull_request"]["number"],
-        commit=payload["pull_request"]["head"]["sha"],
-        branch=payload["pull_request"]["head"]["ref"],
-    )
+    # GitHub may deliver the same event more than once
+    if x_github_delivery and deliveries.seen(x_github_delivery):
+        _logger.debug("Ignoring duplicated delivery %s", x_github_delivery)
+        return
 
-    if payload["action"] in [
+    # Process payload
+    try:
+        payload = json.loads(body)
+        action = payload["action"]
+        pull_request = payload["pull_request"]
+        git_info = GitInfo(
+            repository=pull_request["head"]["repo"]["full_name"],
+            pull_request=pull_request["number"],
+            commit=pull_request["head"]["sha"],
+            branch=pull_request["head"]["ref"],
+        )
+    except (ValueError, KeyError, TypeError) as e:
+        _logger.warning("Invalid pull_request webhook payload:%s", str(e))
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    _logger.debug("Received %s pull_request webhook", action)
+
+    # Only the last action on a branch within the debounce window is run
+    key = (git_info.repository, git_info.branch)
+    if action in [
         "opened",
         "reopened",
         "synchronize",
     ]:  # new pull request or new commits pushed
-        background_tasks.add_task(manager.start_instance_from_webhook, git_info)
-    elif payload["action"] == "closed":  # pull request closed
-        background_tasks.add_task(manager.stop_instance_from_webhook, git_info)
+        debouncer.schedule(key, manager.start_instance_from_webhook, git_info)
+    elif action == "closed":  # pull request closed
+        debouncer.schedule(key, manager.stop_instance_from_webhook, git_info)
+
+    # Recorded once handled, so a failed delivery can be delivered again
+    if x_github_delivery:
+        deliveries.record(x_github_delivery)
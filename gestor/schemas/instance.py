@@ -1,27 +1,44 @@
 import datetime
 import logging
 import random
+from typing import AsyncIterator, Optional
 
 import shortuuid
 from kubernetes.client import V1Deployment
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, validator
 
 from config import settings
 from gestor.schemas.git import GitInfo
 from gestor.utils import kubernetes
+from gestor.utils.jobs import executor
 
 _logger = logging.getLogger(__name__)
 
+ERP_SERVER_PORT = 8069
+
 
 def instance_name():
     return "g" + shortuuid.uuid()[0:11].lower()
 
 
 def server_port():
+    if settings.EXPOSE_MODE == "ingress":
+        # Reached through the Ingress, no NodePort is taken
+        return ERP_SERVER_PORT
     return random.randint(30000, 32767)
 
 
+def instance_url(name: str) -> Optional[str]:
+    """Returns the public URL of an instance, if it has one"""
+    if settings.EXPOSE_MODE == "ingress":
+        return "https://%s.%s" % (name, settings.DEPLOY_DOMAIN)
+    return None
+
+
 def ssh_port():
+    if settings.SSH_MODE == "gateway":
+        # Reached through the gateway, no NodePort is taken
+        return settings.SSH_GATEWAY_PORT
     return random.randint(30000, 32767)
 
 
@@ -32,10 +49,15 @@ class Instance(BaseModel):
     ssh_port: int = Field(default_factory=ssh_port)
     is_ready = False
     created_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+    url: Optional[str] = None
 
     class Config:
         orm_mode = True
 
+    @validator("url", always=True)
+    def _url(cls, value, values):
+        return instance_url(values["name"]) if "name" in values else None
+
     @classmethod
     def from_orm(cls, instance: any):
         return cls(
@@ -52,7 +74,7 @@ class Instance(BaseModel):
             ),
         )
 
-    async def deploy(self, target_module: str = None) -> None:
+    async def deploy(self, target_module: str = None) -> bool:
         _logger.info("Starting instance (%s)", str(self.dict()))
         data = {
             "name": self.name,
@@ -60,29 +82,46 @@ class Instance(BaseModel):
             "ssh_port": self.ssh_port,
             "created_at": self.created_at,
             "domain": settings.DEPLOY_DOMAIN,
+            "expose_mode": settings.EXPOSE_MODE,
+            "ssh_mode": settings.SSH_MODE,
             "labels": {},
             **self.git_info.dict(),
         }
         if target_module:
             data["target_module"] = target_module
         try:
-            await kubernetes.start_deployment(self.name, data)
+            await executor.run(self.name, kubernetes.start_deployment, self.name, data)
         except Exception as e:
             _logger.error("Failed to start the instance:%s", str(e))
+            return False
+        return True
 
-    async def undeploy(self) -> None:
+    async def undeploy(self) -> bool:
         _logger.info("Removing instance (%s)", str(self.dict()))
+        # A pending deploy of this instance is superseded by its removal
+        executor.cancel(self.name)
         try:
-            await kubernetes.remove_deployment(self.name)
+            await executor.run(self.name, kubernetes.remove_deployment, self.name)
         except Exception as e:
             _logger.error("Failed to remove the instance:%s", str(e))
-
-    async def logs(self) -> str:
-        try:
-            return await kubernetes.pod_logs(self.name)
-        except Exception as e:
-            _logger.error("Failed to get instance logs:%s", str(e))
-            return "Failed to get logs"
+            return False
+        return True
+
+    async def logs(
+        self,
+        tail: int = None,
+        since: int = None,
+        limit_bytes: int = None,
+        follow: bool = False,
+    ) -> AsyncIterator[bytes]:
+        """Returns the log chunks of the instance, see kubernetes.pod_logs"""
+        return await kubernetes.pod_logs(
+            self.name,
+            tail_lines=tail,
+            since_seconds=since,
+            limit_bytes=limit_bytes,
+            follow=follow,
+        )
 
     @staticmethod
     async def deployment_to_dict(deployment: V1Deployment):
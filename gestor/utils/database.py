@@ -1,17 +1,43 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import DeclarativeBase, sessionmaker
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.pool import StaticPool
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
 
-engine = create_engine(
+engine = create_async_engine(
     SQLALCHEMY_DATABASE_URL,
     echo=False,
     connect_args={"check_same_thread": False},
     poolclass=StaticPool,
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(
+    engine, autoflush=False, expire_on_commit=False, class_=AsyncSession
+)
+
+# The in-memory database lives in a single connection, so sessions take
+# turns instead of interleaving their transactions on it
+_session_lock = asyncio.Lock()
 
 
 class Base(DeclarativeBase):
     pass
+
+
+@asynccontextmanager
+async def get_session() -> AsyncIterator[AsyncSession]:
+    """Opens a short-lived session, to be used by a single task"""
+    async with _session_lock:
+        async with SessionLocal() as session:
+            yield session
+
+
+async def create_tables(drop: bool = False) -> None:
+    async with _session_lock:
+        async with engine.begin() as connection:
+            if drop:
+                await connection.run_sync(Base.metadata.drop_all)
+            await connection.run_sync(Base.metadata.create_all)
@@ -0,0 +1,79 @@
+import asyncio
+from collections import OrderedDict
+
+SYNC = "SYNC"
+
+
+def _merge(previous: dict, event: dict) -> dict:
+    """Merges two events of the same object into the one to be processed"""
+    if previous["type"] == "ADDED" and event["type"] == "MODIFIED":
+        # The consumer still has to see the object being created
+        return {**event, "type": "ADDED"}
+    return event
+
+
+class EventBuffer:
+    """Kubernetes events queue keeping only the latest event of each object
+
+    Buffered events are keyed by object name: a new event for an object
+    already waiting replaces it in place, so bursts of changes are processed
+    once per object. A SYNC event carries the whole state and drops every
+    event buffered before it. put() waits while maxsize objects are
+    waiting, except for events that can be merged.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._events: OrderedDict[str, dict] = OrderedDict()
+        self._changed = asyncio.Condition()
+        self.coalesced = 0
+        self.dropped = 0
+
+    async def put(self, event: dict) -> None:
+        async with self._changed:
+            if event["type"] == SYNC:
+                self.dropped += len(self._events)
+                self._events.clear()
+                key = SYNC
+            else:
+                key = event["object"].metadata.name
+                if key not in self._events:
+                    await self._changed.wait_for(
+                        lambda: len(self._events) < self._maxsize
+                    )
+            previous = self._events.get(key)
+            if previous is None:
+                self._events[key] = event
+            else:
+                self.coalesced += 1
+                self._events[key] = _merge(previous, event)
+            self._changed.notify_all()
+
+    async def get(self) -> dict:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._events)
+            _, event = self._events.popitem(last=False)
+            self._changed.notify_all()
+            return event
+
+    async def get_batch(self, size: int) -> list[dict]:
+        """Waits for an event and returns it with up to size - 1 more"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._events)
+            batch = [
+                self._events.popitem(last=False)[1]
+                for _ in range(min(size, len(self._events)))
+            ]
+            self._changed.notify_all()
+            return batch
+
+    def qsize(self) -> int:
+        return len(self._events)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._events),
+            "maxsize": self._maxsize,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
@@ -1,19 +1,24 @@
+import asyncio
 import logging
-from enum import Enum
-from typing import Any
+import random
+import re
+import time
+from collections import OrderedDict
+from enum import Enum, IntEnum
+from typing import Any, Mapping, NamedTuple, Optional
 
 import aiohttp
-from github import Github
 
 from config import settings
 from gestor.schemas.git import GitInfo
 
 _logger = logging.getLogger(__name__)
 
-# Do not show PyGitHub debug messages, too much verbose
-logging.getLogger("github").setLevel(logging.INFO)
+GITHUB_API_URL = "https://api.github.com"
 
-g = Github(login_or_token=settings.GITHUB_TOKEN)
+SHA_PATTERN = re.compile("[0-9a-f]{40}")
+
+STATUS_CONTEXT = "instance-manager"
 
 
 class GitHubStatusState(str, Enum):
@@ -27,15 +32,229 @@ class InvalidGitHubUrl(Exception):
     pass
 
 
-async def _github_request(path: str) -> Any:
-    url = f"https://api.github.com{path}"
+class RateLimitExceeded(InvalidGitHubUrl):
+    pass
+
+
+class Priority(IntEnum):
+    low = 0
+    high = 1
+
+
+class GitHubResponse(NamedTuple):
+    status: int
+    headers: Mapping[str, str]
+    data: Any
+
+
+class GitHubClient:
+    """Authenticated GitHub API client sharing one connection pool
+
+    It keeps track of the rate limit headers: low priority calls wait for
+    the next window (or are shed if it is too far away) once the remaining
+    budget reaches the reserve kept for high priority calls, and responses
+    to secondary rate limits are retried with exponential backoff.
+    """
+
+    def __init__(self, token: str):
+        self._token = token
+        self._session: aiohttp.ClientSession | None = None
+        self._limit: int | None = None
+        self._remaining: int | None = None
+        self._reset = 0.0
+        self._requests = 0
+        self._retries = 0
+        self._shed = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            headers = {
+                "Accept": "application/vnd.github+json",
+                "X-GitHub-Api-Version": "2022-11-28",
+            }
+            if self._token:
+                headers["Authorization"] = "Bearer " + self._token
+            self._session = aiohttp.ClientSession(
+                GITHUB_API_URL,
+                headers=headers,
+                connector=aiohttp.TCPConnector(
+                    limit=settings.GITHUB_CONNECTION_POOL_SIZE
+                ),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _update_budget(self, headers: Mapping[str, str]) -> None:
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        self._limit = int(headers.get("X-RateLimit-Limit", 0))
+        self._remaining = int(headers["X-RateLimit-Remaining"])
+        self._reset = float(headers.get("X-RateLimit-Reset", 0))
+
+    async def _wait_for_budget(self, priority: Priority) -> None:
+        if self._remaining is None:
+            return
+        wait = self._reset - time.time()
+        if wait <= 0:  # A new rate limit window has started
+            self._remaining = None
+            return
+        reserve = settings.GITHUB_RATE_LIMIT_RESERVE if priority < Priority.high else 0
+        if self._remaining > reserve:
+            self._remaining -= 1
+            return
+        if wait > settings.GITHUB_RATE_LIMIT_MAX_WAIT:
+            self._shed += 1
+            raise RateLimitExceeded(
+                "GitHub rate limit budget exhausted for %d seconds" % wait
+            )
+        _logger.warning("GitHub rate limit budget exhausted, waiting %ds", wait)
+        await asyncio.sleep(wait)
+
+    @staticmethod
+    def _retry_delay(response: aiohttp.ClientResponse, attempt: int) -> float | None:
+        """Returns how long to wait before retrying a secondary rate limit"""
+        if response.status not in (403, 429):
+            return None
+        if "Retry-After" in response.headers:
+            return float(response.headers["Retry-After"])
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if response.status == 403 and remaining in (None, "0"):
+            # Not a rate limit or the primary one, retrying will not help
+            return None
+        return 2**attempt + random.random()
+
+    async def request(
+        self, method: str, path: str, priority: Priority = Priority.high, **kwargs
+    ) -> GitHubResponse:
+        for attempt in range(settings.GITHUB_MAX_RETRIES + 1):
+            await self._wait_for_budget(priority)
+            self._requests += 1
+            async with self._get_session().request(method, path, **kwargs) as response:
+                self._update_budget(response.headers)
+                delay = self._retry_delay(response, attempt)
+                if delay is None or attempt == settings.GITHUB_MAX_RETRIES:
+                    try:
+                        data = await response.json(content_type=None)
+                    except ValueError:  # Empty or not JSON body
+                        data = None
+                    return GitHubResponse(response.status, response.headers, data)
+            _logger.warning("GitHub secondary rate limit, retrying in %.1fs", delay)
+            self._retries += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self._limit,
+            "remaining": self._remaining,
+            "reset": self._reset,
+            "requests": self._requests,
+            "retries": self._retries,
+            "shed": self._shed,
+        }
+
+
+class CacheEntry(NamedTuple):
+    etag: str | None
+    data: Any
+    expires: float
+
+
+class ResponseCache:
+    """LRU cache of GitHub responses revalidated through their ETag
+
+    Fresh entries are returned without any request, stale ones are sent
+    with If-None-Match and a 304 response (which does not count against the
+    rate limit) makes them fresh again.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._commits: OrderedDict[str, None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.commit_hits = 0
+
+    def get(self, path: str) -> CacheEntry | None:
+        entry = self._entries.get(path)
+        if entry is not None:
+            self._entries.move_to_end(path)
+        return entry
+
+    def store(self, path: str, etag: str | None, data: Any) -> None:
+        self._entries[path] = CacheEntry(etag, data, time.monotonic() + self._ttl)
+        self._entries.move_to_end(path)
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, path: str) -> None:
+        self._entries.pop(path, None)
+
+    def has_commit(self, repository: str, commit: str) -> bool:
+        key = f"{repository}@{commit}"
+        if key in self._commits:
+            self._commits.move_to_end(key)
+            self.commit_hits += 1
+            return True
+        return False
+
+    def add_commit(self, repository: str, commit: str) -> None:
+        """Remembers an existing commit SHA, which can never change"""
+        if not SHA_PATTERN.fullmatch(commit):
+            return
+        self._commits[f"{repository}@{commit}"] = None
+        if len(self._commits) > self._maxsize:
+            self._commits.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._commits.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "commits": len(self._commits),
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "commit_hits": self.commit_hits,
+        }
+
+
+client = GitHubClient(settings.GITHUB_TOKEN)
+cache = ResponseCache(settings.GITHUB_CACHE_SIZE, settings.GITHUB_CACHE_TTL)
+
+
+async def _github_request(path: str, priority: Priority = Priority.high) -> Any:
+    url = f"{GITHUB_API_URL}{path}"
+
+    entry = cache.get(path)
+    if entry is not None and entry.expires > time.monotonic():
+        cache.hits += 1
+        return entry.data
 
     _logger.debug("Fetching GitHub API (%s)", url)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                raise InvalidGitHubUrl("GitHub URL not found (%s)" % url)
-            return await response.json()
+    headers = {}
+    if entry is not None and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    response = await client.request("GET", path, priority=priority, headers=headers)
+    if response.status == 304 and entry is not None:
+        cache.revalidated += 1
+        cache.store(path, entry.etag, entry.data)
+        return entry.data
+
+    cache.misses += 1
+    if response.status != 200:
+        cache.discard(path)
+        raise InvalidGitHubUrl("GitHub URL not found (%s)" % url)
+    cache.store(path, response.headers.get("ETag"), response.data)
+    return response.data
 
 
 async def get_pull_request_info(repository: str, pull_request: int):
@@ -83,15 +302,23 @@ async def commit_exists(repository: str, commit: str):
         repository,
         commit,
     )
+    if cache.has_commit(repository, commit):
+        return
     path = f"/repos/{repository}/commits/{commit}"
     try:
         await _github_request(path)
     except InvalidGitHubUrl as e:
         raise e
+    cache.add_commit(repository, commit)
 
 
 async def set_commit_status(
-    name: str, repository: str, commit: str, description: str, state: GitHubStatusState
+    name: str,
+    repository: str,
+    commit: str,
+    description: str,
+    state: GitHubStatusState,
+    target_url: str = None,
 ):
     _logger.debug(
         "Setting commit %s status (%s)",
@@ -99,13 +326,96 @@ async def set_commit_status(
         repository,
     )
     try:
-        repo = g.get_repo(repository)
-        commit = repo.get_commit(commit)
-        commit.create_status(
-            state=state,
-            target_url="https://" + settings.DEPLOY_DOMAIN + "?name=" + name,
-            description=description,
-            context="instance-manager",
+        response = await client.request(
+            "POST",
+            f"/repos/{repository}/statuses/{commit}",
+            priority=Priority.low,
+            json={
+                "state": state,
+                "target_url": target_url
+                or "https://" + settings.DEPLOY_DOMAIN + "?name=" + name,
+                "description": description,
+                "context": STATUS_CONTEXT,
+            },
         )
+        if response.status != 201:
+            raise InvalidGitHubUrl("Unexpected response status %d" % response.status)
     except Exception:
         _logger.error("Failed to set commit %s status (%s)", commit, repository)
+
+
+class CommitStatus(NamedTuple):
+    name: str
+    repository: str
+    commit: str
+    description: str
+    state: GitHubStatusState
+    # The instance itself when it has a public URL, the manager otherwise
+    target_url: Optional[str] = None
+
+
+class StatusPublisher:
+    """Posts commit statuses in the background
+
+    Only the latest pending status of a commit is posted, and statuses of
+    the same commit are never posted concurrently so they keep their order.
+    """
+
+    def __init__(self, workers: int):
+        self._workers = workers
+        self._queue: asyncio.Queue[tuple[str, str]] = asyncio.Queue()
+        self._pending: dict[tuple[str, str], CommitStatus] = {}
+        self._in_flight: set[tuple[str, str]] = set()
+        self._deferred: set[tuple[str, str]] = set()
+        self._published = 0
+        self._coalesced = 0
+
+    def publish(self, status: CommitStatus) -> None:
+        key = (status.repository, status.commit)
+        if key in self._pending:
+            self._coalesced += 1
+        else:
+            self._queue.put_nowait(key)
+        self._pending[key] = status
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._queue.get()
+            if key in self._in_flight:
+                # Posted again when the running request finishes
+                self._deferred.add(key)
+                continue
+            status = self._pending.pop(key, None)
+            if status is None:
+                continue
+            self._in_flight.add(key)
+            try:
+                await set_commit_status(*status)
+                self._published += 1
+            finally:
+                self._in_flight.discard(key)
+                if key in self._deferred:
+                    self._deferred.discard(key)
+                    self._queue.put_nowait(key)
+
+    def start(self) -> list[asyncio.Task]:
+        return [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+            "published": self._published,
+            "coalesced": self._coalesced,
+        }
+
+
+publisher = StatusPublisher(settings.GITHUB_STATUS_WORKERS)
+
+
+def stats() -> dict:
+    return {
+        **client.stats(),
+        "cache": cache.stats(),
+        "statuses": publisher.stats(),
+    }
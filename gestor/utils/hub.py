@@ -0,0 +1,143 @@
+import asyncio
+import json
+import uuid
+from collections import deque
+from typing import Any, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+# Returned by Subscription.get when the subscriber has to reload the state
+RESYNC = b""
+
+
+def format_message(event_id: str, event_type: str, data: Any) -> bytes:
+    """Formats a Server-Sent Events message"""
+    encoded = json.dumps(jsonable_encoder(data), separators=(",", ":"))
+    return format_encoded_message(event_id, event_type, encoded.encode("utf-8"))
+
+
+def format_encoded_message(event_id: str, event_type: str, data: bytes) -> bytes:
+    """Formats a Server-Sent Events message with single line JSON data"""
+    return b"id: %s\nevent: %s\ndata: %s\n\n" % (
+        event_id.encode(),
+        event_type.encode(),
+        data,
+    )
+
+
+class Subscription:
+    """Bounded buffer of the messages waiting to be sent to a subscriber
+
+    Instead of blocking the publisher, a subscriber falling more than maxsize
+    messages behind loses them all and gets RESYNC to reload the state.
+    """
+
+    def __init__(self, maxsize: int, resync: bool = False):
+        self._maxsize = maxsize
+        self._messages: deque[bytes] = deque()
+        self._resync = resync
+        self._ready = asyncio.Event()
+        if resync:
+            self._ready.set()
+        self.dropped = 0
+
+    def put(self, message: bytes) -> None:
+        if self._resync:
+            return
+        if len(self._messages) >= self._maxsize:
+            self.resync()
+            return
+        self._messages.append(message)
+        self._ready.set()
+
+    def resync(self) -> None:
+        self.dropped += len(self._messages)
+        self._messages.clear()
+        self._resync = True
+        self._ready.set()
+
+    async def get(self) -> bytes:
+        await self._ready.wait()
+        if self._resync:
+            self._resync = False
+            message = RESYNC
+        else:
+            message = self._messages.popleft()
+        if not self._messages and not self._resync:
+            self._ready.clear()
+        return message
+
+
+class EventHub:
+    """Fans out instance changes to any number of subscribers
+
+    Messages are formatted once and numbered. The last history_size are
+    kept, so a subscriber reconnecting with the id of the last message it got
+    is sent the ones it missed, or RESYNC if they are no longer available.
+    Ids are prefixed with an epoch, so ids from a previous process are never
+    taken for current ones.
+    """
+
+    def __init__(self, buffer_size: int, history_size: int):
+        self._buffer_size = buffer_size
+        self._epoch = uuid.uuid4().hex[:8]
+        self._history: deque[tuple[int, bytes]] = deque(maxlen=history_size)
+        self._subscribers: set[Subscription] = set()
+        self.sequence = 0
+        self.published = 0
+
+    @property
+    def last_event_id(self) -> str:
+        return "%s-%d" % (self._epoch, self.sequence)
+
+    def _parse_event_id(self, event_id: Optional[str]) -> Optional[int]:
+        if not event_id:
+            return None
+        epoch, _, sequence = event_id.partition("-")
+        if epoch != self._epoch or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def publish(self, event_type: str, data: Any) -> None:
+        self.sequence += 1
+        message = format_message(self.last_event_id, event_type, data)
+        self._history.append((self.sequence, message))
+        self.published += 1
+        for subscription in self._subscribers:
+            subscription.put(message)
+
+    def resync(self) -> None:
+        """Makes every subscriber reload the state, after it was replaced"""
+        self.sequence += 1
+        self._history.clear()
+        for subscription in self._subscribers:
+            subscription.resync()
+
+    def subscribe(self, last_event_id: str = None) -> Subscription:
+        """Subscribes to the messages after last_event_id
+
+        Without last_event_id, or when it can not be resumed, the first
+        message is RESYNC.
+        """
+        sequence = self._parse_event_id(last_event_id)
+        oldest = self._history[0][0] if self._history else self.sequence + 1
+        resumable = sequence is not None and oldest - 1 <= sequence <= self.sequence
+        subscription = Subscription(self._buffer_size, resync=not resumable)
+        if resumable:
+            for number, message in self._history:
+                if number > sequence:
+                    subscription.put(message)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscribers.discard(subscription)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "subscribers": len(self._subscribers),
+            "sequence": self.sequence,
+            "published": self.published,
+            "history": len(self._history),
+            "dropped": sum(s.dropped for s in self._subscribers),
+        }
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from config import settings
+
+_logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobExecutor:
+    """Runs deploy and undeploy jobs with a bounded number of concurrent workers"""
+
+    def __init__(self, max_workers: int):
+        self._max_workers = max_workers
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._jobs: dict[str, set[asyncio.Task]] = {}
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+
+    async def _execute(self, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        self._queued += 1
+        try:
+            await self._semaphore.acquire()
+        except asyncio.CancelledError:
+            self._cancelled += 1
+            raise
+        finally:
+            self._queued -= 1
+
+        self._running += 1
+        try:
+            result = await func(*args)
+        except asyncio.CancelledError:
+            self._cancelled += 1
+            raise
+        except Exception:
+            self._failed += 1
+            raise
+        finally:
+            self._running -= 1
+            self._semaphore.release()
+        self._completed += 1
+        return result
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        tasks = self._jobs.get(key)
+        if tasks is None:
+            return
+        tasks.discard(task)
+        if not tasks:
+            del self._jobs[key]
+
+    async def run(self, key: str, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Runs a job once a worker is available and waits for its result"""
+        task = asyncio.create_task(self._execute(func, *args))
+        self._jobs.setdefault(key, set()).add(task)
+        task.add_done_callback(lambda t: self._forget(key, t))
+        _logger.debug("Job %s submitted (%s)", key, str(self.stats()))
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            raise JobCancelled("Job %s was cancelled" % key)
+
+    def cancel(self, key: str) -> int:
+        """Cancels the queued or running jobs of a key"""
+        tasks = self._jobs.get(key, set())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            _logger.debug("Cancelled %d job(s) of %s", len(tasks), key)
+        return len(tasks)
+
+    def cancel_all(self) -> int:
+        return sum(self.cancel(key) for key in list(self._jobs))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "max_workers": self._max_workers,
+            "queued": self._queued,
+            "running": self._running,
+            "completed": self._completed,
+            "failed": self._failed,
+            "cancelled": self._cancelled,
+        }
+
+
+executor = JobExecutor(settings.DEPLOY_MAX_WORKERS)
@@ -1,16 +1,18 @@
 import asyncio
+import json
 import logging
-import os
-import shutil
-import subprocess
-from typing import cast
+import random
+from typing import AsyncIterator
 
+import aiohttp
 from kubernetes.client import V1Deployment, V1Pod
 from kubernetes_asyncio import config, watch, client
+from kubernetes_asyncio.client import ApiException
 from kubernetes_asyncio.client.api_client import ApiClient
-from mako.template import Template
+from kubernetes_asyncio.client.rest import RESTResponse
 
 from config import settings
+from gestor.utils import manifests
 
 _logger = logging.getLogger(__name__)
 
@@ -18,64 +20,140 @@ _logger = logging.getLogger(__name__)
 logging.getLogger("kubernetes_asyncio.client.rest").setLevel(logging.INFO)
 
 
-class TemporaryDirectoryNotFound(Exception):
+# Seconds to wait before watching again after consecutive failures
+WATCH_BACKOFF_BASE = 1
+WATCH_BACKOFF_MAX = 60
+
+# Followed logs have no total timeout, only one between two reads so a dead
+# connection is eventually noticed
+FOLLOW_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=3600)
+
+# Name of the owner of the fields set through server-side apply
+FIELD_MANAGER = "gestor"
+
+# API group and method used to apply and delete each kind of rendered object
+_RESOURCES = {
+    "ConfigMap": (
+        client.CoreV1Api,
+        "patch_namespaced_config_map",
+        "delete_collection_namespaced_config_map",
+    ),
+    "Service": (
+        client.CoreV1Api,
+        "patch_namespaced_service",
+        "delete_collection_namespaced_service",
+    ),
+    "Ingress": (
+        client.NetworkingV1Api,
+        "patch_namespaced_ingress",
+        "delete_collection_namespaced_ingress",
+    ),
+    "Deployment": (
+        client.AppsV1Api,
+        "patch_namespaced_deployment",
+        "delete_collection_namespaced_deployment",
+    ),
+}
+
+
+class UnsupportedResource(Exception):
     pass
 
 
-class TemplateRenderFailed(Exception):
+class PodNotFound(Exception):
     pass
 
 
-async def _kubectl(args: list[str]) -> int:
-    """Executes a kubectl command"""
-    _logger.debug("kubectl %s", " ".join(args))
-    result = subprocess.run(["kubectl", *args])
-    return result.returncode
+class TooManyStreams(Exception):
+    pass
 
 
-async def _create_working_directory(name: str) -> str:
-    if not os.path.exists(settings.TEMP_DIRECTORY_PATH):
-        try:
-            os.mkdir(settings.TEMP_DIRECTORY_PATH)
-        except Exception:
-            raise TemporaryDirectoryNotFound(
-                "Temporary directory path does not exist:%s"
-                % settings.TEMP_DIRECTORY_PATH
-            )
+# Followed logs use connection pools of their own, one for the log collector
+# and one for the API clients, so the long lived streams never make the
+# other requests wait for a connection
+MAIN_POOL = "main"
+LOGS_POOL = "logs"
+FOLLOW_POOL = "follow"
 
-    working_directory_path = os.path.join(settings.TEMP_DIRECTORY_PATH, name)
-    os.mkdir(working_directory_path)
-    shutil.copytree(
-        settings.KUBERNETES_FILES_PATH, working_directory_path, dirs_exist_ok=True
-    )
-    _logger.debug("Copied Kubernetes files to %s", working_directory_path)
+_api_clients: dict[str, ApiClient] = {}
+_api_client_lock = asyncio.Lock()
 
-    return working_directory_path
 
+def _pool_size(pool: str) -> int:
+    if pool == LOGS_POOL:
+        # One connection for each stream the log collector can follow
+        return settings.LOG_BUFFER_MAX_INSTANCES * len(settings.LOG_BUFFER_CONTAINERS)
+    if pool == FOLLOW_POOL:
+        return settings.LOG_FOLLOW_MAX_STREAMS
+    return settings.KUBERNETES_CONNECTION_POOL_SIZE
 
-async def _render_kubernetes_file(directory_path: str, data=None) -> str:
-    """Generates Kubernetes files using data parameter"""
-    # Render Mako template and store output
-    if data is None:
-        data = {}
 
-    kustomization_template = Template(
-        filename=os.path.join(directory_path, "kustomization.mako")
-    )
+async def _load_configuration(pool_size: int) -> client.Configuration:
+    configuration = client.Configuration()
     try:
-        output = kustomization_template.render(**data)
-    except Exception as e:
-        raise TemplateRenderFailed(
-            "Could not render kustomization file from Mako template:%s" % str(e)
-        )
+        config.load_incluster_config(client_configuration=configuration)
+        _logger.debug("Loaded in-cluster Kubernetes configuration")
+    except config.ConfigException:
+        await config.load_kube_config(client_configuration=configuration)
+        _logger.debug("Loaded Kubernetes configuration from kubeconfig")
+    configuration.connection_pool_maxsize = pool_size
+    return configuration
+
 
-    # Write output to file
-    output_file_path = os.path.join(directory_path, "kustomization.yaml")
-    with open(output_file_path, "w") as f:
-        f.write(output)
-    _logger.debug("Kustomization file render saved (%s)", output_file_path)
+async def get_client(pool: str = MAIN_POOL) -> ApiClient:
+    """Returns the shared API client of a pool, creating it on first use"""
+    async with _api_client_lock:
+        if pool not in _api_clients:
+            configuration = await _load_configuration(_pool_size(pool))
+            _api_clients[pool] = ApiClient(configuration)
+    return _api_clients[pool]
 
-    return output_file_path
+
+async def close_client() -> None:
+    async with _api_client_lock:
+        for api_client in _api_clients.values():
+            await api_client.close()
+        _api_clients.clear()
+
+
+def _pool_full(pool: str) -> bool:
+    api_client = _api_clients.get(pool)
+    if api_client is None:
+        return False
+    connector = api_client.rest_client.pool_manager.connector
+    return len(connector._acquired) >= connector.limit
+
+
+def client_stats(pool: str = MAIN_POOL) -> dict:
+    """Returns the state of the connection pool of a shared API client"""
+    api_client = _api_clients.get(pool)
+    if api_client is None:
+        return {"limit": _pool_size(pool), "open": False}
+    connector = api_client.rest_client.pool_manager.connector
+    # aiohttp does not expose pool usage publicly
+    return {
+        "limit": connector.limit,
+        "open": not connector.closed,
+        "in_use": len(connector._acquired),
+        "idle": sum(len(conns) for conns in connector._conns.values()),
+    }
+
+
+async def _apply(api: ApiClient, obj: dict) -> None:
+    """Creates or updates an object using server-side apply"""
+    try:
+        api_class, apply_method, _ = _RESOURCES[obj["kind"]]
+    except KeyError:
+        raise UnsupportedResource("Cannot apply %s objects" % obj["kind"])
+    _logger.debug("Applying %s %s", obj["kind"], obj["metadata"]["name"])
+    await getattr(api_class(api), apply_method)(
+        name=obj["metadata"]["name"],
+        namespace=settings.KUBERNETES_NAMESPACE,
+        body=json.dumps(obj).encode("utf-8"),
+        field_manager=FIELD_MANAGER,
+        force=True,
+        _content_type="application/apply-patch+yaml",
+    )
 
 
 async def start_deployment(name: str, data: dict = None) -> None:
@@ -83,95 +161,191 @@ async def start_deployment(name: str, data: dict = None) -> None:
     if data is None:
         data = {}
     _logger.debug("Deploying %s", name)
-    tmp_dir_path = await _create_working_directory(name)
-    await _render_kubernetes_file(tmp_dir_path, data)
-    await _kubectl(
-        [
-            "apply",
-            "-k",
-            tmp_dir_path,
-            "--namespace=" + settings.KUBERNETES_NAMESPACE,
-        ]
+    objects = manifests.render(data)
+    deployments = [obj for obj in objects if obj["kind"] == "Deployment"]
+    api = await get_client()
+    # Pods must find their ConfigMaps and Services when they are created
+    await asyncio.gather(
+        *(_apply(api, obj) for obj in objects if obj["kind"] != "Deployment")
     )
+    await asyncio.gather(*(_apply(api, obj) for obj in deployments))
 
 
 async def remove_deployment(name: str) -> None:
     """Removes a deployment in the Kubernetes cluster"""
     _logger.debug("Undeploying %s", name)
-    await _kubectl(
-        [
-            "delete",
-            "deployment",
-            name + "-erpserver-deployment",
-            "--namespace=" + settings.KUBERNETES_NAMESPACE,
-        ]
+    api = await get_client()
+    await asyncio.gather(
+        *(
+            getattr(api_class(api), delete_method)(
+                namespace=settings.KUBERNETES_NAMESPACE,
+                label_selector="gestor/name={}".format(name),
+                propagation_policy="Background",
+            )
+            for api_class, _, delete_method in _RESOURCES.values()
+        )
     )
-    await _kubectl(
-        [
-            "delete",
-            "service",
-            name + "-erpserver",
-            "--namespace=" + settings.KUBERNETES_NAMESPACE,
-        ]
+
+
+async def _pod_name(v1: client.CoreV1Api, name: str) -> str:
+    pods = await v1.list_namespaced_pod(
+        namespace=settings.KUBERNETES_NAMESPACE,
+        label_selector="gestor/name={}".format(name),
     )
+    if not pods.items:
+        raise PodNotFound("Pod not found in the cluster")
+    return pods.items[0].metadata.name
 
 
-async def pod_logs(name: str) -> str:
-    async with ApiClient() as api:
-        v1 = client.CoreV1Api(api)
-        pods = await v1.list_namespaced_pod(
-            namespace=settings.KUBERNETES_NAMESPACE,
-            label_selector="gestor/name={}".format(name),
-        )
-        if pods.items:
-            return cast(
-                str,
-                await v1.read_namespaced_pod_log(
-                    name=pods.items[0].metadata.name,
-                    namespace=settings.KUBERNETES_NAMESPACE,
-                    container="erpserver",
-                    tail_lines=None,
-                    follow=False,
-                ),
-            )
-        else:
-            raise Exception("Pod not found in the cluster")
+async def _iter_chunks(response) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in response.content.iter_any():
+            yield chunk
+    finally:
+        response.release()
+
+
+async def pod_logs(
+    name: str,
+    container: str = "erpserver",
+    tail_lines: int = None,
+    since_seconds: int = None,
+    limit_bytes: int = None,
+    follow: bool = False,
+    timestamps: bool = False,
+    pool: str = None,
+) -> AsyncIterator[bytes]:
+    """Opens the log of an instance and returns its chunks as they arrive
+
+    The log is read straight from the API server response, never loaded
+    whole in memory. With follow, the chunks keep coming until the pod stops
+    or the iterator is closed. The request is sent with the client of pool,
+    by default FOLLOW_POOL when following, which raises TooManyStreams once
+    all its connections are taken instead of waiting for one.
+    """
+    if pool is None:
+        pool = FOLLOW_POOL if follow else MAIN_POOL
+    if pool == FOLLOW_POOL and _pool_full(pool):
+        raise TooManyStreams("All the followed log streams are in use")
+    v1 = client.CoreV1Api(await get_client(pool))
+    # The default timeout of the client would cut followed logs
+    options = {"_request_timeout": FOLLOW_TIMEOUT} if follow else {}
+    response = await v1.read_namespaced_pod_log(
+        name=await _pod_name(v1, name),
+        namespace=settings.KUBERNETES_NAMESPACE,
+        container=container,
+        tail_lines=tail_lines,
+        since_seconds=since_seconds,
+        limit_bytes=limit_bytes,
+        follow=follow,
+        timestamps=timestamps,
+        _preload_content=False,
+        **options,
+    )
+    if not 200 <= response.status <= 299:
+        # Not checked by the client when the content is not preloaded
+        try:
+            data = await response.read()
+        finally:
+            response.release()
+        raise ApiException(http_resp=RESTResponse(response, data))
+    return _iter_chunks(response)
 
 
 async def cluster_deployments() -> list[V1Deployment]:
-    """Starts a new deployment in the Kubernetes cluster"""
-    async with ApiClient() as api:
-        v1 = client.AppsV1Api(api)
-        deployments = await v1.list_namespaced_deployment(
-            namespace=settings.KUBERNETES_NAMESPACE
-        )
-        return deployments.items
+    """Lists the deployments in the Kubernetes cluster"""
+    v1 = client.AppsV1Api(await get_client())
+    deployments = await v1.list_namespaced_deployment(
+        namespace=settings.KUBERNETES_NAMESPACE
+    )
+    return deployments.items
 
 
 async def cluster_pods() -> list[V1Pod]:
-    """Starts a new deployment in the Kubernetes cluster"""
-    async with ApiClient() as api:
-        v1 = client.AppsV1Api(api)
+    """Lists the pods in the Kubernetes cluster"""
+    v1 = client.CoreV1Api(await get_client())
+    pods = await v1.list_namespaced_pod(namespace=settings.KUBERNETES_NAMESPACE)
+    return pods.items
+
+
+def _backoff_delay(failures: int) -> float:
+    """Exponential backoff with jitter for reconnection attempts"""
+    delay = min(WATCH_BACKOFF_MAX, WATCH_BACKOFF_BASE * 2**failures)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class DeploymentInformer:
+    """Keeps a consumer in sync with the deployments of the cluster
+
+    The deployments are listed once and then watched from the listed
+    resourceVersion, with bookmarks to keep it current. A closed watch is
+    resumed from the last seen version and the deployments are only listed
+    again when that version has expired (410 Gone). Each list is sent as a
+    single SYNC event with all the deployments in its "objects" key.
+    """
+
+    def __init__(self):
+        self.resource_version: str | None = None
+        self._failures = 0
+
+    async def _list(self, v1: client.AppsV1Api, event_queue) -> None:
         deployments = await v1.list_namespaced_deployment(
             namespace=settings.KUBERNETES_NAMESPACE
         )
-        return deployments.items
-
-
-async def watch_deployments(event_queue) -> None:
-    await config.load_kube_config()
-    while True:
-        _logger.debug("Opening connection to listen Deployment events")
-        async with ApiClient() as api:
-            v1 = client.AppsV1Api(api)
-            deployment_watcher = watch.Watch()
-            async with deployment_watcher.stream(
-                v1.list_namespaced_deployment, namespace=settings.KUBERNETES_NAMESPACE
-            ) as s:
-                while True:
-                    try:
-                        event = await asyncio.wait_for(s.__anext__(), timeout=None)
-                        await event_queue.put(event)
-                    except asyncio.TimeoutError:
-                        pass
-        _logger.debug("Closing connection to listen Deployment events")
+        self.resource_version = deployments.metadata.resource_version
+        _logger.debug(
+            "Listed %d deployments (version %s)",
+            len(deployments.items),
+            self.resource_version,
+        )
+        await event_queue.put(
+            {"type": "SYNC", "object": None, "objects": deployments.items}
+        )
+
+    async def _watch(self, v1: client.AppsV1Api, event_queue) -> bool:
+        """Sends the watched events until the stream closes
+
+        Returns whether any event, bookmarks included, was received.
+        """
+        _logger.debug(
+            "Watching Deployment events from version %s", self.resource_version
+        )
+        deployment_watcher = watch.Watch()
+        async with deployment_watcher.stream(
+            v1.list_namespaced_deployment,
+            namespace=settings.KUBERNETES_NAMESPACE,
+            resource_version=self.resource_version,
+            allow_watch_bookmarks=True,
+        ) as stream:
+            received = False
+            async for event in stream:
+                received = True
+                self._failures = 0
+                self.resource_version = deployment_watcher.resource_version
+                if event["type"] != "BOOKMARK":
+                    await event_queue.put(event)
+        _logger.debug("Deployment events stream closed")
+        return received
+
+    async def run(self, event_queue) -> None:
+        while True:
+            try:
+                v1 = client.AppsV1Api(await get_client())
+                if self.resource_version is None:
+                    await self._list(v1, event_queue)
+                if await self._watch(v1, event_queue):
+                    continue
+                # A watch closing at once must not be reopened in a loop
+                _logger.debug("Deployment events stream closed without events")
+            except ApiException as e:
+                if e.status == 410:
+                    _logger.debug("Version %s expired", self.resource_version)
+                    self.resource_version = None
+                    continue
+                _logger.debug("Error watching K8s Deployments:%s" % str(e))
+            except Exception as e:
+                _logger.debug("Error watching K8s Deployments:%s" % str(e))
+            delay = _backoff_delay(self._failures)
+            self._failures += 1
+            _logger.debug("Watching K8s Deployments again in %.1fs", delay)
+            await asyncio.sleep(delay)
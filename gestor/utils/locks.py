@@ -0,0 +1,50 @@
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+
+class Superseded(Exception):
+    pass
+
+
+class KeyedLock:
+    """Serializes the operations sharing a key
+
+    Operations on the same key run one at a time in arrival order, while
+    operations on different keys run concurrently. An operation acquired
+    with supersede=True is cancelled, raising Superseded, if another
+    superseding operation arrives for its key while it is still waiting.
+    """
+
+    def __init__(self):
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+        self._users: dict[Hashable, int] = {}
+        self._latest: dict[Hashable, int] = {}
+        self._tickets = itertools.count()
+        self.superseded = 0
+
+    @asynccontextmanager
+    async def acquire(
+        self, key: Hashable, supersede: bool = False
+    ) -> AsyncIterator[None]:
+        ticket = next(self._tickets)
+        if supersede:
+            self._latest[key] = ticket
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                if supersede and self._latest.get(key) != ticket:
+                    self.superseded += 1
+                    raise Superseded("A newer operation for %s arrived" % str(key))
+                yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+                self._latest.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._locks)
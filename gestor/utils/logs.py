@@ -0,0 +1,185 @@
+import asyncio
+import datetime
+import logging
+import re
+from collections import deque
+from contextlib import aclosing
+from typing import NamedTuple, Optional
+
+from gestor.utils import kubernetes
+
+_logger = logging.getLogger(__name__)
+
+# Seconds to wait before following a log again after its stream ended
+RETRY_DELAY = 5
+# Longer lines are split, so a missing newline can not grow a line forever
+MAX_LINE_SIZE = 64 * 1024
+
+
+class LogLine(NamedTuple):
+    timestamp: datetime.datetime
+    container: str
+    text: str
+
+
+def parse_line(container: str, raw: bytes) -> LogLine:
+    """Parses a log line prefixed with its Kubernetes timestamp"""
+    line = raw.decode("utf-8", "replace").rstrip("\r")
+    stamp, _, text = line.partition(" ")
+    try:
+        timestamp = datetime.datetime.fromisoformat(stamp)
+    except ValueError:
+        return LogLine(datetime.datetime.now(datetime.timezone.utc), container, line)
+    return LogLine(timestamp, container, text)
+
+
+def _aware(value: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def search(
+    lines: list[LogLine],
+    pattern: re.Pattern = None,
+    since: datetime.datetime = None,
+    until: datetime.datetime = None,
+    container: str = None,
+    limit: int = None,
+) -> list[LogLine]:
+    """Returns the latest limit matching lines, oldest first
+
+    Naive datetimes are taken as UTC, like the Kubernetes timestamps.
+    """
+    since, until = _aware(since), _aware(until)
+    matches = []
+    for line in reversed(lines):
+        if limit is not None and len(matches) >= limit:
+            break
+        if (
+            (container is None or line.container == container)
+            and (since is None or line.timestamp >= since)
+            and (until is None or line.timestamp <= until)
+            and (pattern is None or pattern.search(line.text))
+        ):
+            matches.append(line)
+    matches.reverse()
+    return matches
+
+
+class LogCollector:
+    """Keeps the recent log lines of the watched instances in memory
+
+    Every container in containers of a watched instance is followed, and its
+    lines are added to a ring buffer of maxlines per instance, so searches
+    don't download the logs again. Each stream holds a connection of the
+    Kubernetes logs pool, so at most max_instances are followed at once and
+    the rest wait, in order, for a watched one to go. With maxlines 0
+    nothing is collected.
+    """
+
+    def __init__(self, maxlines: int, containers: list[str], max_instances: int):
+        self._maxlines = maxlines
+        self._containers = containers
+        self._max_instances = max_instances
+        self._buffers: dict[str, deque[LogLine]] = {}
+        self._tasks: dict[str, list[asyncio.Task]] = {}
+        # Instances waiting for a free slot, the dict keeps their order
+        self._waiting: dict[str, None] = {}
+        self.reconnects = 0
+
+    def watch(self, name: str) -> None:
+        if not self._maxlines or name in self._buffers:
+            return
+        if len(self._buffers) >= self._max_instances:
+            self._waiting[name] = None
+            return
+        buffer: deque[LogLine] = deque(maxlen=self._maxlines)
+        self._buffers[name] = buffer
+        self._tasks[name] = [
+            asyncio.create_task(self._follow(name, container, buffer))
+            for container in self._containers
+        ]
+
+    def unwatch(self, name: str) -> None:
+        self._waiting.pop(name, None)
+        if self._buffers.pop(name, None) is None:
+            return
+        for task in self._tasks.pop(name, ()):
+            task.cancel()
+        if self._waiting:
+            waiting = next(iter(self._waiting))
+            del self._waiting[waiting]
+            self.watch(waiting)
+
+    def retain(self, names: set[str]) -> None:
+        """Stops watching every instance not in names"""
+        for name in list(self._waiting):
+            if name not in names:
+                del self._waiting[name]
+        for name in list(self._buffers):
+            if name not in names:
+                self.unwatch(name)
+
+    def is_watched(self, name: str) -> bool:
+        return name in self._buffers
+
+    def lines(self, name: str) -> list[LogLine]:
+        return list(self._buffers.get(name, ()))
+
+    async def _follow(self, name: str, container: str, buffer: deque) -> None:
+        last = None
+        while True:
+            # Resumed from the last line buffered, skipping the ones seen
+            resume = last
+            since = None
+            if resume is not None:
+                elapsed = datetime.datetime.now(datetime.timezone.utc) - resume
+                since = max(1, int(elapsed.total_seconds()) + 1)
+            try:
+                chunks = await kubernetes.pod_logs(
+                    name,
+                    container=container,
+                    tail_lines=None if since else self._maxlines,
+                    since_seconds=since,
+                    follow=True,
+                    timestamps=True,
+                    pool=kubernetes.LOGS_POOL,
+                )
+                pending = b""
+                async with aclosing(chunks):
+                    async for chunk in chunks:
+                        *lines, pending = (pending + chunk).split(b"\n")
+                        if len(pending) > MAX_LINE_SIZE:
+                            lines.append(pending)
+                            pending = b""
+                        for raw in lines:
+                            line = parse_line(container, raw)
+                            if resume is not None and line.timestamp <= resume:
+                                continue
+                            buffer.append(line)
+                            last = line.timestamp
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _logger.debug("Failed to follow the logs of %s:%s", name, str(e))
+            self.reconnects += 1
+            await asyncio.sleep(RETRY_DELAY)
+
+    async def stop(self) -> None:
+        tasks = [task for tasks in self._tasks.values() for task in tasks]
+        self._buffers.clear()
+        self._tasks.clear()
+        self._waiting.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "instances": len(self._buffers),
+            "lines": sum(len(buffer) for buffer in self._buffers.values()),
+            "waiting": len(self._waiting),
+            "streams": sum(len(tasks) for tasks in self._tasks.values()),
+            "reconnects": self.reconnects,
+        }
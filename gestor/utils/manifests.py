@@ -0,0 +1,266 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+from typing import Any
+
+import yaml
+from mako.template import Template
+
+from config import settings
+
+_logger = logging.getLogger(__name__)
+
+try:
+    _Loader = yaml.CSafeLoader
+except AttributeError:  # PyYAML built without libyaml
+    _Loader = yaml.SafeLoader
+
+# Same alphabet substitution kustomize uses to build ConfigMap name suffixes
+_HASH_TRANSLATION = str.maketrans("013ae", "ghkmt")
+
+
+class TemplateRenderFailed(Exception):
+    pass
+
+
+class UnsupportedKustomization(Exception):
+    pass
+
+
+def _copy(obj: Any) -> Any:
+    """Copies a parsed YAML document, faster than copy.deepcopy"""
+    if isinstance(obj, dict):
+        return {key: _copy(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_copy(value) for value in obj]
+    return obj
+
+
+def _pointer(path: str) -> list[str]:
+    return [part.replace("~1", "/").replace("~0", "~") for part in path.split("/")[1:]]
+
+
+def _apply_json_patch(obj: dict, operations: list[dict]) -> None:
+    """Applies add, replace and remove JSON patch (RFC 6902) operations"""
+    for operation in operations:
+        *parents, last = _pointer(operation["path"])
+        target = obj
+        for part in parents:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+
+        op = operation["op"]
+        if isinstance(target, list):
+            index = len(target) if last == "-" else int(last)
+            if op == "add":
+                target.insert(index, operation["value"])
+            elif op == "replace":
+                target[index] = operation["value"]
+            elif op == "remove":
+                del target[index]
+            else:
+                raise UnsupportedKustomization("Unsupported patch operation %s" % op)
+        else:
+            if op in ("add", "replace"):
+                target[last] = operation["value"]
+            elif op == "remove":
+                del target[last]
+            else:
+                raise UnsupportedKustomization("Unsupported patch operation %s" % op)
+
+
+def _matches(obj: dict, target: dict) -> bool:
+    return (
+        target.get("kind", obj["kind"]) == obj["kind"]
+        and target.get("name", obj["metadata"]["name"]) == obj["metadata"]["name"]
+    )
+
+
+def _config_map_hash(config_map: dict) -> str:
+    encoded = json.dumps(
+        {
+            "data": config_map["data"],
+            "kind": "ConfigMap",
+            "name": config_map["metadata"]["name"],
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    digest = hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+    return digest[:10].translate(_HASH_TRANSLATION)
+
+
+def _config_map_references(obj: dict):
+    """Yields the dicts holding a ConfigMap name referenced by a Deployment"""
+    pod_spec = obj.get("spec", {}).get("template", {}).get("spec", {})
+    for container in pod_spec.get("containers", []) + pod_spec.get(
+        "initContainers", []
+    ):
+        for env_from in container.get("envFrom", []):
+            if "configMapRef" in env_from:
+                yield env_from["configMapRef"]
+        for env in container.get("env", []):
+            value_from = env.get("valueFrom", {})
+            if "configMapKeyRef" in value_from:
+                yield value_from["configMapKeyRef"]
+    for volume in pod_spec.get("volumes", []):
+        if "configMap" in volume:
+            yield volume["configMap"]
+
+
+def _service_references(obj: dict):
+    """Yields the dicts holding a Service name referenced by an Ingress"""
+    spec = obj.get("spec", {})
+    if "service" in spec.get("defaultBackend", {}):
+        yield spec["defaultBackend"]["service"]
+    for rule in spec.get("rules", []):
+        for path in rule.get("http", {}).get("paths", []):
+            if "service" in path.get("backend", {}):
+                yield path["backend"]["service"]
+
+
+class ManifestRenderer:
+    """Renders the Kubernetes objects of an instance in memory
+
+    The kustomization template and the resources it references are loaded
+    once, and each render applies the kustomize features used by the
+    instance files (namePrefix, commonLabels, commonAnnotations,
+    configMapGenerator and JSON patches) without touching the filesystem.
+    Like kustomize, namePrefix also renames the references to ConfigMaps in
+    Deployments and to Services in Ingress backends.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._template = Template(filename=os.path.join(path, "kustomization.mako"))
+        self._resources: dict[str, list[dict]] = {}
+        for file_name in sorted(os.listdir(path)):
+            if file_name.endswith((".yaml", ".yml")):
+                self._load_resource(file_name)
+        _logger.debug(
+            "Loaded Kubernetes files from %s (%s)", path, ", ".join(self._resources)
+        )
+
+    def _load_resource(self, file_name: str) -> list[dict]:
+        with open(os.path.join(self._path, file_name)) as f:
+            documents = [d for d in yaml.load_all(f, Loader=_Loader) if d]
+        self._resources[file_name] = documents
+        return documents
+
+    def _kustomization(self, data: dict) -> dict:
+        try:
+            output = self._template.render(**data)
+        except Exception as e:
+            raise TemplateRenderFailed(
+                "Could not render kustomization file from Mako template:%s" % str(e)
+            )
+        return yaml.load(output, Loader=_Loader) or {}
+
+    def render(self, data: dict = None) -> list[dict]:
+        """Returns the final Kubernetes objects for the given template data"""
+        if data is None:
+            data = {}
+        kustomization = self._kustomization(data)
+
+        objects = []
+        for file_name in kustomization.get("resources") or []:
+            documents = self._resources.get(file_name)
+            if documents is None:
+                documents = self._load_resource(file_name)
+            objects.extend(_copy(document) for document in documents)
+
+        generated = {}
+        for generator in kustomization.get("configMapGenerator") or []:
+            if generator.get("files") or generator.get("envs"):
+                raise UnsupportedKustomization(
+                    "Only literals are supported in configMapGenerator"
+                )
+            literals = (
+                literal.split("=", 1) for literal in generator.get("literals") or []
+            )
+            objects.append(
+                {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "metadata": {"name": generator["name"]},
+                    "data": {key: value for key, value in literals},
+                }
+            )
+            generated[generator["name"]] = objects[-1]
+
+        for patch in kustomization.get("patches") or []:
+            target = patch.get("target", {})
+            operations = yaml.load(patch["patch"], Loader=_Loader)
+            if not isinstance(operations, list):
+                raise UnsupportedKustomization("Only JSON patches are supported")
+            for obj in objects:
+                if _matches(obj, target):
+                    _apply_json_patch(obj, operations)
+
+        prefix = kustomization.get("namePrefix") or ""
+        labels = {
+            key: str(value)
+            for key, value in (kustomization.get("commonLabels") or {}).items()
+        }
+        annotations = {
+            key: str(value)
+            for key, value in (kustomization.get("commonAnnotations") or {}).items()
+        }
+
+        # ConfigMap references are renamed after prefixing and hashing
+        names = {
+            obj["metadata"]["name"]: prefix + obj["metadata"]["name"]
+            for obj in objects
+            if obj["kind"] == "ConfigMap"
+        }
+        # As are Service references in Ingress backends, after prefixing
+        services = {
+            obj["metadata"]["name"]: prefix + obj["metadata"]["name"]
+            for obj in objects
+            if obj["kind"] == "Service"
+        }
+        for obj in objects:
+            metadata = obj["metadata"]
+            metadata["name"] = prefix + metadata["name"]
+            metadata.setdefault("labels", {}).update(labels)
+            metadata.setdefault("annotations", {}).update(annotations)
+            if obj["kind"] == "Deployment":
+                spec = obj["spec"]
+                spec.setdefault("selector", {}).setdefault("matchLabels", {}).update(
+                    labels
+                )
+                template_metadata = spec["template"].setdefault("metadata", {})
+                template_metadata.setdefault("labels", {}).update(labels)
+                template_metadata.setdefault("annotations", {}).update(annotations)
+            elif obj["kind"] == "Service":
+                obj["spec"].setdefault("selector", {}).update(labels)
+
+        for name, config_map in generated.items():
+            config_map["metadata"]["name"] += "-" + _config_map_hash(config_map)
+            names[name] = config_map["metadata"]["name"]
+
+        for obj in objects:
+            if obj["kind"] != "Deployment":
+                continue
+            for reference in _config_map_references(obj):
+                if reference.get("name") in names:
+                    reference["name"] = names[reference["name"]]
+
+        for obj in objects:
+            if obj["kind"] != "Ingress":
+                continue
+            for reference in _service_references(obj):
+                if reference.get("name") in services:
+                    reference["name"] = services[reference["name"]]
+
+        return objects
+
+
+@functools.cache
+def get_renderer() -> ManifestRenderer:
+    return ManifestRenderer(settings.KUBERNETES_FILES_PATH)
+
+
+def render(data: dict = None) -> list[dict]:
+    return get_renderer().render(data)
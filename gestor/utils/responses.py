@@ -0,0 +1,104 @@
+import hashlib
+import json
+import zlib
+from typing import Any, AsyncIterator, Hashable, NamedTuple, Optional
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+
+class CachedBody(NamedTuple):
+    body: bytes
+    etag: str
+    headers: Optional[dict[str, str]] = None
+
+
+def encode(data: Any, headers: dict[str, str] = None) -> CachedBody:
+    """Serializes data as FastAPI's JSONResponse does, with a strong ETag"""
+    body = json.dumps(
+        jsonable_encoder(data),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+    return CachedBody(body, '"%s"' % hashlib.sha256(body).hexdigest()[:32], headers)
+
+
+class BodyCache:
+    """Serialized response bodies of a versioned source
+
+    Every body is dropped as soon as the source version changes, so they are
+    built once per change whatever the number of requests. At most maxsize
+    bodies are kept for a version.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self._maxsize = maxsize
+        self._version: Optional[int] = None
+        self._bodies: dict[Hashable, CachedBody] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version: int, key: Hashable) -> Optional[CachedBody]:
+        if version != self._version:
+            self._bodies.clear()
+            self._version = version
+        cached = self._bodies.get(key)
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    def store(
+        self, version: int, key: Hashable, data: Any, headers: dict[str, str] = None
+    ) -> CachedBody:
+        cached = encode(data, headers)
+        # The source may have changed while data was read
+        if version == self._version and len(self._bodies) < self._maxsize:
+            self._bodies[key] = cached
+        return cached
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._bodies), "hits": self.hits, "misses": self.misses}
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (
+        tag.strip() for tag in if_none_match.split(",")
+    )
+
+
+def cached_response(request: Request, cached: CachedBody) -> Response:
+    """Returns the cached body, or 304 if the client already has it"""
+    headers = {
+        **(cached.headers or {}),
+        "ETag": cached.etag,
+        "Cache-Control": "no-cache",
+    }
+    if _etag_matches(request, cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
+def accepts_gzip(request: Request) -> bool:
+    accept_encoding = request.headers.get("accept-encoding", "")
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00")
+    return False
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Compresses a stream of chunks as a single gzip member"""
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
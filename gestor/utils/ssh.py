@@ -0,0 +1,379 @@
+import asyncio
+import codecs
+import functools
+import json
+import logging
+import time
+from typing import Optional
+
+import paramiko
+from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+from config import settings
+from gestor.utils.locks import KeyedLock
+
+_logger = logging.getLogger(__name__)
+
+READ_SIZE = 32 * 1024
+# Output is sent once no more arrives for FLUSH_DELAY seconds, or FLUSH_SIZE
+# bytes are waiting
+FLUSH_DELAY = 0.005
+FLUSH_SIZE = 64 * 1024
+# Maximum seconds between two checks of the pooled connections
+REAP_INTERVAL = 30
+
+_stats = {"bridges": 0, "frames": 0, "bytes": 0}
+
+
+@functools.cache
+def _key() -> paramiko.RSAKey:
+    return paramiko.RSAKey.from_private_key_file(settings.SSH_KEY_PATH)
+
+
+Address = tuple[str, int]
+
+
+class UnsupportedSSHMode(Exception):
+    pass
+
+
+def instance_address(name: str, ssh_port: int) -> Address:
+    """Returns where the SSH server of an instance is reached
+
+    In nodeport mode, through its NodePort on SSH_IP. In gateway mode,
+    through SSH_GATEWAY_HOST, by default the ClusterIP Service of the
+    instance, so the manager has to run inside the cluster.
+    """
+    if settings.SSH_MODE == "nodeport":
+        return settings.SSH_IP, ssh_port
+    if settings.SSH_MODE == "gateway":
+        host = settings.SSH_GATEWAY_HOST.format(
+            name=name, namespace=settings.KUBERNETES_NAMESPACE
+        )
+        return host, settings.SSH_GATEWAY_PORT
+    raise UnsupportedSSHMode("Unknown SSH mode %s" % settings.SSH_MODE)
+
+
+def _connect(address: Address) -> paramiko.SSHClient:
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    hostname, port = address
+    try:
+        ssh.connect(
+            hostname=hostname,
+            username=settings.SSH_USER,
+            pkey=_key(),
+            port=port,
+            timeout=2,
+        )
+    except Exception:
+        ssh.close()
+        raise
+    ssh.get_transport().set_keepalive(settings.SSH_KEEPALIVE_INTERVAL)
+    return ssh
+
+
+def _is_healthy(ssh: paramiko.SSHClient) -> bool:
+    transport = ssh.get_transport()
+    return (
+        transport is not None and transport.is_active() and transport.is_authenticated()
+    )
+
+
+class TransportPool:
+    """Authenticated SSH connections shared by the shells of an instance
+
+    Shells to the same address are opened as channels of one connection, so
+    only the first one pays the key exchange and authentication. Connections
+    are health checked before reuse and closed by reap() once they have had
+    no channel for idle_timeout seconds. As servers limit the sessions of a
+    connection, shells beyond max_channels get a connection of their own.
+    """
+
+    def __init__(self, idle_timeout: float, max_channels: int):
+        self._idle_timeout = idle_timeout
+        self._max_channels = max_channels
+        self._clients: dict[Address, paramiko.SSHClient] = {}
+        # Usage is tracked per connection, as a connection that is replaced
+        # may still have shells open
+        self._channels: dict[paramiko.SSHClient, int] = {}
+        self._idle_since: dict[paramiko.SSHClient, float] = {}
+        self._owners: dict[paramiko.Channel, paramiko.SSHClient] = {}
+        self._dedicated: dict[paramiko.Channel, paramiko.SSHClient] = {}
+        self._connecting = KeyedLock()
+        self.handshakes = 0
+        self.reused = 0
+
+    def _discard(self, address: Address) -> Optional[paramiko.SSHClient]:
+        ssh = self._clients.pop(address, None)
+        self._channels.pop(ssh, None)
+        self._idle_since.pop(ssh, None)
+        return ssh
+
+    async def _client(self, address: Address) -> Optional[paramiko.SSHClient]:
+        """Reserves a channel of the pooled connection to address
+
+        Returns None when the connection has max_channels already.
+        """
+        async with self._connecting.acquire(address):
+            ssh = self._clients.get(address)
+            if ssh is not None and not _is_healthy(ssh):
+                self._discard(address)
+                await asyncio.to_thread(ssh.close)
+                ssh = None
+            if ssh is None:
+                ssh = await asyncio.to_thread(_connect, address)
+                self.handshakes += 1
+                self._clients[address] = ssh
+                self._channels[ssh] = 0
+            elif self._channels[ssh] >= self._max_channels:
+                return None
+            else:
+                self.reused += 1
+            self._channels[ssh] += 1
+            self._idle_since.pop(ssh, None)
+            return ssh
+
+    async def _open_dedicated(self, address: Address) -> paramiko.Channel:
+        ssh = await asyncio.to_thread(_connect, address)
+        self.handshakes += 1
+        try:
+            chan = await asyncio.to_thread(ssh.invoke_shell, term="xterm")
+        except Exception:
+            await asyncio.to_thread(ssh.close)
+            raise
+        self._dedicated[chan] = ssh
+        return chan
+
+    def _give_back(self, ssh: paramiko.SSHClient) -> None:
+        # Connections discarded since the channel was reserved are closed
+        if ssh in self._channels:
+            self._channels[ssh] -= 1
+            if not self._channels[ssh]:
+                self._idle_since[ssh] = time.monotonic()
+
+    async def open_shell(self, address: Address) -> paramiko.Channel:
+        """Opens a shell at address, on a pooled connection if possible"""
+        for attempt in range(2):
+            ssh = await self._client(address)
+            if ssh is None:
+                return await self._open_dedicated(address)
+            try:
+                chan = await asyncio.to_thread(ssh.invoke_shell, term="xterm")
+                break
+            except Exception:
+                if _is_healthy(ssh):
+                    # Only this channel was refused, like beyond the sessions
+                    # the server allows, the other shells keep the connection
+                    self._give_back(ssh)
+                    return await self._open_dedicated(address)
+                # The connection died since the health check, retried once
+                if self._clients.get(address) is ssh:
+                    self._discard(address)
+                await asyncio.to_thread(ssh.close)
+                if attempt:
+                    raise
+        self._owners[chan] = ssh
+        return chan
+
+    async def release(self, chan: paramiko.Channel) -> None:
+        """Closes a shell opened with open_shell"""
+        await asyncio.to_thread(chan.close)
+        ssh = self._dedicated.pop(chan, None)
+        if ssh is not None:
+            await asyncio.to_thread(ssh.close)
+            return
+        ssh = self._owners.pop(chan, None)
+        if ssh is not None:
+            self._give_back(ssh)
+
+    async def reap(self) -> None:
+        """Closes the connections idle for too long or no longer healthy"""
+        now = time.monotonic()
+        expired = [
+            address
+            for address, ssh in self._clients.items()
+            if not _is_healthy(ssh)
+            or (
+                ssh in self._idle_since
+                and now - self._idle_since[ssh] >= self._idle_timeout
+            )
+        ]
+        for address in expired:
+            ssh = self._discard(address)
+            if ssh is not None:
+                await asyncio.to_thread(ssh.close)
+
+    async def _reaper(self) -> None:
+        while True:
+            await asyncio.sleep(min(self._idle_timeout, REAP_INTERVAL))
+            try:
+                await self.reap()
+            except Exception as e:
+                _logger.error("Failed to reap the SSH connections:%s", str(e))
+
+    def start(self) -> list[asyncio.Task]:
+        return [asyncio.create_task(self._reaper())]
+
+    async def close(self) -> None:
+        clients = [*self._clients.values(), *self._dedicated.values()]
+        self._clients.clear()
+        self._channels.clear()
+        self._idle_since.clear()
+        self._owners.clear()
+        self._dedicated.clear()
+        for ssh in clients:
+            await asyncio.to_thread(ssh.close)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "connections": len(self._clients) + len(self._dedicated),
+            "channels": sum(self._channels.values()) + len(self._dedicated),
+            "idle": len(self._idle_since),
+            "handshakes": self.handshakes,
+            "reused": self.reused,
+        }
+
+
+pool = TransportPool(settings.SSH_IDLE_TIMEOUT, settings.SSH_MAX_CHANNELS)
+
+
+async def _readable(chan: paramiko.Channel, timeout: float = None) -> None:
+    """Waits until the channel has output or is closed, at most timeout
+
+    Waits on the channel file descriptor, which paramiko makes readable when
+    data arrives or the channel is closed, so an idle channel costs nothing.
+    """
+    loop = asyncio.get_running_loop()
+    fd = chan.fileno()
+    ready = loop.create_future()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+    timer = None
+    if timeout is not None:
+        timer = loop.call_later(timeout, lambda: ready.done() or ready.set_result(None))
+    try:
+        await ready
+    finally:
+        loop.remove_reader(fd)
+        if timer is not None:
+            timer.cancel()
+
+
+async def recv(chan: paramiko.Channel, size: int = READ_SIZE) -> bytes:
+    """Returns the output available in the channel, b"" once it is closed"""
+    while not chan.recv_ready():
+        if chan.closed or chan.eof_received:
+            return b""
+        await _readable(chan)
+    return chan.recv(size)
+
+
+async def recv_batch(chan: paramiko.Channel) -> bytes:
+    """Returns the output arriving within FLUSH_DELAY, up to FLUSH_SIZE bytes
+
+    A burst of small writes, like a scrolling log, is sent in one frame
+    instead of one frame each. Returns b"" once the channel is closed.
+    """
+    data = await recv(chan)
+    if not data:
+        return data
+    batch = bytearray(data)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FLUSH_DELAY
+    while len(batch) < FLUSH_SIZE:
+        if chan.recv_ready():
+            batch += chan.recv(FLUSH_SIZE - len(batch))
+            continue
+        timeout = deadline - loop.time()
+        if timeout <= 0 or chan.closed or chan.eof_received:
+            break
+        await _readable(chan, timeout)
+    return bytes(batch)
+
+
+async def send(chan: paramiko.Channel, data: bytes) -> None:
+    """Sends data to the channel, in a thread if its window is full"""
+    while data and chan.send_ready():
+        data = data[chan.send(data) :]
+    if data:
+        await asyncio.to_thread(chan.sendall, data)
+
+
+def _handle_input(chan: paramiko.Channel, message: str) -> bytes:
+    if '"type":"resize"' in message:
+        sizes = json.loads(message)
+        chan.resize_pty(width=int(sizes["cols"]), height=int(sizes["rows"]))
+        return b""
+    return message.encode("utf-8")
+
+
+async def _forward_output(
+    websocket: WebSocket, chan: paramiko.Channel, text: bool
+) -> None:
+    # Characters split between reads are completed with the next one
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    while True:
+        # Nothing is read while a frame is being sent, so a slow client
+        # fills the SSH window and the shell waits, instead of the output
+        # piling up in memory
+        data = await recv_batch(chan)
+        if not data:
+            return
+        _stats["frames"] += 1
+        _stats["bytes"] += len(data)
+        if text:
+            decoded = decoder.decode(data)
+            if decoded:
+                await websocket.send_text(decoded)
+        else:
+            await websocket.send_bytes(data)
+
+
+async def _forward_input(websocket: WebSocket, chan: paramiko.Channel) -> None:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        if message.get("text") is not None:
+            data = _handle_input(chan, message["text"])
+        else:
+            data = message.get("bytes") or b""
+        if data:
+            await send(chan, data)
+
+
+async def bridge(websocket: WebSocket, address: Address, text: bool = False) -> None:
+    """Connects the websocket to a shell at address until either closes
+
+    Output is sent in binary frames, or decoded in text frames with text.
+    """
+    try:
+        chan = await pool.open_shell(address)
+    except Exception as e:
+        _logger.error("Failed to connect to the instance:%s", str(e))
+        await websocket.close(code=1011)
+        return
+    await websocket.accept()
+    _stats["bridges"] += 1
+    tasks = [
+        asyncio.create_task(_forward_output(websocket, chan, text)),
+        asyncio.create_task(_forward_input(websocket, chan)),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception():
+                _logger.debug("SSH bridge closed:%s", str(task.exception()))
+    finally:
+        _stats["bridges"] -= 1
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await pool.release(chan)
+    if websocket.client_state == WebSocketState.CONNECTED:
+        await websocket.close()
+
+
+def stats() -> dict[str, int]:
+    return {**_stats, **pool.stats()}
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from kubernetes.client import V1Deployment, V1ObjectMeta
+
+from gestor.utils.events import EventBuffer
+
+
+def _event(event_type, name, version="1"):
+    return {
+        "type": event_type,
+        "object": V1Deployment(
+            metadata=V1ObjectMeta(name=name, resource_version=version)
+        ),
+    }
+
+
+@pytest.mark.asyncio
+async def test_events_coalesced_per_object():
+    events = EventBuffer(10)
+    await events.put(_event("MODIFIED", "a", "1"))
+    await events.put(_event("MODIFIED", "b", "2"))
+    await events.put(_event("MODIFIED", "a", "3"))
+
+    first = await events.get()
+    assert first["object"].metadata.name == "a"
+    assert first["object"].metadata.resource_version == "3"
+    assert (await events.get())["object"].metadata.name == "b"
+    assert events.qsize() == 0
+    assert events.stats()["coalesced"] == 1
+
+
+@pytest.mark.asyncio
+async def test_added_event_kept_as_added():
+    events = EventBuffer(10)
+    await events.put(_event("ADDED", "a", "1"))
+    await events.put(_event("MODIFIED", "a", "2"))
+
+    event = await events.get()
+    assert event["type"] == "ADDED"
+    assert event["object"].metadata.resource_version == "2"
+
+
+@pytest.mark.asyncio
+async def test_deleted_event_replaces_pending():
+    events = EventBuffer(10)
+    await events.put(_event("ADDED", "a"))
+    await events.put(_event("DELETED", "a"))
+
+    assert (await events.get())["type"] == "DELETED"
+
+
+@pytest.mark.asyncio
+async def test_sync_drops_previous_events():
+    events = EventBuffer(10)
+    await events.put(_event("MODIFIED", "a"))
+    await events.put(_event("MODIFIED", "b"))
+    await events.put({"type": "SYNC", "object": None, "objects": []})
+    await events.put(_event("MODIFIED", "c"))
+
+    assert (await events.get())["type"] == "SYNC"
+    assert (await events.get())["object"].metadata.name == "c"
+    assert events.stats()["dropped"] == 2
+
+
+@pytest.mark.asyncio
+async def test_put_waits_when_full():
+    events = EventBuffer(1)
+    await events.put(_event("MODIFIED", "a"))
+    # Events of a buffered object do not need room
+    await asyncio.wait_for(events.put(_event("MODIFIED", "a")), timeout=1)
+
+    put = asyncio.create_task(events.put(_event("MODIFIED", "b")))
+    await asyncio.sleep(0.01)
+    assert not put.done()
+
+    await events.get()
+    await asyncio.wait_for(put, timeout=1)
+    assert events.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_get_batch():
+    events = EventBuffer(10)
+    for name in "abc":
+        await events.put(_event("MODIFIED", name))
+
+    batch = await events.get_batch(2)
+
+    assert [event["object"].metadata.name for event in batch] == ["a", "b"]
+    assert len(await events.get_batch(2)) == 1
+    assert events.qsize() == 0
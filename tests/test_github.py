@@ -1,7 +1,11 @@
+import asyncio
 import json
+import time
+from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 
+from config import settings
 from gestor.schemas.git import GitInfo
 from gestor.utils import github
 
@@ -121,3 +125,222 @@ async def test_commit_not_exists(mocker):
 async def test__github_request():
     with pytest.raises(github.InvalidGitHubUrl):
         await github._github_request("/test-invalid-url")
+
+
+class FakeResponse:
+    def __init__(self, status, headers=None, data=None):
+        self.status = status
+        self.headers = headers or {}
+        self._data = data
+
+    async def json(self, content_type=None):
+        if self._data is None:
+            raise ValueError("Empty body")
+        return self._data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, path, **kwargs):
+        self.requests.append((method, path, kwargs))
+        return self.responses.pop(0)
+
+
+def _github_client(mocker, responses):
+    test_client = github.GitHubClient("secret")
+    session = FakeSession(responses)
+    mocker.patch.object(test_client, "_get_session", return_value=session)
+    return test_client, session
+
+
+@pytest.mark.asyncio
+async def test_client_tracks_rate_limit(mocker):
+    headers = {
+        "X-RateLimit-Limit": "5000",
+        "X-RateLimit-Remaining": "4999",
+        "X-RateLimit-Reset": "2000000000",
+    }
+    test_client, _ = _github_client(mocker, [FakeResponse(200, headers, {})])
+
+    response = await test_client.request("GET", "/test")
+
+    assert response.status == 200
+    assert test_client.stats()["remaining"] == 4999
+
+
+@pytest.mark.asyncio
+async def test_client_sheds_low_priority_requests(mocker):
+    test_client, session = _github_client(mocker, [])
+    test_client._remaining = 10
+    test_client._reset = time.time() + 3600
+
+    with pytest.raises(github.RateLimitExceeded):
+        await test_client.request("GET", "/test", priority=github.Priority.low)
+    assert session.requests == []
+    assert test_client.stats()["shed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_client_reserve_kept_for_high_priority(mocker):
+    test_client, session = _github_client(mocker, [FakeResponse(200, data={})])
+    test_client._remaining = 10
+    test_client._reset = time.time() + 3600
+
+    await test_client.request("GET", "/test", priority=github.Priority.high)
+    assert len(session.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_client_retries_secondary_rate_limit(mocker):
+    test_client, session = _github_client(
+        mocker,
+        [
+            FakeResponse(403, {"Retry-After": "0"}, {"message": "secondary"}),
+            FakeResponse(200, data={"ok": True}),
+        ],
+    )
+    mocker.patch("asyncio.sleep", AsyncMock())
+
+    response = await test_client.request("GET", "/test")
+
+    assert response.data == {"ok": True}
+    assert len(session.requests) == 2
+    assert test_client.stats()["retries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_client_does_not_retry_primary_rate_limit(mocker):
+    headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "0"}
+    test_client, session = _github_client(mocker, [FakeResponse(403, headers)])
+
+    response = await test_client.request("GET", "/test")
+
+    assert response.status == 403
+    assert len(session.requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_github_request_cached(mocker):
+    github.cache.clear()
+    request = mocker.patch.object(
+        github.client,
+        "request",
+        AsyncMock(return_value=github.GitHubResponse(200, {"ETag": '"a"'}, {})),
+    )
+
+    assert await github._github_request("/test") == {}
+    assert await github._github_request("/test") == {}
+    request.assert_called_once()
+    assert github.cache.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_github_request_revalidated(mocker):
+    github.cache.clear()
+    mocker.patch.object(github.cache, "_ttl", 0)
+    github.cache.store("/test", '"a"', {"cached": True})
+    request = mocker.patch.object(
+        github.client,
+        "request",
+        AsyncMock(return_value=github.GitHubResponse(304, {}, None)),
+    )
+
+    assert await github._github_request("/test") == {"cached": True}
+    assert request.call_args.kwargs["headers"] == {"If-None-Match": '"a"'}
+    assert github.cache.revalidated >= 1
+
+
+@pytest.mark.asyncio
+async def test_commit_exists_cached_for_sha(mocker):
+    github.cache.clear()
+    sha = "0123456789abcdef0123456789abcdef01234567"
+    request = mocker.patch(
+        "gestor.utils.github._github_request", return_value=test_response_branch
+    )
+
+    await github.commit_exists("Som-Energia/test", sha)
+    await github.commit_exists("Som-Energia/test", sha)
+    await github.commit_exists("Som-Energia/test", "testtest")
+    await github.commit_exists("Som-Energia/test", "testtest")
+    assert request.call_count == 3
+
+
+def _status(commit, state):
+    return github.CommitStatus(
+        "gtest", "Som-Energia/test", commit, "Test", github.GitHubStatusState(state)
+    )
+
+
+@pytest.mark.asyncio
+async def test_status_publisher_coalesces(mocker):
+    set_commit_status = mocker.patch(
+        "gestor.utils.github.set_commit_status", AsyncMock()
+    )
+    publisher = github.StatusPublisher(2)
+    publisher.publish(_status("a", "pending"))
+    publisher.publish(_status("a", "success"))
+    publisher.publish(_status("b", "pending"))
+
+    tasks = publisher.start()
+    await asyncio.sleep(0.01)
+    for task in tasks:
+        task.cancel()
+
+    assert set_commit_status.call_count == 2
+    assert set(call.args[4] for call in set_commit_status.call_args_list) == {
+        "success",
+        "pending",
+    }
+    assert publisher.stats()["coalesced"] == 1
+
+
+@pytest.mark.asyncio
+async def test_status_publisher_keeps_commit_order(mocker):
+    posted = []
+    release = asyncio.Event()
+
+    async def set_commit_status(
+        name, repository, commit, description, state, target_url=None
+    ):
+        await release.wait()
+        posted.append(state)
+
+    mocker.patch("gestor.utils.github.set_commit_status", set_commit_status)
+    publisher = github.StatusPublisher(2)
+    tasks = publisher.start()
+    publisher.publish(_status("a", "pending"))
+    await asyncio.sleep(0)
+    publisher.publish(_status("a", "success"))
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.sleep(0.01)
+    for task in tasks:
+        task.cancel()
+
+    assert posted == ["pending", "success"]
+
+
+@pytest.mark.asyncio
+async def test_set_commit_status_target_url(mocker):
+    request = mocker.patch.object(
+        github.client, "request", AsyncMock(return_value=MagicMock(status=201))
+    )
+
+    await github.set_commit_status("gtest", "Som-Energia/test", "a", "Test", "success")
+    assert request.call_args.kwargs["json"]["target_url"] == (
+        "https://%s?name=gtest" % settings.DEPLOY_DOMAIN
+    )
+
+    await github.set_commit_status(
+        "gtest", "Som-Energia/test", "a", "Test", "success", "https://gtest.test"
+    )
+    assert request.call_args.kwargs["json"]["target_url"] == "https://gtest.test"
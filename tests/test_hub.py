@@ -0,0 +1,78 @@
+import pytest
+
+from gestor.utils.hub import RESYNC, EventHub, format_message
+
+
+def test_format_message():
+    assert format_message("e-1", "added", {"name": "a"}) == (
+        b'id: e-1\nevent: added\ndata: {"name":"a"}\n\n'
+    )
+
+
+@pytest.mark.asyncio
+async def test_subscribe_starts_with_resync():
+    hub = EventHub(buffer_size=10, history_size=10)
+    subscription = hub.subscribe()
+    # Part of the snapshot sent on RESYNC
+    hub.publish("added", {"name": "a"})
+
+    assert await subscription.get() == RESYNC
+    hub.publish("added", {"name": "b"})
+    assert b'"b"' in await subscription.get()
+    assert hub.stats()["subscribers"] == 1
+
+
+@pytest.mark.asyncio
+async def test_subscribe_resumes_from_last_event_id():
+    hub = EventHub(buffer_size=10, history_size=10)
+    hub.publish("added", {"name": "a"})
+    last_event_id = hub.last_event_id
+    hub.publish("modified", {"name": "a"})
+    hub.publish("ready", {"name": "a"})
+
+    subscription = hub.subscribe(last_event_id)
+
+    assert b"event: modified" in await subscription.get()
+    assert b"event: ready" in await subscription.get()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_unknown_event_id_resyncs():
+    hub = EventHub(buffer_size=10, history_size=1)
+    hub.publish("added", {"name": "a"})
+    last_event_id = hub.last_event_id
+    hub.publish("added", {"name": "b"})
+    hub.publish("added", {"name": "c"})
+
+    # Out of the history, from another process and invalid
+    for event_id in (last_event_id, "other-3", "garbage"):
+        assert await hub.subscribe(event_id).get() == RESYNC
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_dropped_to_resync():
+    hub = EventHub(buffer_size=2, history_size=10)
+    subscription = hub.subscribe(hub.last_event_id)
+
+    for name in "abc":
+        hub.publish("added", {"name": name})
+    hub.publish("deleted", {"name": "a"})
+
+    assert await subscription.get() == RESYNC
+    assert subscription.dropped == 2
+    hub.publish("deleted", {"name": "b"})
+    assert b"event: deleted" in await subscription.get()
+
+
+@pytest.mark.asyncio
+async def test_resync_all_subscribers():
+    hub = EventHub(buffer_size=10, history_size=10)
+    subscription = hub.subscribe(hub.last_event_id)
+    hub.publish("added", {"name": "a"})
+    last_event_id = hub.last_event_id
+
+    hub.resync()
+    hub.unsubscribe(subscription)
+
+    assert await subscription.get() == RESYNC
+    assert await hub.subscribe(last_event_id).get() == RESYNC
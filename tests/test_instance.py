@@ -4,9 +4,10 @@ from unittest.mock import MagicMock
 import pytest
 from kubernetes.client import V1Deployment, V1ObjectMeta, V1DeploymentStatus
 
+from config import settings
 from gestor.schemas.git import GitInfo
 from gestor.schemas.instance import Instance
-from gestor.utils import kubernetes
+from gestor.utils import manifests
 
 test_git_info = GitInfo(
     commit="testtest",
@@ -49,7 +50,7 @@ def test_default_factory_name():
 async def test_start_instance_kubernetes_exception(mocker):
     mocker.patch(
         "gestor.utils.kubernetes.start_deployment",
-        side_effect=kubernetes.TemplateRenderFailed("Exception"),
+        side_effect=manifests.TemplateRenderFailed("Exception"),
     )
     magic_method = MagicMock()
     mocker.patch("gestor.schemas.instance._logger.error", magic_method)
@@ -62,3 +63,12 @@ async def test_instance_from_deployment():
     instance_dict = await Instance.deployment_to_dict(test_deployment)
     instance = Instance.parse_obj(instance_dict)
     assert instance == test_instance
+
+
+def test_instance_url(mocker):
+    assert Instance(git_info=test_git_info).url is None
+
+    mocker.patch.object(settings, "EXPOSE_MODE", "ingress")
+    instance = Instance(git_info=test_git_info)
+    assert instance.url == "https://%s.%s" % (instance.name, settings.DEPLOY_DOMAIN)
+    assert instance.server_port == 8069
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from gestor.utils.jobs import JobCancelled, JobExecutor
+
+
+@pytest.mark.asyncio
+async def test_run_returns_result():
+    executor = JobExecutor(2)
+
+    async def job(value):
+        return value
+
+    assert await executor.run("test", job, 1) == 1
+    assert executor.stats()["completed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_run_failed_job():
+    executor = JobExecutor(2)
+
+    async def job():
+        raise ValueError("Exception")
+
+    with pytest.raises(ValueError):
+        await executor.run("test", job)
+    assert executor.stats()["failed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit():
+    executor = JobExecutor(2)
+    release = asyncio.Event()
+
+    async def job():
+        await release.wait()
+
+    tasks = [asyncio.create_task(executor.run(str(i), job)) for i in range(5)]
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    stats = executor.stats()
+    assert stats["running"] == 2
+    assert stats["queued"] == 3
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert executor.stats()["completed"] == 5
+
+
+@pytest.mark.asyncio
+async def test_cancel_job():
+    executor = JobExecutor(1)
+
+    async def job():
+        await asyncio.Event().wait()
+
+    task = asyncio.create_task(executor.run("test", job))
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert executor.cancel("test") == 1
+    with pytest.raises(JobCancelled):
+        await task
+    assert executor.stats()["cancelled"] == 1
+    assert executor.cancel("test") == 0
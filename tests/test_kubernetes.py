@@ -1,11 +1,18 @@
-import os
+import asyncio
+from unittest.mock import AsyncMock
 
 import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from kubernetes_asyncio import client
+from kubernetes_asyncio.client import ApiException
 
 from config import settings
 from gestor.schemas.git import GitInfo
 from gestor.schemas.instance import Instance
 from gestor.utils import kubernetes
+from gestor.utils.logs import LogCollector
 
 test_git_info = GitInfo(
     commit="testtest",
@@ -16,59 +23,381 @@ test_git_info = GitInfo(
 
 
 @pytest.mark.asyncio
-async def test__create_working_directory_ok():
+async def test_start_deployment_applies_rendered_objects(mocker):
     test_instance = Instance(git_info=test_git_info)
-    working_directory_path = await kubernetes._create_working_directory(
-        test_instance.name
-    )
-    expected_path = os.path.join(settings.TEMP_DIRECTORY_PATH, test_instance.name)
-    assert expected_path == working_directory_path
-    assert os.path.exists(working_directory_path)
+    data = {
+        "name": test_instance.name,
+        "domain": settings.DEPLOY_DOMAIN,
+        "labels": {},
+        **test_instance.git_info.dict(),
+    }
+    mocker.patch("gestor.utils.kubernetes.get_client", AsyncMock())
+    apply = mocker.patch("gestor.utils.kubernetes._apply", AsyncMock())
 
+    await kubernetes.start_deployment(test_instance.name, data)
 
-@pytest.mark.asyncio
-async def test__create_working_directory_no_tmp(mocker):
-    test_instance = Instance(git_info=test_git_info)
-    mocker.patch(
-        "os.path.exists",
-        return_value=False,
-    )
-    with pytest.raises(Exception):
-        await kubernetes._create_working_directory(test_instance.name)
+    kinds = [call.args[1]["kind"] for call in apply.call_args_list]
+    assert sorted(kinds) == ["ConfigMap", "Deployment", "Ingress", "Service"]
+    assert kinds[-1] == "Deployment"
 
 
 @pytest.mark.asyncio
-async def test__render_kubernetes_file_ok():
+async def test_start_deployment_missing_data(mocker):
     test_instance = Instance(git_info=test_git_info)
     data = {
         "name": test_instance.name,
-        "domain": settings.DEPLOY_DOMAIN,
         "labels": {},
         **test_instance.git_info.dict(),
     }
-    working_directory_path = await kubernetes._create_working_directory(
-        test_instance.name
+    apply = mocker.patch("gestor.utils.kubernetes._apply", AsyncMock())
+
+    with pytest.raises(Exception):
+        await kubernetes.start_deployment(test_instance.name, data)
+    apply.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_apply_server_side(mocker):
+    patch = mocker.patch.object(
+        client.AppsV1Api, "patch_namespaced_deployment", AsyncMock()
+    )
+    obj = {"kind": "Deployment", "metadata": {"name": "test-deployment"}}
+
+    async with client.ApiClient() as api:
+        await kubernetes._apply(api, obj)
+
+    kwargs = patch.call_args.kwargs
+    assert kwargs["name"] == "test-deployment"
+    assert kwargs["namespace"] == settings.KUBERNETES_NAMESPACE
+    assert kwargs["field_manager"] == kubernetes.FIELD_MANAGER
+    assert kwargs["force"] is True
+    assert kwargs["_content_type"] == "application/apply-patch+yaml"
+
+
+@pytest.mark.asyncio
+async def test_apply_unsupported_resource():
+    obj = {"kind": "Secret", "metadata": {"name": "test-secret"}}
+    async with client.ApiClient() as api:
+        with pytest.raises(kubernetes.UnsupportedResource):
+            await kubernetes._apply(api, obj)
+
+
+@pytest.mark.asyncio
+async def test_remove_deployment_by_label(mocker):
+    mocker.patch(
+        "gestor.utils.kubernetes.get_client",
+        AsyncMock(return_value=client.ApiClient()),
     )
+    deletes = [
+        mocker.patch.object(api_class, delete_method, AsyncMock())
+        for api_class, _, delete_method in kubernetes._RESOURCES.values()
+    ]
 
-    await kubernetes._render_kubernetes_file(working_directory_path, data)
-    expected_file_path = os.path.join(working_directory_path, "kustomization.yaml")
+    await kubernetes.remove_deployment("gtest")
 
-    assert os.path.isfile(expected_file_path)
+    for delete in deletes:
+        delete.assert_called_once_with(
+            namespace=settings.KUBERNETES_NAMESPACE,
+            label_selector="gestor/name=gtest",
+            propagation_policy="Background",
+        )
 
 
 @pytest.mark.asyncio
-async def test__render_kubernetes_file_missing_data():
+async def test_shared_client(mocker):
+    load_configuration = mocker.patch(
+        "gestor.utils.kubernetes._load_configuration",
+        AsyncMock(return_value=client.Configuration()),
+    )
+
+    api = await kubernetes.get_client()
+    assert await kubernetes.get_client() is api
+    load_configuration.assert_called_once()
+    assert kubernetes.client_stats()["in_use"] == 0
+    assert await kubernetes.get_client(kubernetes.LOGS_POOL) is not api
+
+    await kubernetes.close_client()
+    assert kubernetes.client_stats()["open"] is False
+
+
+class FakeWatch:
+    """Replays a list of events and then raises an exception"""
+
+    streams = []
+
+    def __init__(self):
+        self.resource_version = None
+        self.events, self.exception = FakeWatch.streams.pop(0)
+
+    def stream(self, func, **kwargs):
+        self.kwargs = kwargs
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.events:
+            event = self.events.pop(0)
+            self.resource_version = event["version"]
+            return event
+        raise self.exception
+
+
+def _list_response(version):
+    return client.V1DeploymentList(
+        items=[], metadata=client.V1ListMeta(resource_version=version)
+    )
+
+
+@pytest.mark.asyncio
+async def test_informer_resumes_and_relists(mocker):
+    mocker.patch("gestor.utils.kubernetes.get_client", AsyncMock())
+    list_deployments = mocker.patch.object(
+        client.AppsV1Api,
+        "list_namespaced_deployment",
+        AsyncMock(side_effect=[_list_response("1"), _list_response("10")]),
+    )
+    mocker.patch("gestor.utils.kubernetes.watch.Watch", FakeWatch)
+    FakeWatch.streams = [
+        ([{"type": "ADDED", "version": "2"}], StopAsyncIteration()),
+        ([{"type": "BOOKMARK", "version": "5"}], client.ApiException(status=410)),
+        ([], asyncio.CancelledError()),
+    ]
+    event_queue = asyncio.Queue()
+
+    informer = kubernetes.DeploymentInformer()
+    with pytest.raises(asyncio.CancelledError):
+        await informer.run(event_queue)
+
+    events = [event_queue.get_nowait()["type"] for _ in range(event_queue.qsize())]
+    assert events == ["SYNC", "ADDED", "SYNC"]
+    assert list_deployments.call_count == 2
+    assert informer.resource_version == "10"
+
+
+@pytest.mark.asyncio
+async def test_informer_backoff(mocker):
+    mocker.patch(
+        "gestor.utils.kubernetes.get_client",
+        AsyncMock(side_effect=[Exception("Exception"), asyncio.CancelledError()]),
+    )
+    sleep = mocker.patch("asyncio.sleep", AsyncMock())
+
+    with pytest.raises(asyncio.CancelledError):
+        await kubernetes.DeploymentInformer().run(asyncio.Queue())
+    sleep.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_informer_backoff_empty_watch(mocker):
+    mocker.patch("gestor.utils.kubernetes.get_client", AsyncMock())
+    mocker.patch.object(
+        client.AppsV1Api,
+        "list_namespaced_deployment",
+        AsyncMock(return_value=_list_response("1")),
+    )
+    mocker.patch("gestor.utils.kubernetes.watch.Watch", FakeWatch)
+    FakeWatch.streams = [
+        ([], StopAsyncIteration()),
+        ([], StopAsyncIteration()),
+        ([], asyncio.CancelledError()),
+    ]
+    sleep = mocker.patch("asyncio.sleep", AsyncMock())
+
+    with pytest.raises(asyncio.CancelledError):
+        await kubernetes.DeploymentInformer().run(asyncio.Queue())
+
+    delays = [call.args[0] for call in sleep.call_args_list]
+    assert len(delays) == 2
+    # The delay grows as the empty watches go on
+    assert delays[0] <= delays[1]
+
+
+def test_backoff_delay():
+    for failures in range(20):
+        delay = kubernetes._backoff_delay(failures)
+        assert 0 < delay <= kubernetes.WATCH_BACKOFF_MAX
+    assert kubernetes._backoff_delay(20) >= kubernetes.WATCH_BACKOFF_MAX / 2
+
+
+class FakeLogResponse:
+    def __init__(self, chunks, status=200):
+        self.content = self
+        self._chunks = chunks
+        self.status = status
+        self.reason = "Bad Request" if status == 400 else "OK"
+        self.headers = {}
+        self.released = False
+
+    async def read(self):
+        return b"".join(self._chunks)
+
+    async def iter_any(self):
+        for chunk in self._chunks:
+            yield chunk
+
+    def release(self):
+        self.released = True
+
+
+@pytest.mark.asyncio
+async def test_pod_logs_streams_chunks(mocker):
+    mocker.patch("gestor.utils.kubernetes.get_client", AsyncMock())
+    pod = client.V1Pod(metadata=client.V1ObjectMeta(name="test-pod"))
+    mocker.patch.object(
+        client.CoreV1Api,
+        "list_namespaced_pod",
+        AsyncMock(return_value=client.V1PodList(items=[pod])),
+    )
+    response = FakeLogResponse([b"first\n", b"second\n"])
+    read_log = mocker.patch.object(
+        client.CoreV1Api, "read_namespaced_pod_log", AsyncMock(return_value=response)
+    )
+
+    chunks = await kubernetes.pod_logs("test", tail_lines=10, follow=True)
+
+    assert [chunk async for chunk in chunks] == [b"first\n", b"second\n"]
+    assert response.released
+    kwargs = read_log.call_args.kwargs
+    assert kwargs["name"] == "test-pod"
+    assert kwargs["tail_lines"] == 10
+    assert kwargs["follow"] is True
+    assert kwargs["_preload_content"] is False
+    assert kwargs["_request_timeout"].total is None
+
+
+@pytest.mark.asyncio
+async def test_pod_logs_pod_not_found(mocker):
+    mocker.patch("gestor.utils.kubernetes.get_client", AsyncMock())
+    mocker.patch.object(
+        client.CoreV1Api,
+        "list_namespaced_pod",
+        AsyncMock(return_value=client.V1PodList(items=[])),
+    )
+    read_log = mocker.patch.object(
+        client.CoreV1Api, "read_namespaced_pod_log", AsyncMock()
+    )
+
+    with pytest.raises(kubernetes.PodNotFound):
+        await kubernetes.pod_logs("test")
+    read_log.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_pod_logs_error_status(mocker):
+    mocker.patch("gestor.utils.kubernetes.get_client", AsyncMock())
+    pod = client.V1Pod(metadata=client.V1ObjectMeta(name="test-pod"))
+    mocker.patch.object(
+        client.CoreV1Api,
+        "list_namespaced_pod",
+        AsyncMock(return_value=client.V1PodList(items=[pod])),
+    )
+    response = FakeLogResponse([b"container is waiting to start"], status=400)
+    mocker.patch.object(
+        client.CoreV1Api, "read_namespaced_pod_log", AsyncMock(return_value=response)
+    )
+
+    with pytest.raises(ApiException) as error:
+        await kubernetes.pod_logs("test")
+    read_log = client.CoreV1Api.read_namespaced_pod_log
+    assert "_request_timeout" not in read_log.call_args.kwargs
+
+    assert error.value.status == 400
+    assert error.value.body == b"container is waiting to start"
+    assert response.released
+
+
+@pytest_asyncio.fixture
+async def api_server(mocker):
+    """Kubernetes API serving a pod whose log is followed until teardown
+
+    Yields the list of the open log streams.
+    """
+    streams = []
+    stopped = asyncio.Event()
+
+    async def list_pods(request):
+        return web.json_response({"items": [{"metadata": {"name": "test-pod"}}]})
+
+    async def follow_log(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        streams.append(response)
+        await stopped.wait()
+        return response
+
+    async def apply(request):
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_get("/api/v1/namespaces/{namespace}/pods", list_pods)
+    app.router.add_get("/api/v1/namespaces/{namespace}/pods/{pod}/log", follow_log)
+    app.router.add_patch("/{path:.*}", apply)
+    server = TestServer(app)
+    await server.start_server()
+
+    async def load_configuration(pool_size):
+        configuration = client.Configuration(host=str(server.make_url("")))
+        configuration.connection_pool_maxsize = pool_size
+        return configuration
+
+    mocker.patch("gestor.utils.kubernetes._load_configuration", load_configuration)
+    mocker.patch.object(settings, "KUBERNETES_CONNECTION_POOL_SIZE", 2)
+    try:
+        yield streams
+    finally:
+        stopped.set()
+        await kubernetes.close_client()
+        await server.close()
+
+
+def _deployment_data() -> dict:
     test_instance = Instance(git_info=test_git_info)
-    data = {
+    return {
         "name": test_instance.name,
+        "domain": settings.DEPLOY_DOMAIN,
         "labels": {},
         **test_instance.git_info.dict(),
     }
-    working_directory_path = await kubernetes._create_working_directory(
-        test_instance.name
-    )
 
-    with pytest.raises(Exception):
-        await kubernetes._render_kubernetes_file(working_directory_path, data)
-    expected_file_path = os.path.join(working_directory_path, "kustomization.yaml")
-    assert not os.path.isfile(expected_file_path)
+
+@pytest.mark.asyncio
+async def test_followed_logs_do_not_block_deployments(mocker, api_server):
+    mocker.patch.object(settings, "LOG_BUFFER_MAX_INSTANCES", 2)
+    collector = LogCollector(10, ["erpserver"], 2)
+    data = _deployment_data()
+    try:
+        for name in ("test-1", "test-2", "test-3"):
+            collector.watch(name)
+        while len(api_server) < 2:
+            await asyncio.sleep(0.01)
+        assert collector.stats()["waiting"] == 1
+
+        await asyncio.wait_for(
+            kubernetes.start_deployment(data["name"], data), timeout=5
+        )
+        assert kubernetes.client_stats(kubernetes.LOGS_POOL)["in_use"] == 2
+    finally:
+        await collector.stop()
+
+
+@pytest.mark.asyncio
+async def test_followed_logs_are_capped(mocker, api_server):
+    mocker.patch.object(settings, "LOG_FOLLOW_MAX_STREAMS", 2)
+    data = _deployment_data()
+    streams = [await kubernetes.pod_logs("test", follow=True) for _ in range(2)]
+
+    with pytest.raises(kubernetes.TooManyStreams):
+        await kubernetes.pod_logs("test", follow=True)
+    await asyncio.wait_for(kubernetes.start_deployment(data["name"], data), timeout=5)
+    assert kubernetes.client_stats()["in_use"] == 0
+
+    await streams[0].aclose()
+    await streams[1].aclose()
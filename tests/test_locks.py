@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from gestor.utils.locks import KeyedLock, Superseded
+
+
+@pytest.mark.asyncio
+async def test_same_key_serialized():
+    lock = KeyedLock()
+    running = []
+
+    async def operation(key, value):
+        async with lock.acquire(key):
+            running.append(value)
+            assert running.count(value) == 1
+            await asyncio.sleep(0.01)
+            running.remove(value)
+
+    await asyncio.gather(*(operation("key", "same") for _ in range(3)))
+    assert len(lock) == 0
+
+
+@pytest.mark.asyncio
+async def test_different_keys_concurrent():
+    lock = KeyedLock()
+    both_running = asyncio.Event()
+    running = set()
+
+    async def operation(key):
+        async with lock.acquire(key):
+            running.add(key)
+            if len(running) == 2:
+                both_running.set()
+            await asyncio.wait_for(both_running.wait(), timeout=1)
+
+    await asyncio.gather(operation("a"), operation("b"))
+
+
+@pytest.mark.asyncio
+async def test_waiting_operation_superseded():
+    lock = KeyedLock()
+    done = []
+
+    async def operation(value):
+        async with lock.acquire("key", supersede=True):
+            await asyncio.sleep(0.01)
+            done.append(value)
+
+    results = await asyncio.gather(
+        operation(1), operation(2), operation(3), return_exceptions=True
+    )
+
+    assert done == [1, 3]
+    assert isinstance(results[1], Superseded)
+    assert lock.superseded == 1
@@ -0,0 +1,122 @@
+import asyncio
+import datetime
+import re
+from unittest.mock import AsyncMock
+
+import pytest
+
+from gestor.utils import logs
+from gestor.utils.logs import LogCollector, LogLine, parse_line, search
+
+UTC = datetime.timezone.utc
+
+
+def _line(second: int, text: str, container: str = "erpserver") -> LogLine:
+    return LogLine(
+        datetime.datetime(2023, 3, 1, 10, 0, second, tzinfo=UTC), container, text
+    )
+
+
+async def _chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_parse_line():
+    line = parse_line("erpserver", b"2023-03-01T10:00:00.123456789Z Traceback\r")
+
+    assert line.timestamp == datetime.datetime(2023, 3, 1, 10, 0, 0, 123456, UTC)
+    assert line.container == "erpserver"
+    assert line.text == "Traceback"
+    assert parse_line("redis", b"no timestamp").text == "no timestamp"
+
+
+def test_search():
+    lines = [
+        _line(1, "INFO start"),
+        _line(2, "Traceback (most recent call last):"),
+        _line(3, "ready", "redis"),
+        _line(4, "traceback again"),
+    ]
+
+    assert search(lines, re.compile("Traceback")) == [lines[1]]
+    assert search(lines, re.compile("traceback", re.I), limit=1) == [lines[3]]
+    assert search(lines, container="redis") == [lines[2]]
+    assert (
+        search(
+            lines,
+            since=datetime.datetime(2023, 3, 1, 10, 0, 2),
+            until=datetime.datetime(2023, 3, 1, 10, 0, 3),
+        )
+        == lines[1:3]
+    )
+
+
+@pytest.mark.asyncio
+async def test_collector_follows_lines(mocker):
+    pod_logs = mocker.patch(
+        "gestor.utils.kubernetes.pod_logs",
+        AsyncMock(
+            side_effect=[
+                _chunks(
+                    b"2023-03-01T10:00:01Z first\n2023-03-01T10:00:02Z sec",
+                    b"ond\n",
+                ),
+                # Reconnected, the lines already buffered come again
+                _chunks(b"2023-03-01T10:00:02Z second\n2023-03-01T10:00:03Z third\n"),
+            ]
+        ),
+    )
+    mocker.patch.object(logs, "RETRY_DELAY", 0)
+    collector = LogCollector(2, ["erpserver"], 10)
+
+    collector.watch("test")
+    collector.watch("test")
+    while collector.reconnects < 2:
+        await asyncio.sleep(0)
+
+    assert [line.text for line in collector.lines("test")] == ["second", "third"]
+    assert pod_logs.call_args_list[0].kwargs["tail_lines"] == 2
+    assert pod_logs.call_args_list[1].kwargs["since_seconds"] >= 1
+    assert collector.stats()["streams"] == 1
+
+    collector.unwatch("test")
+    assert not collector.is_watched("test")
+    assert collector.lines("test") == []
+    await collector.stop()
+
+
+@pytest.mark.asyncio
+async def test_collector_disabled():
+    collector = LogCollector(0, ["erpserver"], 10)
+
+    collector.watch("test")
+
+    assert not collector.is_watched("test")
+    assert collector.stats()["streams"] == 0
+
+
+@pytest.mark.asyncio
+async def test_collector_max_instances(mocker):
+    mocker.patch(
+        "gestor.utils.kubernetes.pod_logs",
+        AsyncMock(side_effect=lambda *args, **kwargs: _chunks()),
+    )
+    collector = LogCollector(2, ["erpserver"], 2)
+
+    for name in ("test-1", "test-2", "test-3", "test-4"):
+        collector.watch(name)
+    assert not collector.is_watched("test-3")
+    assert collector.stats()["waiting"] == 2
+
+    collector.unwatch("test-1")
+    assert collector.is_watched("test-3")
+    collector.retain({"test-2", "test-3"})
+    assert collector.stats() == {
+        "instances": 2,
+        "lines": 0,
+        "waiting": 0,
+        "streams": 2,
+        "reconnects": 0,
+    }
+    await collector.stop()
@@ -1,9 +1,37 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import pytest
 from fastapi.testclient import TestClient
 
+from gestor import manager
 from gestor.main import app
+from gestor.models.store import MemoryInstanceStore
+from gestor.schemas.git import GitInfo
+from gestor.schemas.instance import Instance
+from gestor.utils import kubernetes
+from gestor.utils.logs import LogCollector, parse_line
+from gestor.utils.responses import BodyCache
+from gestor.routers import api
 
 client = TestClient(app)
 
+test_git_info = GitInfo(
+    commit="testtest",
+    pull_request=1,
+    branch="TEST_branch",
+    repository="Som-Energia/openerp_som_addons",
+)
+
+
+@pytest.fixture
+def store(mocker) -> MemoryInstanceStore:
+    """Empty store used by the API, with an empty response cache"""
+    store = MemoryInstanceStore()
+    mocker.patch.object(manager.manager, "store", store)
+    mocker.patch.object(api, "bodies", BodyCache())
+    return store
+
 
 def test_health_main() -> None:
     response = client.get("/")
@@ -18,3 +46,157 @@ def test_health_api() -> None:
 def test_health_webhooks() -> None:
     response = client.get("/webhooks")
     assert 200 == response.status_code
+
+
+def test_read_instances() -> None:
+    response = client.get("/api/instances/")
+    assert 200 == response.status_code
+    assert isinstance(response.json(), list)
+
+
+def test_read_instances_not_modified() -> None:
+    response = client.get("/api/instances/")
+    etag = response.headers["etag"]
+
+    response = client.get("/api/instances/", headers={"If-None-Match": etag})
+    assert 304 == response.status_code
+
+    # Rebuilt after a write, with the same ETag while the content is the same
+    misses = api.bodies.misses
+    manager.manager.store.version += 1
+    response = client.get("/api/instances/", headers={"If-None-Match": etag})
+    assert 304 == response.status_code
+    assert api.bodies.misses == misses + 1
+
+
+def test_read_instance_not_found() -> None:
+    response = client.get("/api/instances/missing")
+    assert 404 == response.status_code
+
+
+def test_read_instances_pages(store) -> None:
+    instances = [Instance(git_info=test_git_info) for _ in range(3)]
+    asyncio.run(store.write_instances(instances))
+    names = sorted(instance.name for instance in instances)
+
+    response = client.get("/api/instances/?limit=2&fields=name,is_ready")
+    assert response.json() == [{"name": name, "is_ready": False} for name in names[:2]]
+    next_url = response.links["next"]["url"]
+
+    response = client.get(next_url)
+    assert [instance["name"] for instance in response.json()] == names[2:]
+    assert "next" not in response.links
+
+
+def test_read_instances_invalid_query() -> None:
+    assert 400 == client.get("/api/instances/?fields=password").status_code
+    assert 400 == client.get("/api/instances/?cursor=%25").status_code
+    assert 422 == client.get("/api/instances/?limit=0").status_code
+
+
+@pytest.mark.asyncio
+async def test_instance_events_stream(store) -> None:
+    instance = Instance(git_info=test_git_info)
+    await store.write_instances([instance])
+    subscription = manager.manager.feed.subscribe()
+    stream = api._stream_events(subscription)
+
+    snapshot = await anext(stream)
+    manager.manager.feed.publish("deleted", instance)
+    deleted = await anext(stream)
+    await stream.aclose()
+
+    assert b"event: snapshot" in snapshot
+    assert instance.name.encode() in snapshot
+    assert b"event: deleted" in deleted
+    assert manager.manager.feed.stats()["subscribers"] == 0
+
+
+async def _log_chunks():
+    yield b"first\n"
+    yield b"second\n"
+
+
+@pytest.mark.asyncio
+async def test_read_instance_logs(mocker, store) -> None:
+    instance = Instance(git_info=test_git_info)
+    await store.write_instances([instance])
+    pod_logs = mocker.patch(
+        "gestor.utils.kubernetes.pod_logs",
+        AsyncMock(side_effect=lambda *args, **kwargs: _log_chunks()),
+    )
+    url = "/api/instances/%s/logs" % instance.name
+
+    response = client.get(url + "?tail=10", headers={"Accept-Encoding": "gzip"})
+    assert 200 == response.status_code
+    assert response.headers["content-type"] == "text/plain; charset=utf-8"
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text == "first\nsecond\n"
+    assert pod_logs.call_args.kwargs["tail_lines"] == 10
+
+    response = client.get(url + "?follow=true", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.content == b"first\nsecond\n"
+    assert pod_logs.call_args.kwargs["follow"] is True
+
+    assert 422 == client.get(url + "?since=0").status_code
+
+
+@pytest.mark.asyncio
+async def test_read_instance_logs_pod_not_found(mocker, store) -> None:
+    instance = Instance(git_info=test_git_info)
+    await store.write_instances([instance])
+    mocker.patch(
+        "gestor.utils.kubernetes.pod_logs",
+        AsyncMock(side_effect=kubernetes.PodNotFound("Pod not found in the cluster")),
+    )
+
+    response = client.get("/api/instances/%s/logs" % instance.name)
+    assert 404 == response.status_code
+    assert 404 == client.get("/api/instances/missing/logs").status_code
+
+
+@pytest.mark.asyncio
+async def test_read_instance_logs_too_many_streams(mocker, store) -> None:
+    instance = Instance(git_info=test_git_info)
+    await store.write_instances([instance])
+    mocker.patch(
+        "gestor.utils.kubernetes.pod_logs",
+        AsyncMock(side_effect=kubernetes.TooManyStreams("Too many")),
+    )
+
+    response = client.get("/api/instances/%s/logs?follow=true" % instance.name)
+    assert 503 == response.status_code
+
+
+def test_search_instance_logs(mocker) -> None:
+    collector = LogCollector(10, ["erpserver"], 10)
+    mocker.patch.object(manager.manager, "logs", collector)
+    mocker.patch.object(collector, "is_watched", return_value=True)
+    mocker.patch.object(
+        collector,
+        "lines",
+        return_value=[
+            parse_line("erpserver", b"2023-03-01T10:00:01Z INFO start"),
+            parse_line("erpserver", b"2023-03-01T10:00:02Z Traceback"),
+        ],
+    )
+    url = "/api/instances/test/logs/search"
+
+    response = client.get(url, params={"pattern": "traceback", "ignore_case": True})
+    assert 200 == response.status_code
+    assert response.json() == [
+        {
+            "timestamp": "2023-03-01T10:00:02+00:00",
+            "container": "erpserver",
+            "text": "Traceback",
+        }
+    ]
+    response = client.get(url, params={"since": "2023-03-01T10:00:02"})
+    assert len(response.json()) == 1
+    assert 400 == client.get(url, params={"pattern": "("}).status_code
+
+
+def test_search_instance_logs_not_collected() -> None:
+    response = client.get("/api/instances/missing/logs/search")
+    assert 404 == response.status_code
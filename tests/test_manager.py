@@ -1,14 +1,15 @@
+import asyncio
 from unittest.mock import AsyncMock
 
 import pytest
 from kubernetes.client import V1ObjectMeta, V1Deployment, V1DeploymentStatus
 
+from config import settings
 from gestor import manager
-from gestor.models.instance import InstanceModel
 from gestor.schemas.git import GitInfo
 from gestor.schemas.instance import Instance
 from gestor.utils import github
-from gestor.utils.database import Base, SessionLocal, engine
+from gestor.utils.database import create_tables
 
 test_git_info = GitInfo(
     commit="testtest",
@@ -63,13 +64,12 @@ test_deployment = V1Deployment(
     ),
 )
 
-db = SessionLocal()
+store = manager.manager.store
 
 
 @pytest.mark.asyncio
 async def test_create_instance_from_pull_request(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
 
     mocker.patch(
         "gestor.utils.github.get_pull_request_info",
@@ -86,8 +86,7 @@ async def test_create_instance_from_pull_request(mocker):
 
 @pytest.mark.asyncio
 async def test_create_instance_from_pull_request_not_allowed(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
 
     mocker.patch(
         "gestor.utils.github.get_pull_request_info",
@@ -105,15 +104,14 @@ async def test_create_instance_from_pull_request_existing(mocker):
         return_value=test_git_info,
     )
 
-    InstanceModel.create_instance(db, Instance(git_info=test_git_info))
+    await store.create_instance(Instance(git_info=test_git_info))
     with pytest.raises(Exception) as e:
         await manager.manager.start_instance_from_pull_request("Som-Energia/fail", 1)
 
 
 @pytest.mark.asyncio
 async def test_create_instance_from_pull_request_github_fail(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
 
     mocker.patch(
         "gestor.utils.github.get_pull_request_info",
@@ -128,8 +126,7 @@ async def test_create_instance_from_pull_request_github_fail(mocker):
 
 @pytest.mark.asyncio
 async def test_create_instance_from_webhook(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
 
     mocker.patch(
         "gestor.utils.github.get_pull_request_info",
@@ -144,8 +141,7 @@ async def test_create_instance_from_webhook(mocker):
 
 @pytest.mark.asyncio
 async def test_create_instance_from_webhook_not_allowed(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
 
     mocker.patch(
         "gestor.utils.github.get_pull_request_info",
@@ -165,7 +161,7 @@ async def test_create_instance_from_webhook_existing(mocker):
         return_value=test_git_info,
     )
 
-    InstanceModel.create_instance(db, Instance(git_info=test_git_info))
+    await store.create_instance(Instance(git_info=test_git_info))
     magic_method = AsyncMock()
     mocker.patch("gestor.schemas.instance.Instance.deploy", magic_method)
     await manager.manager.start_instance_from_webhook(test_git_info)
@@ -179,7 +175,7 @@ async def test_create_instance_from_webhook_limit(mocker):
         return_value=test_git_info_3,
     )
 
-    InstanceModel.create_instance(db, Instance(git_info=test_git_info_2))
+    await store.create_instance(Instance(git_info=test_git_info_2))
     magic_method_deploy = AsyncMock()
     mocker.patch("gestor.schemas.instance.Instance.deploy", magic_method_deploy)
     magic_method_undeploy = AsyncMock()
@@ -191,7 +187,7 @@ async def test_create_instance_from_webhook_limit(mocker):
 
 @pytest.mark.asyncio
 async def test_start_instance_limit():
-    InstanceModel.create_instance(db, Instance(git_info=test_git_info_2))
+    await store.create_instance(Instance(git_info=test_git_info_2))
     with pytest.raises(Exception) as e:
         await manager.manager.start_instance(Instance(git_info=test_git_info_3))
 
@@ -224,8 +220,7 @@ async def test_create_instance_from_branch_not_allowed(mocker):
 
 @pytest.mark.asyncio
 async def test_create_instance_from_branch_github_fail(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
 
     mocker.patch(
         "gestor.utils.github.get_branch_info",
@@ -269,8 +264,7 @@ async def test_create_instance_from_commit_not_allowed(mocker):
 
 @pytest.mark.asyncio
 async def test_create_instance_from_commit_github_fail(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
 
     mocker.patch(
         "gestor.utils.github.get_pull_request_info",
@@ -285,14 +279,220 @@ async def test_create_instance_from_commit_github_fail(mocker):
 
 @pytest.mark.asyncio
 async def test_init_db_from_cluster(mocker):
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
+    await create_tables(drop=True)
     mocker.patch(
         "gestor.utils.kubernetes.cluster_deployments",
         return_value=[test_deployment],
     )
-    assert len(InstanceModel.get_instances(db)) == 0
+    assert len(await store.get_instances()) == 0
     await manager.manager.init_db_from_cluster()
-    db_instances = InstanceModel.get_instances(db)
+    db_instances = await store.get_instances()
     assert len(db_instances) == 1
     assert Instance.from_orm(db_instances[0]) == test_instance
+
+
+def test_update_commit_status(mocker):
+    publish = mocker.patch("gestor.manager.publisher.publish")
+    instance = Instance(git_info=test_git_info, is_ready=True)
+
+    manager.manager.update_commit_status(instance, "MODIFIED")
+
+    status = publish.call_args.args[0]
+    assert status.commit == test_git_info.commit
+    assert status.state == github.GitHubStatusState.success
+    assert status.target_url is None
+
+
+def test_update_commit_status_ingress(mocker):
+    publish = mocker.patch("gestor.manager.publisher.publish")
+    mocker.patch.object(settings, "EXPOSE_MODE", "ingress")
+    instance = Instance(git_info=test_git_info, is_ready=True)
+
+    manager.manager.update_commit_status(instance, "MODIFIED")
+
+    status = publish.call_args.args[0]
+    assert status.target_url == "https://%s.%s" % (
+        instance.name,
+        settings.DEPLOY_DOMAIN,
+    )
+
+
+def test_update_commit_status_not_ready_modified(mocker):
+    publish = mocker.patch("gestor.manager.publisher.publish")
+    instance = Instance(git_info=test_git_info, is_ready=False)
+
+    manager.manager.update_commit_status(instance, "MODIFIED")
+
+    publish.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_webhooks_same_branch(mocker):
+    await create_tables(drop=True)
+
+    magic_method_deploy = AsyncMock(return_value=True)
+    mocker.patch("gestor.schemas.instance.Instance.deploy", magic_method_deploy)
+    magic_method_undeploy = AsyncMock(return_value=True)
+    mocker.patch("gestor.schemas.instance.Instance.undeploy", magic_method_undeploy)
+
+    await asyncio.gather(
+        manager.manager.start_instance_from_webhook(test_git_info_2),
+        manager.manager.start_instance_from_webhook(test_git_info_2),
+        manager.manager.start_instance_from_webhook(test_git_info_3),
+    )
+
+    # The second webhook is superseded by the third one, which replaces the
+    # instance deployed by the first one
+    assert magic_method_deploy.call_count == 2
+    magic_method_undeploy.assert_called_once()
+    instances = await store.get_instances()
+    assert len(instances) == 1
+    assert instances[0].commit == test_git_info_3.commit
+
+
+@pytest.mark.asyncio
+async def test_init_db_from_cluster_removes_missing():
+    await create_tables(drop=True)
+    await store.create_instance(Instance(git_info=test_git_info_2))
+
+    await manager.manager.init_db_from_cluster([test_deployment])
+
+    assert [i.name for i in await store.get_instances()] == [test_instance.name]
+
+
+@pytest.mark.asyncio
+async def test_init_db_from_cluster_notifies_changes(mocker):
+    await create_tables(drop=True)
+    publish = mocker.patch("gestor.manager.publisher.publish")
+    watch = mocker.patch.object(manager.manager.logs, "watch")
+    feed = mocker.patch.object(manager.manager.feed, "publish")
+    removed = Instance(git_info=test_git_info_2)
+    await store.write_instances([test_instance, removed])
+    ready_deployment = V1Deployment(
+        metadata=test_deployment.metadata,
+        status=V1DeploymentStatus(replicas=1, ready_replicas=1),
+    )
+
+    # Relisted after the instance became ready and the other was removed
+    await manager.manager.init_db_from_cluster([ready_deployment])
+
+    states = {
+        status.name: status.state for status in (c.args[0] for c in publish.mock_calls)
+    }
+    assert states == {
+        test_instance.name: github.GitHubStatusState.success,
+        removed.name: github.GitHubStatusState.failure,
+    }
+    assert ("ready", test_instance.name) in {
+        (c.args[0], c.args[1].name) for c in feed.mock_calls
+    }
+    watch.assert_called_once_with(test_instance.name)
+
+    # Nothing changed since the last list
+    publish.reset_mock()
+    await manager.manager.init_db_from_cluster([ready_deployment])
+    publish.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_apply_kubernetes_events_batch(mocker):
+    await create_tables(drop=True)
+    publish = mocker.patch("gestor.manager.publisher.publish")
+    instance_2 = Instance(git_info=test_git_info_2)
+    await store.create_instance(instance_2)
+    write_instances = mocker.spy(manager.manager.store, "write_instances")
+    deleted = V1Deployment(
+        metadata=V1ObjectMeta(
+            name="deleted-deployment",
+            labels={"gestor/name": instance_2.name},
+            annotations={
+                **test_deployment.metadata.annotations,
+                "gestor/pull_request": test_git_info_2.pull_request,
+            },
+        ),
+        status=V1DeploymentStatus(ready_replicas=1),
+    )
+
+    await manager.manager.apply_kubernetes_events(
+        [
+            {"type": "ADDED", "object": test_deployment},
+            {"type": "DELETED", "object": deleted},
+        ]
+    )
+
+    write_instances.assert_called_once()
+    db_instances = await store.get_instances()
+    assert [i.name for i in db_instances] == [test_instance.name]
+    assert publish.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_apply_kubernetes_events_upserts_modified(mocker):
+    await create_tables(drop=True)
+    mocker.patch("gestor.manager.publisher.publish")
+    watch = mocker.patch.object(manager.manager.logs, "watch")
+    await store.create_instance(test_instance)
+    assert not (await store.get_instance(test_instance.name)).is_ready
+    ready_deployment = V1Deployment(
+        metadata=test_deployment.metadata,
+        status=V1DeploymentStatus(replicas=1, ready_replicas=1),
+    )
+
+    await manager.manager.apply_kubernetes_events(
+        [{"type": "MODIFIED", "object": ready_deployment}]
+    )
+
+    db_instances = await store.get_instances()
+    assert len(db_instances) == 1
+    assert db_instances[0].is_ready
+    watch.assert_called_once_with(test_instance.name)
+
+
+@pytest.mark.asyncio
+async def test_get_instance_lookups():
+    await create_tables(drop=True)
+    await store.write_instances(
+        [test_instance, Instance(git_info=test_git_info_not_allowed)]
+    )
+
+    instance = await store.get_instance(test_instance.name)
+    assert instance.name == test_instance.name
+    assert await store.get_instance("missing") is None
+    by_branch = await store.get_instance(
+        repository=test_git_info.repository, branch=test_git_info.branch
+    )
+    assert by_branch.name == test_instance.name
+    assert len(await store.get_instances(branch=test_git_info.branch)) == 2
+    assert len(await store.get_ports()) == 2
+
+
+def test_publish_change_ready_once(mocker):
+    publish = mocker.patch.object(manager.manager.feed, "publish")
+    ready = Instance(git_info=test_git_info, is_ready=True)
+
+    manager.manager.publish_change(test_instance, "ADDED")
+    manager.manager.publish_change(ready, "MODIFIED")
+    manager.manager.publish_change(ready, "MODIFIED")
+    manager.manager.publish_change(ready, "DELETED")
+
+    assert [call.args[0] for call in publish.call_args_list] == [
+        "added",
+        "modified",
+        "ready",
+        "modified",
+        "deleted",
+    ]
+
+
+def test_collect_logs_until_deleted(mocker):
+    watch = mocker.patch.object(manager.manager.logs, "watch")
+    unwatch = mocker.patch.object(manager.manager.logs, "unwatch")
+    ready = Instance(git_info=test_git_info, is_ready=True)
+
+    manager.manager.collect_logs(test_instance, "ADDED")
+    manager.manager.collect_logs(ready, "MODIFIED")
+    manager.manager.collect_logs(test_instance, "MODIFIED")
+    manager.manager.collect_logs(test_instance, "DELETED")
+
+    watch.assert_called_once_with(ready.name)
+    unwatch.assert_called_once_with(test_instance.name)
@@ -0,0 +1,171 @@
+import os
+
+import pytest
+
+from config import settings
+from gestor.schemas.git import GitInfo
+from gestor.schemas.instance import Instance
+from gestor.utils import manifests
+
+test_git_info = GitInfo(
+    commit="testtest",
+    pull_request=1,
+    branch="TEST_branch",
+    repository="Som-Energia/test",
+)
+
+test_instance = Instance(git_info=test_git_info)
+
+test_data = {
+    "name": test_instance.name,
+    "domain": settings.DEPLOY_DOMAIN,
+    "labels": {"gestor/name": test_instance.name},
+    **test_instance.git_info.dict(),
+}
+
+
+def _by_kind(objects):
+    return {obj["kind"]: obj for obj in objects}
+
+
+def _services(objects):
+    return {
+        obj["metadata"]["name"]: obj["spec"]
+        for obj in objects
+        if obj["kind"] == "Service"
+    }
+
+
+def _gestor_data(**data):
+    """Data the manager renders the files in gestor/kubernetes with"""
+    return {
+        **test_data,
+        "labels": {},
+        "server_port": 30001,
+        "ssh_port": 30002,
+        "created_at": test_instance.created_at,
+        "target_module": None,
+        **data,
+    }
+
+
+@pytest.fixture(scope="module")
+def renderer():
+    return manifests.ManifestRenderer(
+        os.path.join(os.path.dirname(manifests.__file__), "..", "kubernetes")
+    )
+
+
+def test_render_ok():
+    objects = _by_kind(manifests.render(test_data))
+    assert set(objects) == {"Deployment", "Service", "Ingress", "ConfigMap"}
+    for obj in objects.values():
+        assert obj["metadata"]["name"].startswith(test_instance.name + "-")
+        assert obj["metadata"]["labels"]["gestor/name"] == test_instance.name
+
+
+def test_render_patches():
+    objects = _by_kind(manifests.render(test_data))
+    ingress = objects["Ingress"]
+    assert ingress["spec"]["rules"][0]["host"] == "%s.%s" % (
+        test_instance.name,
+        settings.DEPLOY_DOMAIN,
+    )
+    backend = ingress["spec"]["rules"][0]["http"]["paths"][0]["backend"]
+    assert backend["service"]["name"] == test_instance.name + "-erpserver"
+
+
+def test_render_common_labels_selectors():
+    objects = _by_kind(manifests.render(test_data))
+    deployment = objects["Deployment"]
+    assert deployment["spec"]["selector"]["matchLabels"] == {
+        "app": "erpserver",
+        "gestor/name": test_instance.name,
+    }
+    template_labels = deployment["spec"]["template"]["metadata"]["labels"]
+    assert template_labels == deployment["spec"]["selector"]["matchLabels"]
+    assert objects["Service"]["spec"]["selector"]["gestor/name"] == test_instance.name
+
+
+def test_render_config_map_generator():
+    objects = _by_kind(manifests.render(test_data))
+    config_map = objects["ConfigMap"]
+    assert config_map["data"]["COMMIT"] == "testtest"
+    assert config_map["data"]["CI_PULL_REQUEST"] == "1"
+    assert config_map["metadata"]["name"].startswith(
+        test_instance.name + "-environmentvars-"
+    )
+    container = objects["Deployment"]["spec"]["template"]["spec"]["containers"][0]
+    assert (
+        container["envFrom"][0]["configMapRef"]["name"]
+        == config_map["metadata"]["name"]
+    )
+
+
+def test_render_config_map_hash_changes_with_data():
+    name = _by_kind(manifests.render(test_data))["ConfigMap"]["metadata"]["name"]
+    assert (
+        name == _by_kind(manifests.render(test_data))["ConfigMap"]["metadata"]["name"]
+    )
+    other_name = _by_kind(manifests.render({**test_data, "commit": "other"}))[
+        "ConfigMap"
+    ]["metadata"]["name"]
+    assert name != other_name
+
+
+def test_render_does_not_modify_loaded_files():
+    manifests.render(test_data)
+    objects = _by_kind(manifests.render({**test_data, "name": "other"}))
+    assert objects["Deployment"]["metadata"]["name"] == "other-erpserver-deployment"
+
+
+def test_render_missing_data():
+    data = {
+        "name": test_instance.name,
+        "labels": {},
+        **test_instance.git_info.dict(),
+    }
+    with pytest.raises(manifests.TemplateRenderFailed):
+        manifests.render(data)
+
+
+def test_render_gestor_files(renderer):
+    objects = _by_kind(renderer.render(_gestor_data()))
+    assert [port["nodePort"] for port in objects["Service"]["spec"]["ports"]] == [
+        30001,
+        30002,
+    ]
+    annotations = objects["Deployment"]["metadata"]["annotations"]
+    assert annotations["gestor/commit"] == "testtest"
+
+
+def test_render_gestor_files_ssh_gateway(renderer):
+    objects = renderer.render(_gestor_data(ssh_port=22, ssh_mode="gateway"))
+    services = _services(objects)
+    server = services[test_instance.name + "-erpserver"]
+    ssh = services[test_instance.name + "-erpserver-ssh"]
+    assert [port["name"] for port in server["ports"]] == ["erpserver"]
+    assert ssh["type"] == "ClusterIP"
+    assert ssh["ports"][0]["port"] == 22
+    assert ssh["selector"]["gestor/name"] == test_instance.name
+
+
+def test_render_gestor_files_ingress(renderer):
+    data = _gestor_data(server_port=8069, expose_mode="ingress")
+    objects = renderer.render(data)
+    services = _services(objects)
+    server = services[test_instance.name + "-erpserver"]
+    assert server["type"] == "ClusterIP"
+    assert server["ports"] == [{"name": "erpserver", "port": 8069, "targetPort": 8069}]
+    # Without the SSH gateway, only SSH takes a NodePort
+    ssh = services[test_instance.name + "-erpserver-ssh"]
+    assert ssh["type"] == "NodePort"
+    assert ssh["ports"][0]["nodePort"] == 30002
+    ingress = _by_kind(objects)["Ingress"]
+    rule = ingress["spec"]["rules"][0]
+    assert rule["host"] == "%s.%s" % (test_instance.name, settings.DEPLOY_DOMAIN)
+    backend = rule["http"]["paths"][0]["backend"]["service"]
+    assert backend["name"] == test_instance.name + "-erpserver"
+
+    objects = renderer.render({**data, "ssh_mode": "gateway"})
+    assert all(spec["type"] == "ClusterIP" for spec in _services(objects).values())
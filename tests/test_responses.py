@@ -0,0 +1,86 @@
+import gzip
+
+import pytest
+from fastapi import Request
+
+from gestor.utils.responses import (
+    BodyCache,
+    accepts_gzip,
+    cached_response,
+    encode,
+    gzip_chunks,
+)
+
+
+def _request(headers: dict = None) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (key.lower().encode(), value.encode())
+                for key, value in (headers or {}).items()
+            ],
+        }
+    )
+
+
+def test_encode():
+    cached = encode({"name": "test", "ports": [1, 2]})
+
+    assert cached.body == b'{"name":"test","ports":[1,2]}'
+    assert cached.etag == encode({"name": "test", "ports": [1, 2]}).etag
+    assert cached.etag != encode({"name": "test"}).etag
+
+
+def test_body_cache_invalidated_by_version():
+    bodies = BodyCache()
+    assert bodies.get(1, "key") is None
+    stored = bodies.store(1, "key", [1])
+
+    assert bodies.get(1, "key") == stored
+    assert bodies.get(2, "key") is None
+    assert bodies.stats() == {"size": 0, "hits": 1, "misses": 2}
+
+
+def test_body_cache_skips_outdated_data():
+    bodies = BodyCache()
+    bodies.get(1, "key")
+    bodies.get(2, "other")
+
+    bodies.store(1, "key", [1])
+
+    assert bodies.get(2, "key") is None
+
+
+def test_cached_response_not_modified():
+    cached = encode([1])
+
+    response = cached_response(_request(), cached)
+    assert response.status_code == 200
+    assert response.body == cached.body
+    assert response.headers["etag"] == cached.etag
+
+    response = cached_response(_request({"If-None-Match": cached.etag}), cached)
+    assert response.status_code == 304
+    assert response.body == b""
+    response = cached_response(_request({"If-None-Match": '"other"'}), cached)
+    assert response.status_code == 200
+
+
+def test_accepts_gzip():
+    assert accepts_gzip(_request({"Accept-Encoding": "deflate, gzip;q=0.5"}))
+    assert not accepts_gzip(_request({"Accept-Encoding": "gzip;q=0"}))
+    assert not accepts_gzip(_request())
+
+
+@pytest.mark.asyncio
+async def test_gzip_chunks():
+    async def chunks():
+        for number in range(100):
+            yield b"line %d\n" % number
+
+    compressed = b"".join([chunk async for chunk in gzip_chunks(chunks())])
+
+    assert gzip.decompress(compressed) == b"".join(
+        b"line %d\n" % number for number in range(100)
+    )
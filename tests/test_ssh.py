@@ -0,0 +1,318 @@
+import asyncio
+import os
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+import paramiko
+import pytest
+from fastapi.testclient import TestClient
+
+from config import settings
+from gestor import manager
+from gestor.main import app
+from gestor.models.store import MemoryInstanceStore
+from gestor.schemas.git import GitInfo
+from gestor.schemas.instance import Instance
+from gestor.utils import ssh
+
+test_git_info = GitInfo(
+    commit="testtest",
+    pull_request=1,
+    branch="TEST_branch",
+    repository="Som-Energia/openerp_som_addons",
+)
+
+
+class FakeChannel:
+    """Channel whose file descriptor is readable while it has output, as paramiko's"""
+
+    def __init__(self):
+        self._read, self._write = os.pipe()
+        self._buffer = b""
+        self.closed = False
+        self.eof_received = False
+        self.sent = b""
+        self.size = None
+
+    def fileno(self) -> int:
+        return self._read
+
+    def feed(self, data: bytes) -> None:
+        if not self._buffer:
+            os.write(self._write, b"*")
+        self._buffer += data
+
+    def eof(self) -> None:
+        self.eof_received = True
+        os.write(self._write, b"*")
+
+    def recv_ready(self) -> bool:
+        return bool(self._buffer)
+
+    def recv(self, size: int) -> bytes:
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if not self._buffer:
+            os.read(self._read, 1)
+        return data
+
+    def send_ready(self) -> bool:
+        return True
+
+    def send(self, data: bytes) -> int:
+        self.sent += data
+        return len(data)
+
+    def resize_pty(self, width: int, height: int) -> None:
+        self.size = (width, height)
+
+
+@pytest.mark.asyncio
+async def test_recv_waits_for_output():
+    chan = FakeChannel()
+
+    read = asyncio.create_task(ssh.recv(chan))
+    await asyncio.sleep(0.01)
+    assert not read.done()
+
+    chan.feed(b"hello")
+    assert await read == b"hello"
+
+    chan.eof()
+    assert await ssh.recv(chan) == b""
+
+
+@pytest.mark.asyncio
+async def test_ssh_connection(mocker):
+    store = MemoryInstanceStore()
+    mocker.patch.object(manager.manager, "store", store)
+    instance = Instance(git_info=test_git_info)
+    await store.write_instances([instance])
+    chan = FakeChannel()
+    open_shell = mocker.patch.object(
+        ssh.pool, "open_shell", AsyncMock(return_value=chan)
+    )
+    release = mocker.patch.object(ssh.pool, "release", AsyncMock())
+
+    with TestClient(app).websocket_connect(
+        "/api/instances/%s/ssh" % instance.name
+    ) as websocket:
+        websocket.send_text('{"type":"resize","cols":80,"rows":24}')
+        websocket.send_text("ls\n")
+        chan.feed("héllo".encode())
+        assert websocket.receive_bytes() == "héllo".encode()
+        chan.eof()
+        assert websocket.receive()["type"] == "websocket.close"
+
+    address = (settings.SSH_IP, instance.ssh_port)
+    open_shell.assert_called_once_with(address)
+    assert chan.size == (80, 24)
+    assert chan.sent == b"ls\n"
+    release.assert_called_once_with(chan)
+    assert ssh.stats()["bridges"] == 0
+
+
+@pytest.mark.asyncio
+async def test_ssh_connection_text(mocker):
+    store = MemoryInstanceStore()
+    mocker.patch.object(manager.manager, "store", store)
+    instance = Instance(git_info=test_git_info)
+    await store.write_instances([instance])
+    chan = FakeChannel()
+    mocker.patch.object(ssh.pool, "open_shell", AsyncMock(return_value=chan))
+    mocker.patch.object(ssh.pool, "release", AsyncMock())
+    mocker.patch.object(ssh, "FLUSH_DELAY", 0)
+    encoded = "héllo".encode()
+
+    with TestClient(app).websocket_connect(
+        "/api/instances/%s/ssh?text=true" % instance.name
+    ) as websocket:
+        # The é is split between two reads
+        chan.feed(encoded[:2])
+        while chan.recv_ready():
+            time.sleep(0.01)
+        chan.feed(encoded[2:])
+        assert websocket.receive_text() == "h"
+        assert websocket.receive_text() == "éllo"
+        chan.eof()
+
+
+@pytest.mark.asyncio
+async def test_recv_batch_coalesces_output(mocker):
+    mocker.patch.object(ssh, "FLUSH_SIZE", 8)
+    mocker.patch.object(ssh, "FLUSH_DELAY", 1)
+    chan = FakeChannel()
+
+    async def write():
+        for chunk in (b"one ", b"two ", b"three"):
+            chan.feed(chunk)
+            await asyncio.sleep(0.001)
+        chan.eof()
+
+    writer = asyncio.create_task(write())
+    assert await ssh.recv_batch(chan) == b"one two "
+    await writer
+    assert await ssh.recv_batch(chan) == b"three"
+    assert await ssh.recv_batch(chan) == b""
+
+
+def _client() -> MagicMock:
+    client = MagicMock()
+    client.get_transport.return_value.is_active.return_value = True
+    client.get_transport.return_value.is_authenticated.return_value = True
+    client.invoke_shell.side_effect = lambda term: MagicMock()
+    return client
+
+
+@pytest.mark.asyncio
+async def test_pool_reuses_connections(mocker):
+    client = _client()
+    connect = mocker.patch.object(ssh, "_connect", return_value=client)
+    pool = ssh.TransportPool(idle_timeout=60, max_channels=10)
+    address = ("localhost", 2222)
+
+    first = await pool.open_shell(address)
+    second = await pool.open_shell(address)
+
+    assert connect.call_count == 1
+    assert pool.stats()["channels"] == 2
+    assert pool.stats()["reused"] == 1
+
+    await pool.release(first)
+    await pool.release(second)
+    first.close.assert_called_once()
+    assert pool.stats()["idle"] == 1
+    await pool.reap()
+    assert pool.stats()["connections"] == 1
+
+    # Connections are health checked before being reused
+    client.get_transport.return_value.is_active.return_value = False
+    connect.return_value = _client()
+    await pool.open_shell(address)
+    assert connect.call_count == 2
+    client.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_pool_reaps_idle_connections(mocker):
+    client = _client()
+    mocker.patch.object(ssh, "_connect", return_value=client)
+    pool = ssh.TransportPool(idle_timeout=0, max_channels=10)
+    address = ("localhost", 2222)
+
+    chan = await pool.open_shell(address)
+    await pool.reap()
+    assert pool.stats()["connections"] == 1
+
+    await pool.release(chan)
+    await pool.reap()
+    assert pool.stats()["connections"] == 0
+    client.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_pool_dedicated_connections(mocker):
+    pooled, dedicated = _client(), _client()
+    mocker.patch.object(ssh, "_connect", side_effect=[pooled, dedicated])
+    pool = ssh.TransportPool(idle_timeout=60, max_channels=1)
+    address = ("localhost", 2222)
+
+    await pool.open_shell(address)
+    chan = await pool.open_shell(address)
+    assert pool.stats() == {
+        "connections": 2,
+        "channels": 2,
+        "idle": 0,
+        "handshakes": 2,
+        "reused": 0,
+    }
+
+    await pool.release(chan)
+    dedicated.close.assert_called_once()
+    pooled.close.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_pool_dedicated_connections_concurrent(mocker):
+    clients = [_client(), _client()]
+    mocker.patch.object(ssh, "_connect", side_effect=clients)
+    pool = ssh.TransportPool(idle_timeout=60, max_channels=1)
+    address = ("localhost", 2222)
+
+    await asyncio.gather(pool.open_shell(address), pool.open_shell(address))
+
+    assert pool.stats()["connections"] == 2
+    assert pool.stats()["channels"] == 2
+
+
+@pytest.mark.asyncio
+async def test_pool_release_after_replacement(mocker):
+    old, new = _client(), _client()
+    mocker.patch.object(ssh, "_connect", side_effect=[old, new])
+    pool = ssh.TransportPool(idle_timeout=0, max_channels=10)
+    address = ("localhost", 2222)
+
+    stale = await pool.open_shell(address)
+    old.get_transport.return_value.is_active.return_value = False
+    await pool.open_shell(address)
+    await pool.release(stale)
+    await pool.reap()
+
+    # The shell of the old connection does not count for its replacement
+    assert pool.stats()["channels"] == 1
+    assert pool.stats()["idle"] == 0
+    new.close.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_pool_retries_dead_connections(mocker):
+    dead, alive = _client(), _client()
+
+    def invoke_shell(term):
+        dead.get_transport.return_value.is_active.return_value = False
+        raise EOFError()
+
+    dead.invoke_shell.side_effect = invoke_shell
+    connect = mocker.patch.object(ssh, "_connect", side_effect=[dead, alive])
+    pool = ssh.TransportPool(idle_timeout=60, max_channels=10)
+
+    await pool.open_shell(("localhost", 2222))
+
+    assert connect.call_count == 2
+    dead.close.assert_called_once()
+    assert pool.stats()["channels"] == 1
+
+
+@pytest.mark.asyncio
+async def test_pool_channel_refused(mocker):
+    pooled, dedicated = _client(), _client()
+    connect = mocker.patch.object(ssh, "_connect", side_effect=[pooled, dedicated])
+    pool = ssh.TransportPool(idle_timeout=60, max_channels=10)
+    address = ("localhost", 2222)
+
+    first = await pool.open_shell(address)
+    pooled.invoke_shell.side_effect = paramiko.ChannelException(1, "Refused")
+    chan = await pool.open_shell(address)
+
+    # The shell already open keeps its connection
+    assert connect.call_count == 2
+    pooled.close.assert_not_called()
+    assert pool.stats()["channels"] == 2
+    await pool.release(chan)
+    dedicated.close.assert_called_once()
+    await pool.release(first)
+    assert pool.stats()["idle"] == 1
+
+
+def test_instance_address(mocker):
+    assert ssh.instance_address("test", 30002) == (settings.SSH_IP, 30002)
+
+    mocker.patch.object(settings, "SSH_MODE", "gateway")
+    assert ssh.instance_address("test", 22) == (
+        "test-erpserver-ssh.%s.svc.cluster.local" % settings.KUBERNETES_NAMESPACE,
+        22,
+    )
+    assert Instance(git_info=test_git_info).ssh_port == settings.SSH_GATEWAY_PORT
+
+    mocker.patch.object(settings, "SSH_MODE", "tunnel")
+    with pytest.raises(ssh.UnsupportedSSHMode):
+        ssh.instance_address("test", 22)
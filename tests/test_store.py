@@ -0,0 +1,192 @@
+import asyncio
+import datetime
+
+import pytest
+import pytest_asyncio
+
+from gestor.models.store import (
+    MemoryInstanceStore,
+    Snapshot,
+    SQLInstanceStore,
+    UnsupportedInstanceStore,
+    get_store,
+)
+from gestor.schemas.git import GitInfo
+from gestor.schemas.instance import Instance
+from gestor.utils.database import create_tables
+
+test_instance = Instance(
+    git_info=GitInfo(
+        commit="testtest",
+        pull_request=1,
+        branch="TEST_branch",
+        repository="Som-Energia/openerp_som_addons",
+    )
+)
+
+test_instance_2 = Instance(
+    git_info=GitInfo(
+        commit="testtesttest",
+        pull_request=2,
+        branch="TEST_branch_2",
+        repository="Som-Energia/openerp_som_addons",
+    )
+)
+
+
+@pytest_asyncio.fixture(params=["sql", "memory"])
+async def store(request):
+    await create_tables(drop=True)
+    return get_store(request.param)
+
+
+def test_get_store():
+    assert isinstance(get_store("sql"), SQLInstanceStore)
+    assert isinstance(get_store("memory"), MemoryInstanceStore)
+    with pytest.raises(UnsupportedInstanceStore):
+        get_store("redis")
+
+
+@pytest.mark.asyncio
+async def test_create_and_lookup(store):
+    await store.create_instance(test_instance)
+    await store.create_instance(test_instance_2)
+    await store.create_instance(test_instance)
+
+    assert len(await store.get_instances()) == 2
+    assert (
+        Instance.from_orm(await store.get_instance(test_instance.name)) == test_instance
+    )
+    assert await store.get_instance("missing") is None
+    assert await store.get_instance() is None
+    by_branch = await store.get_instance(
+        repository=test_instance_2.git_info.repository,
+        branch=test_instance_2.git_info.branch,
+    )
+    assert by_branch.name == test_instance_2.name
+    by_commit = await store.get_instance(commit="testtest")
+    assert by_commit.name == test_instance.name
+    by_port = await store.get_instance_by_port(test_instance.ssh_port)
+    assert by_port.name in (
+        test_instance.name,
+        test_instance_2.name,
+    )
+    assert sorted(tuple(ports) for ports in await store.get_ports()) == sorted(
+        [
+            (test_instance.server_port, test_instance.ssh_port),
+            (test_instance_2.server_port, test_instance_2.ssh_port),
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_write_instances(store):
+    await store.write_instances([test_instance, test_instance_2])
+    ready = test_instance.copy(update={"is_ready": True})
+
+    await store.write_instances([ready], deleted=[test_instance_2.name])
+
+    instances = await store.get_instances()
+    assert [instance.name for instance in instances] == [test_instance.name]
+    assert instances[0].is_ready
+
+
+@pytest.mark.asyncio
+async def test_write_instances_replace(store):
+    await store.write_instances([test_instance])
+
+    await store.write_instances([test_instance_2], replace=True)
+
+    assert [i.name for i in await store.get_instances()] == [test_instance_2.name]
+
+
+@pytest.mark.asyncio
+async def test_delete_instance(store):
+    await store.create_instance(test_instance)
+
+    await store.delete_instance(test_instance)
+
+    assert await store.get_instances() == []
+
+
+@pytest.mark.asyncio
+async def test_memory_snapshot_not_modified_by_writes():
+    store = MemoryInstanceStore()
+    await store.write_instances([test_instance])
+    snapshot = store.snapshot()
+
+    await store.write_instances([test_instance_2], deleted=[test_instance.name])
+
+    assert list(snapshot.names) == [test_instance.name]
+    assert list(store.snapshot().names) == [test_instance_2.name]
+    with pytest.raises(AttributeError):
+        snapshot.names[test_instance.name].is_ready = True
+
+
+@pytest.mark.asyncio
+async def test_memory_snapshot_updates_indexes():
+    store = MemoryInstanceStore()
+    ready = test_instance.copy(update={"is_ready": True})
+    await store.write_instances([test_instance, test_instance_2])
+
+    await store.write_instances([ready], deleted=[test_instance_2.name])
+
+    snapshot = store.snapshot()
+    rebuilt = Snapshot(dict(snapshot.names))
+    for attribute in ("ordered", "branches", "pull_requests", "commits"):
+        assert getattr(snapshot, attribute) == getattr(rebuilt, attribute)
+    assert snapshot.ordered[0].is_ready
+    assert await store.get_instance_by_port(test_instance_2.server_port) is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_tasks(store):
+    instances = [Instance(git_info=test_instance.git_info) for _ in range(20)]
+
+    await asyncio.gather(
+        *(store.create_instance(instance) for instance in instances),
+        *(store.get_instances() for _ in instances),
+    )
+
+    assert len(await store.get_instances()) == 20
+
+
+@pytest.mark.asyncio
+async def test_get_instances_filters(store):
+    ready = test_instance_2.copy(update={"is_ready": True})
+    await store.write_instances([test_instance, ready])
+    repository = test_instance.git_info.repository
+
+    async def names(**filters):
+        return [instance.name for instance in await store.get_instances(**filters)]
+
+    assert await names(repository=repository, pull_request=2) == [ready.name]
+    assert await names(is_ready=True) == [ready.name]
+    assert await names(is_ready=False) == [test_instance.name]
+    assert await names(repository="Som-Energia/test") == []
+    created_after = min(test_instance.created_at, ready.created_at)
+    assert len(await names(created_after=created_after)) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_instances_pages(store):
+    instances = [Instance(git_info=test_instance.git_info) for _ in range(5)]
+    await store.write_instances(instances)
+    expected = sorted(instance.name for instance in instances)
+
+    first = [instance.name for instance in await store.get_instances(limit=2)]
+    rest = await store.get_instances(after=first[-1], limit=10)
+
+    assert first + [instance.name for instance in rest] == expected
+
+
+@pytest.mark.asyncio
+async def test_get_instances_created_after_aware(store):
+    await store.write_instances([test_instance])
+    before = test_instance.created_at - datetime.timedelta(seconds=1)
+    aware = before.astimezone(datetime.timezone.utc)
+
+    instances = await store.get_instances(created_after=aware)
+    assert [instance.name for instance in instances] == [test_instance.name]
+    later = aware + datetime.timedelta(days=1)
+    assert await store.get_instances(created_after=later) == []
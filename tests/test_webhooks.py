@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from config import settings
+from gestor.main import app
+from gestor.routers import webhooks
+
+client = TestClient(app)
+
+test_payload = {
+    "action": "synchronize",
+    "pull_request": {
+        "number": 1,
+        "head": {
+            "ref": "TEST_branch",
+            "sha": "testtest",
+            "repo": {"full_name": "Som-Energia/openerp_som_addons"},
+        },
+    },
+}
+
+
+def _post(payload, delivery="1", secret=settings.WEBHOOKS_SECRET):
+    body = json.dumps(payload).encode("utf-8")
+    signature = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return client.post(
+        "/webhooks/github",
+        content=body,
+        headers={
+            "X-GitHub-Event": "pull_request",
+            "X-GitHub-Delivery": delivery,
+            "X-Hub-Signature-256": "sha256=" + signature,
+        },
+    )
+
+
+def test_webhook_schedules_deploy(mocker):
+    schedule = mocker.patch("gestor.routers.webhooks.debouncer.schedule")
+    mocker.patch("gestor.routers.webhooks.deliveries", webhooks.DeliveryLog(10))
+
+    assert _post(test_payload).status_code == 200
+
+    key, func, git_info = schedule.call_args.args
+    assert key == ("Som-Energia/openerp_som_addons", "TEST_branch")
+    assert func == webhooks.manager.start_instance_from_webhook
+    assert git_info.commit == "testtest"
+
+
+def test_webhook_invalid_signature(mocker):
+    schedule = mocker.patch("gestor.routers.webhooks.debouncer.schedule")
+    mocker.patch("gestor.routers.webhooks.deliveries", webhooks.DeliveryLog(10))
+
+    assert _post(test_payload, secret="invalid").status_code == 200
+    schedule.assert_not_called()
+
+
+def test_webhook_duplicated_delivery(mocker):
+    schedule = mocker.patch("gestor.routers.webhooks.debouncer.schedule")
+    mocker.patch("gestor.routers.webhooks.deliveries", webhooks.DeliveryLog(10))
+
+    _post(test_payload, delivery="2")
+    _post(test_payload, delivery="2")
+    schedule.assert_called_once()
+
+
+def test_webhook_invalid_payload(mocker):
+    schedule = mocker.patch("gestor.routers.webhooks.debouncer.schedule")
+    mocker.patch("gestor.routers.webhooks.deliveries", webhooks.DeliveryLog(10))
+
+    assert _post({"action": "synchronize"}, delivery="3").status_code == 400
+    schedule.assert_not_called()
+    # The redelivery of a failed delivery is not dropped
+    assert _post(test_payload, delivery="3").status_code == 200
+    schedule.assert_called_once()
+
+
+def test_delivery_log_bounded():
+    deliveries = webhooks.DeliveryLog(2)
+    for delivery in ["1", "2", "3"]:
+        assert not deliveries.seen(delivery)
+        deliveries.record(delivery)
+    assert deliveries.seen("3")
+    assert not deliveries.seen("1")
+
+
+@pytest.mark.asyncio
+async def test_debouncer_runs_last_call():
+    debouncer = webhooks.Debouncer(0.01, 1)
+    func = AsyncMock()
+
+    for commit in ["a", "b", "c"]:
+        debouncer.schedule(("repository", "branch"), func, commit)
+    debouncer.schedule(("repository", "other"), func, "d")
+    await asyncio.sleep(0.05)
+
+    assert sorted(call.args[0] for call in func.call_args_list) == ["c", "d"]
+    assert debouncer.debounced == 2
+
+
+@pytest.mark.asyncio
+async def test_debouncer_max_wait():
+    debouncer = webhooks.Debouncer(0.05, 0.1)
+    func = AsyncMock()
+
+    # Calls keep coming faster than the delay, the last one runs at max_wait
+    for commit in ["a", "b", "c", "d"]:
+        debouncer.schedule(("repository", "branch"), func, commit)
+        await asyncio.sleep(0.03)
+
+    func.assert_called_once()
+    assert func.call_args.args[0] in ["c", "d"]
+    await debouncer.stop()
+
+
+@pytest.mark.asyncio
+async def test_debouncer_stop():
+    debouncer = webhooks.Debouncer(0.01, 1)
+    started = asyncio.Event()
+    calls = []
+
+    async def func(commit):
+        calls.append(commit)
+        started.set()
+        await asyncio.sleep(60)
+
+    debouncer.schedule(("repository", "branch"), func, "a")
+    await started.wait()
+    debouncer.schedule(("repository", "branch"), func, "b")
+    task = next(iter(debouncer._tasks))
+
+    await debouncer.stop()
+    await asyncio.sleep(0.05)
+    assert task.cancelled()
+    assert calls == ["a"]